@@ -0,0 +1,289 @@
+""" bench.py
+benchmark suite for the harvest, stats and matching hot paths
+
+Generates a synthetic photo tree (tiny JPEGs with an EXIF DateTimeOriginal,
+in the YYYY/MM/DD and 'posted photos/YYYY/MM' layout) and synthetic
+cache/<user>-tags-pageXXX.json data for the same photos, then times the
+timestamp, matching, cache-reading and statistics functions against them.
+
+Everything is written under a work folder (a temporary folder by default),
+and the cache file locations are redirected there, so the real cache is
+never touched. Results are printed and written as JSON, and --compare shows
+the ratio to a previous results file (e.g., from another commit).
+
+Usage: python bench.py [--photos 10000] [--sample 1000] [--folder PATH]
+                       [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+import exifts
+import flickrtags
+import matcher
+import metacache
+import rollups
+import tagstore
+import tsindex
+
+USERS = ['benchuser1', 'benchuser2']
+
+#-------------------------------------------------------------------------------
+def exif_jpeg(timestamp):
+    """Create a minimal JPEG file with an EXIF DateTimeOriginal.
+
+    timestamp = 'YYYY-MM-DD HH:MM:SS'
+
+    Returns the file contents (bytes): SOI, an APP1 segment containing IFD0
+    and an Exif IFD with tag 0x9003, and EOI. There is no image data, but
+    the EXIF structure is the same as a camera's.
+    """
+    value = timestamp.replace('-', ':', 2).encode('ascii') + b'\x00'
+    tiff = b'II*\x00' + struct.pack('<L', 8)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHLL', 0x8769, 4, 1, 26) + struct.pack('<L', 0)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHLL', 0x9003, 2, len(value), 44) + \
+        struct.pack('<L', 0)
+    tiff += value
+    app1 = b'Exif\x00\x00' + tiff
+    return b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + b'\xff\xd9'
+
+#-------------------------------------------------------------------------------
+def generate_cache(photos, cache_folder, seed=0):
+    """Write synthetic tag data in the format of the cache files.
+
+    photos = list of (relative filename, timestamp) from generate_tree()
+    cache_folder = folder for the <user>-tags-pageXXX.json files
+    seed = random number seed
+
+    Each photo is assigned to a user and given 0-6 keywords from a 5000-word
+    vocabulary with a skewed (Zipf-like) distribution, plus the flickr-<user>
+    tag. Most Flickr timestamps match a file exactly; 10% are off by a few
+    seconds and 5% match no file. Returns the list of tag records.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['tag{0:04}'.format(wordno) for wordno in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    records = {user_id: [] for user_id in USERS}
+    for photono, (_, timestamp) in enumerate(photos):
+        user_id = rng.choice(USERS)
+        chance = rng.random()
+        if chance < 0.05:
+            taken = tsindex.epoch_to_ts(tsindex.ts_to_epoch(timestamp) + rng.randint(3600, 86400))
+        elif chance < 0.15:
+            taken = tsindex.epoch_to_ts(tsindex.ts_to_epoch(timestamp) + rng.randint(1, 5))
+        else:
+            taken = timestamp
+        keywords = sorted(set(rng.choices(vocabulary, weights, k=rng.randint(0, 6))))
+        keywords.append('flickr-' + user_id)
+        records[user_id].append(
+            {'user_id': user_id,
+             'title': 'photo {0}'.format(photono),
+             'taken': taken,
+             'keywords': keywords,
+             'photo_url': 'http://flickr.com/photos/' + user_id + '/' + str(1000000 + photono)})
+
+    os.makedirs(cache_folder, exist_ok=True)
+    for user_id in USERS:
+        # photostream order is newest first, 100 photos per page
+        userphotos = list(reversed(records[user_id]))
+        for pageno, first in enumerate(range(0, len(userphotos), 100), start=1):
+            filename = os.path.join(cache_folder, '{0}-tags-page{1:03}.json'.format(
+                user_id, pageno))
+            with open(filename, 'w') as fhandle:
+                fhandle.write(json.dumps(userphotos[first:first + 100], indent=4,
+                                         sort_keys=True))
+    return [record for user_id in USERS for record in records[user_id]]
+
+#-------------------------------------------------------------------------------
+def generate_tree(photo_home, nphotos, seed=0):
+    """Create a synthetic photo tree.
+
+    photo_home = root folder
+    nphotos = number of photo files
+    seed = random number seed
+
+    Photos are spread randomly from October 2004 through August 2016; 10% are
+    in 'posted photos/YYYY/MM', the rest in YYYY/MM/DD. Returns a list of
+    (filename relative to photo_home, timestamp) tuples.
+    """
+    rng = random.Random(seed)
+    first = tsindex.ts_to_epoch('2004-10-01 00:00:00')
+    last = tsindex.ts_to_epoch('2016-08-31 23:59:59')
+    photos = []
+    for photono in range(nphotos):
+        timestamp = tsindex.epoch_to_ts(rng.randint(first, last))
+        if rng.random() < 0.1:
+            folder = os.path.join('posted photos', timestamp[:4], timestamp[5:7])
+        else:
+            folder = os.path.join(timestamp[:4], timestamp[5:7], timestamp[8:10])
+        filename = os.path.join(folder, 'DSC_{0:07}.jpg'.format(photono))
+        os.makedirs(os.path.join(photo_home, folder), exist_ok=True)
+        with open(os.path.join(photo_home, filename), 'wb') as fhandle:
+            fhandle.write(exif_jpeg(timestamp))
+        photos.append((filename, timestamp))
+    return photos
+
+#-------------------------------------------------------------------------------
+def print_results(results, baseline=None):
+    """Print benchmark results, with ratios to a baseline if provided.
+
+    results = dictionary returned by run_benchmarks()
+    baseline = optional results dictionary from a previous run
+    """
+    print('{0} photos, sample {1}, commit {2}'.format(
+        results['photos'], results['sample'], results['commit']))
+    previous = baseline['timings'] if baseline else dict()
+    for name, timing in results['timings'].items():
+        line = '{0:24} {1:10.3f} sec {2:12,.0f} ops/sec'.format(
+            name, timing['seconds'], timing['ops_per_sec'])
+        if name in previous:
+            line += '  {0:6.2f}x vs {1}'.format(
+                previous[name]['seconds'] / max(timing['seconds'], 1e-9), baseline['commit'])
+        print(line)
+
+#-------------------------------------------------------------------------------
+def run_benchmarks(folder, nphotos=10000, sample=1000, seed=0):
+    """Generate synthetic data and time the hot paths.
+
+    folder = work folder; the photo tree is created in <folder>/photos and
+             the cache in <folder>/cache, replacing any previous run's
+    nphotos = number of photos
+    sample = number of files/timestamps for the per-call benchmarks
+    seed = random number seed
+
+    Returns a dictionary of results, with 'timings' = dictionary of
+    benchmark name -> {seconds, ops, ops_per_sec}.
+    """
+    photo_home = os.path.join(folder, 'photos')
+    cache_folder = os.path.join(folder, 'cache')
+    timings = dict()
+
+    def timed(name, ops, func, *args, **kwargs):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            retval = func(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        timings[name] = {'seconds': round(elapsed, 6), 'ops': ops,
+                         'ops_per_sec': round(ops / max(elapsed, 1e-9), 1)}
+        return retval
+
+    if os.path.isdir(photo_home):
+        shutil.rmtree(photo_home)
+    photos = timed('generate_tree', nphotos, generate_tree, photo_home, nphotos, seed)
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    _redirect_cache(folder)
+    records = timed('generate_cache', nphotos, generate_cache, photos, cache_folder, seed)
+
+    rng = random.Random(seed)
+    sample_files = [os.path.join(photo_home, filename)
+                    for filename, _ in rng.sample(photos, min(sample, nphotos))]
+    sample_ts = [record['taken'] for record in rng.sample(records, min(sample, nphotos))]
+
+    # timestamps of individual files
+    timed('exif_timestamp', len(sample_files),
+          lambda: [exifts.exif_timestamp(filename) for filename in sample_files])
+    timed('filename_ts_cold', len(sample_files),
+          lambda: [flickrtags.filename_ts(filename) for filename in sample_files])
+    timed('filename_ts_warm', len(sample_files),
+          lambda: [flickrtags.filename_ts(filename) for filename in sample_files])
+
+    # matching timestamps to files, one at a time
+    timed('ts_search', len(sample_ts),
+          lambda: [flickrtags.ts_search(os.path.join(photo_home, ts[:4], ts[5:7], ts[8:10]), ts)
+                   for ts in sample_ts])
+    timed('ts_filename_folders', len(sample_ts),
+          lambda: [flickrtags.ts_filename(ts, photo_home=photo_home) for ts in sample_ts])
+    index = timed('tsindex_build', nphotos, tsindex.build_index, photo_home)
+    timed('ts_filename_index', len(sample_ts),
+          lambda: [flickrtags.ts_filename(ts, index) for ts in sample_ts])
+
+    # batch matching
+    timed('match_photos', len(records), matcher.match_photos, records, index)
+
+    # cache readers and statistics
+    timed('tag_records_pages', len(records),
+          lambda: [record for user_id in USERS
+                   for record in flickrtags.tag_records(user_id, normalize=False)])
+    timed('tagstore_migrate', len(records), tagstore.migrate)
+    timed('tag_records_store', len(records),
+          lambda: [record for user_id in USERS
+                   for record in flickrtags.tag_records(user_id, normalize=False)])
+    timed('tag_records_normalized', len(records),
+          lambda: [record for user_id in USERS for record in flickrtags.tag_records(user_id)])
+    timed('generate_stats_cold', len(records), flickrtags.generate_stats, USERS)
+    timed('generate_stats_warm', len(records), flickrtags.generate_stats, USERS)
+
+    metacache.close_store()
+    return {'commit': _git_commit(), 'python': platform.python_version(),
+            'photos': nphotos, 'sample': len(sample_files), 'timings': timings}
+
+#-------------------------------------------------------------------------------
+def _git_commit():
+    """Get the current git commit (short hash), or '' if not available.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=source_folder,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+#-------------------------------------------------------------------------------
+def _redirect_cache(folder):
+    """Point all cache files at <folder>/cache instead of the real cache.
+
+    The cache filenames are hard-coded relative to the source folder (or to
+    the current folder, for the tags pages), so the filename functions are
+    replaced and the current folder is changed for the rest of the run.
+    """
+    cache_folder = os.path.join(folder, 'cache')
+    os.makedirs(cache_folder, exist_ok=True)
+    os.chdir(folder)
+    flickrtags.cache_filename = lambda *, user_id, pageno, datatype: os.path.join(
+        cache_folder, user_id + '-' + datatype + '-page' + str(pageno).zfill(3) + '.json')
+    matcher.matches_filename = lambda: os.path.join(cache_folder, 'matches.json')
+    rollups.rollups_filename = lambda: os.path.join(cache_folder, 'rollups.json')
+    tagstore.store_filename = lambda: os.path.join(cache_folder, 'tags.jsonl')
+    tsindex.index_filename = lambda: os.path.join(cache_folder, 'tsindex.json')
+    metacache.close_store()
+    metacache.open_store(os.path.join(cache_folder, 'metadata.db'))
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Benchmark the photo-keywords hot paths.')
+    PARSER.add_argument('--photos', type=int, default=10000,
+                        help='number of synthetic photos (e.g., 10000 to 1000000)')
+    PARSER.add_argument('--sample', type=int, default=1000,
+                        help='number of files/timestamps for per-call benchmarks')
+    PARSER.add_argument('--seed', type=int, default=0, help='random number seed')
+    PARSER.add_argument('--folder', help='work folder (default = temporary folder)')
+    PARSER.add_argument('--output', help='JSON file for the results')
+    PARSER.add_argument('--compare', help='JSON results file from a previous run')
+    ARGS = PARSER.parse_args()
+
+    FOLDER = os.path.abspath(ARGS.folder) if ARGS.folder else tempfile.mkdtemp(prefix='bench-')
+    try:
+        RESULTS = run_benchmarks(FOLDER, ARGS.photos, ARGS.sample, ARGS.seed)
+    finally:
+        os.chdir(os.path.dirname(os.path.realpath(__file__)))
+        if not ARGS.folder:
+            shutil.rmtree(FOLDER, ignore_errors=True)
+
+    BASELINE = None
+    if ARGS.compare:
+        with open(ARGS.compare, 'r') as fhandle:
+            BASELINE = json.loads(fhandle.read())
+    print_results(RESULTS, BASELINE)
+    if ARGS.output:
+        print('--> writing ' + ARGS.output)
+        with open(ARGS.output, 'w') as fhandle:
+            fhandle.write(json.dumps(RESULTS, indent=4))
@@ -0,0 +1,312 @@
+""" clockoffset.py
+per-camera clock offset detection, to tighten the match window (requires numpy)
+
+A file's EXIF timestamp and the Flickr 'taken' time for the same photo don't
+always agree: a camera left on home time after a trip, a clock that drifts,
+or an upload that was exported after its timestamp was corrected all shift
+one side by a few seconds to several hours. A fixed match window either
+misses those photos or, if it's made wide enough, generates many false
+candidates for every other photo.
+
+Every (Flickr photo, file) pair whose timestamps are within max_offset
+seconds is a candidate, and the offsets (file timestamp - Flickr taken) of
+all candidate pairs are histogrammed per camera model and month, with NumPy.
+Unrelated pairs are spread evenly over the histogram, while a camera whose
+clock disagreed shows a sharp peak; where the peak is strong enough, its
+offset is taken as the camera's offset for that month (or for all months
+of that model, if no single month has enough photos). corrected_index()
+subtracts the offsets from the file timestamps, so that the matcher can be
+run with a window of a second or two.
+
+Usage: python clockoffset.py [--max-offset 14400] [--resolution 2] [--window 1]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import metacache
+import tsindex
+
+#-------------------------------------------------------------------------------
+def apply_offsets(index, filename=None):
+    """Apply saved clock offsets to a timestamp index, for matching.
+
+    index = timestamp index, as returned by tsindex.load_index()
+    filename = optional offsets file; default is cache/clockoffsets.json
+
+    Returns the corrected index (see corrected_index()), or the index
+    unchanged if no offsets have been saved.
+    """
+    offsets = load_offsets(filename)
+    if not offsets:
+        return index
+    models, modelnos = camera_models(index)
+    return corrected_index(index, offsets, models, modelnos)
+
+#-------------------------------------------------------------------------------
+def camera_models(index):
+    """Get the camera model of every file in a timestamp index.
+
+    index = timestamp index, as returned by tsindex.load_index()
+
+    Returns a tuple (models, modelnos): models is a list of the distinct
+    model names ('' for files with no model, or that no longer exist), and
+    modelnos is an int32 array with the model number of each file, parallel
+    to index['filenames']. Models are cached in the metadata store (see
+    metacache.py), so only the first call reads the files.
+    """
+    models = {'': 0}
+    modelnos = np.zeros(len(index['filenames']), dtype=np.int32)
+    for fileno, relpath in enumerate(index['filenames']):
+        try:
+            model = metacache.file_model(os.path.join(index['photo_home'], relpath)) or ''
+        except OSError:
+            model = ''
+        modelnos[fileno] = models.setdefault(model, len(models))
+    return (list(models), modelnos)
+
+#-------------------------------------------------------------------------------
+def candidate_pairs(photo_epochs, file_epochs, max_offset):
+    """Find every (photo, file) pair whose timestamps are close enough.
+
+    photo_epochs = int64 array of Flickr taken times, seconds since the epoch
+    file_epochs = sorted int64 array of file timestamps
+    max_offset = maximum difference in seconds, in either direction
+
+    Returns a tuple of two int64 arrays (photonos, filenos), one entry per
+    candidate pair.
+    """
+    first = np.searchsorted(file_epochs, photo_epochs - max_offset, side='left')
+    last = np.searchsorted(file_epochs, photo_epochs + max_offset, side='right')
+    counts = last - first
+    photonos = np.repeat(np.arange(len(photo_epochs), dtype=np.int64), counts)
+    # file # = first file of the pair's photo + position within that photo's run
+    run_starts = np.cumsum(counts) - counts
+    filenos = np.arange(counts.sum(), dtype=np.int64) - np.repeat(run_starts - first, counts)
+    return (photonos, filenos)
+
+#-------------------------------------------------------------------------------
+def corrected_index(index, offsets, models, modelnos):
+    """Apply detected clock offsets to a timestamp index.
+
+    index = timestamp index, as returned by tsindex.load_index()
+    offsets = dictionary returned by detect_offsets() or load_offsets()
+    models, modelnos = camera models of the files, from camera_models()
+
+    Returns a copy of the index in which each file's timestamp has its
+    camera's offset for that month (or for the model as a whole)
+    subtracted, so that it lines up with the Flickr taken time. The entries
+    are re-sorted by the corrected timestamps.
+    """
+    file_epochs = np.array(index['timestamps'], dtype=np.int64)
+    adjustment = np.zeros(len(file_epochs), dtype=np.int64)
+    if len(file_epochs):
+        monthnos = _month_numbers(file_epochs)
+        for modelno, model in enumerate(models):
+            if model not in offsets:
+                continue
+            in_model = modelnos == modelno
+            if 'all' in offsets[model]:
+                adjustment[in_model] = offsets[model]['all']['offset']
+            for month, detected in offsets[model].items():
+                if month != 'all':
+                    adjustment[in_model & (monthnos == _month_number(month))] = \
+                        detected['offset']
+    corrected = file_epochs - adjustment
+    order = np.argsort(corrected, kind='stable')
+    return dict(index, timestamps=corrected[order].tolist(),
+                filenames=[index['filenames'][fileno] for fileno in order])
+
+#-------------------------------------------------------------------------------
+def detect_offsets(photo_epochs, file_epochs, models, modelnos, max_offset=14400,
+                   resolution=2, min_support=5, min_ratio=10):
+    """Detect per-camera, per-month clock offsets.
+
+    photo_epochs = int64 array of Flickr taken times
+    file_epochs = sorted int64 array of file timestamps
+    models, modelnos = camera models of the files, from camera_models()
+    max_offset = largest offset in seconds (either direction) to look for
+    resolution = histogram bin width in seconds; clocks drift during a month,
+                 so the offsets of true matches are spread over a few seconds
+    min_support = minimum number of pairs in a peak
+    min_ratio = minimum ratio of the pairs in a peak to the number expected
+                if the group's pairs were spread evenly (chance matches)
+
+    Returns a dictionary of model -> {month -> offset}, where month is
+    'YYYY-MM' or 'all' (the whole model), and offset is a dictionary:
+    offset = file timestamp - Flickr taken, in seconds (median of the peak)
+    support = number of candidate pairs at that offset
+    ratio = support / number of pairs expected there by chance
+    Groups without a clear peak are left out, as are groups of files with
+    no camera model.
+    """
+    photo_epochs = np.asarray(photo_epochs, dtype=np.int64)
+    file_epochs = np.asarray(file_epochs, dtype=np.int64)
+    photonos, filenos = candidate_pairs(photo_epochs, file_epochs, max_offset)
+    deltas = file_epochs[filenos] - photo_epochs[photonos]
+    pair_models = modelnos[filenos].astype(np.int64)
+    pair_months = _month_numbers(file_epochs[filenos])
+    first_month = pair_months.min() if len(pair_months) else 0
+    nmonths = (pair_months.max() - first_month + 1) if len(pair_months) else 1
+
+    offsets = dict()
+    groupings = [('all', pair_models),
+                 ('month', pair_models * nmonths + (pair_months - first_month))]
+    for grouping, groups in groupings:
+        for group, offset, support, ratio in _histogram_peaks(
+                groups, deltas, max_offset, resolution):
+            if support < min_support or ratio < min_ratio:
+                continue
+            if grouping == 'all':
+                modelno, month = group, 'all'
+            else:
+                modelno, monthno = divmod(group, nmonths)
+                month = _month_name(first_month + monthno)
+            if models[modelno]:
+                offsets.setdefault(models[modelno], dict())[month] = \
+                    {'offset': offset, 'support': support, 'ratio': round(ratio, 1)}
+    return offsets
+
+#-------------------------------------------------------------------------------
+def load_offsets(filename=None):
+    """Load saved clock offsets.
+
+    filename = optional filename; default is cache/clockoffsets.json
+
+    Returns the dictionary saved by save_offsets(), or an empty dictionary if
+    no offsets have been saved.
+    """
+    filename = filename or offsets_filename()
+    if not os.path.isfile(filename):
+        return dict()
+    with open(filename, 'r', encoding='utf-8') as fhandle:
+        return json.loads(fhandle.read())
+
+#-------------------------------------------------------------------------------
+def offsets_filename():
+    """Get filename for the saved clock offsets.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/clockoffsets.json')
+
+#-------------------------------------------------------------------------------
+def print_offsets(offsets):
+    """Print detected clock offsets, one line per camera model and month.
+    """
+    for model in sorted(offsets):
+        for month in sorted(offsets[model], key=lambda month: (month != 'all', month)):
+            detected = offsets[model][month]
+            print('{0:24} {1:7} {2:+8,} sec  {3:6,} pairs  {4:8,.1f}x chance'.format(
+                model[:24], month, detected['offset'], detected['support'],
+                detected['ratio']))
+
+#-------------------------------------------------------------------------------
+def save_offsets(offsets, filename=None):
+    """Save detected clock offsets to disk.
+
+    offsets = dictionary returned by detect_offsets()
+    filename = optional filename; default is cache/clockoffsets.json
+    """
+    filename = filename or offsets_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename, 'w', encoding='utf-8') as fhandle:
+        fhandle.write(json.dumps(offsets, indent=4, sort_keys=True, ensure_ascii=False))
+
+#-------------------------------------------------------------------------------
+def _histogram_peaks(groups, deltas, max_offset, resolution):
+    """Find the highest bin of each group's offset histogram.
+
+    groups = int64 array, the group number of each candidate pair
+    deltas = int64 array, the offset of each candidate pair
+    max_offset/resolution = range and bin width of the histograms
+
+    Generates (group, offset, support, ratio) tuples; the peak is widened to
+    its neighbouring bins, so that a cluster of offsets that straddles a bin
+    boundary isn't split.
+    """
+    if not len(groups):
+        return
+    nbins = 2 * max_offset // resolution + 3 # +1 bin of padding on each side
+    pair_keys = groups * nbins + (deltas + max_offset) // resolution + 1
+    order = np.argsort(pair_keys, kind='stable')
+    pair_keys, deltas = pair_keys[order], deltas[order]
+    keys, counts = np.unique(pair_keys, return_counts=True)
+    group_pairs = np.bincount(keys // nbins, weights=counts)
+
+    # highest bin of each group: sort by group, then by count descending
+    ranked = np.lexsort((-counts, keys // nbins))
+    first = np.ones(len(ranked), dtype=bool)
+    first[1:] = keys[ranked][1:] // nbins != keys[ranked][:-1] // nbins
+    peak_keys = keys[ranked][first]
+
+    lows = np.searchsorted(pair_keys, peak_keys - 1, side='left')
+    highs = np.searchsorted(pair_keys, peak_keys + 1, side='right')
+    for peak_key, low, high in zip(peak_keys, lows, highs):
+        group = int(peak_key // nbins)
+        expected = group_pairs[group] * 3 / (nbins - 2)
+        yield (group, int(np.round(np.median(deltas[low:high]))), int(high - low),
+               float((high - low) / expected))
+
+#-------------------------------------------------------------------------------
+def _month_name(monthno):
+    """Convert a month number (months since 1970-01) to 'YYYY-MM'.
+    """
+    return '{0:04}-{1:02}'.format(1970 + monthno // 12, monthno % 12 + 1)
+
+#-------------------------------------------------------------------------------
+def _month_number(month):
+    """Convert 'YYYY-MM' to a month number (months since 1970-01).
+    """
+    return (int(month[:4]) - 1970) * 12 + int(month[5:7]) - 1
+
+#-------------------------------------------------------------------------------
+def _month_numbers(epochs):
+    """Get the month number (months since 1970-01) of each of an array of
+    epoch timestamps.
+    """
+    return epochs.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Detect per-camera clock offsets.')
+    PARSER.add_argument('--max-offset', type=int, default=14400,
+                        help='largest offset to look for, in seconds')
+    PARSER.add_argument('--resolution', type=int, default=2,
+                        help='histogram bin width, in seconds')
+    PARSER.add_argument('--window', type=int, default=1,
+                        help='match window to compare, after applying the offsets')
+    ARGS = PARSER.parse_args()
+
+    import matcher
+    import phototable
+    INDEX = tsindex.load_index()
+    if not INDEX:
+        print('ERROR: no timestamp index; run tsindex.py first')
+        sys.exit(1)
+    TABLE = phototable.load_table()
+    START = time.time()
+    MODELS, MODELNOS = camera_models(INDEX)
+    print('camera models: {0:.1f} seconds, {1} models'.format(time.time() - START,
+                                                             len(MODELS) - 1))
+    START = time.time()
+    OFFSETS = detect_offsets(TABLE.taken, np.array(INDEX['timestamps'], dtype=np.int64),
+                             MODELS, MODELNOS, ARGS.max_offset, ARGS.resolution)
+    print('offset detection: {0:.1f} seconds'.format(time.time() - START))
+    print_offsets(OFFSETS)
+    save_offsets(OFFSETS)
+
+    # candidates and matches with the default window vs. the corrected index
+    RECORDS = [TABLE.record(photono) for photono in range(len(TABLE))]
+    CORRECTED = corrected_index(INDEX, OFFSETS, MODELS, MODELNOS)
+    for LABEL, COMPARE_INDEX, WINDOW in [('uncorrected', INDEX, 8),
+                                         ('corrected', CORRECTED, ARGS.window)]:
+        PAIRS = candidate_pairs(TABLE.taken, np.array(COMPARE_INDEX['timestamps'],
+                                                      dtype=np.int64), WINDOW)[0]
+        print('{0}, window {1}: {2:,} candidate pairs'.format(LABEL, WINDOW, len(PAIRS)))
+        matcher.print_report(matcher.match_photos(RECORDS, COMPARE_INDEX, WINDOW))
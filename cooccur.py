@@ -0,0 +1,303 @@
+""" cooccur.py
+tag co-occurrence matrix and keyword suggestions (requires numpy)
+
+Two sparse count matrices are built from the photo table (see
+phototable.py), in one vectorized pass over its keyword arrays:
+- tag x tag: the number of photos that have both tags
+- month x tag: the number of photos from each month that have the tag
+Both are stored in compressed sparse row form (an offsets array, plus
+parallel int32 arrays of column numbers and counts), in cache/cooccur.npz.
+The table's keywords are already normalized (see tagrules.py), so the
+auto-generated flickr-* tags aren't included.
+
+Queries work on a few array slices, so they take milliseconds across the
+whole vocabulary:
+- related(tag) = the tags that most often appear with a tag, scored by
+  cosine similarity (co-occurrences / sqrt(count1 * count2)) so that tags
+  that appear on everything don't dominate
+- suggest(tags, taken) = tags for a photo, from the tags it already has and
+  from what was tagged around its capture date, for filling in photos
+  with few or no keywords
+
+Usage: python cooccur.py related <tag> [--count 10]
+       python cooccur.py suggest [<tag> ...] [--date YYYY[-MM[-DD]]] [--count 10]
+       python cooccur.py untagged [--max-keywords 1] [--limit 20]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+import phototable
+import tagrules
+
+#-------------------------------------------------------------------------------
+class Cooccurrence:
+    """Sparse tag co-occurrence and tag-by-month counts.
+
+    vocabulary = list of tags
+    counts = int32 array, the number of photos with each tag
+    tag_offsets/tag_columns/tag_counts = tag x tag matrix; the tags that
+        appear with tag n are tag_columns[tag_offsets[n]:tag_offsets[n + 1]],
+        and tag_counts has the number of photos for each
+    first_month = month number (months since 1970-01) of month row 0
+    month_offsets/month_columns/month_counts = month x tag matrix, same form
+    month_photos = int32 array, the number of photos in each month
+
+    Create with from_table() or load_matrix().
+    """
+    def __init__(self, *, vocabulary, counts, tag_offsets, tag_columns, tag_counts,
+                 first_month, month_offsets, month_columns, month_counts, month_photos):
+        self.vocabulary = list(vocabulary)
+        self.counts = counts
+        self.tag_offsets = tag_offsets
+        self.tag_columns = tag_columns
+        self.tag_counts = tag_counts
+        self.first_month = int(first_month)
+        self.month_offsets = month_offsets
+        self.month_columns = month_columns
+        self.month_counts = month_counts
+        self.month_photos = month_photos
+        self.tag_numbers = {tag: tagno for tagno, tag in enumerate(self.vocabulary)}
+
+    @classmethod
+    def from_table(cls, table):
+        """Build the matrices from a photo table.
+
+        table = phototable.PhotoTable
+        """
+        nwords = len(table.vocabulary)
+        # distinct (photo, tag) pairs, sorted by photo
+        pairs = np.unique(table.keyword_photos.astype(np.int64) * nwords + table.keyword_ids)
+        photos, words = pairs // nwords, pairs % nwords
+        per_photo = np.bincount(photos, minlength=len(table))
+        photo_starts = np.cumsum(per_photo) - per_photo
+
+        # every ordered pair of different tags on the same photo: entry e is
+        # paired with each entry of its photo
+        runs = per_photo[photos]
+        firsts = np.repeat(np.arange(len(words)), runs)
+        seconds = np.repeat(photo_starts[photos], runs) + \
+            np.arange(runs.sum()) - np.repeat(np.cumsum(runs) - runs, runs)
+        different = firsts != seconds
+        tag_offsets, tag_columns, tag_counts = _csr(
+            words[firsts[different]], words[seconds[different]], nwords, nwords)
+
+        all_months = table.month_numbers()
+        first_month = int(all_months.min()) if len(all_months) else 0
+        nmonths = int(all_months.max()) - first_month + 1 if len(all_months) else 0
+        month_offsets, month_columns, month_counts = _csr(
+            all_months[photos] - first_month, words, nmonths, nwords)
+
+        return cls(vocabulary=table.vocabulary,
+                   counts=np.bincount(words, minlength=nwords).astype(np.int32),
+                   tag_offsets=tag_offsets, tag_columns=tag_columns, tag_counts=tag_counts,
+                   first_month=first_month, month_offsets=month_offsets,
+                   month_columns=month_columns, month_counts=month_counts,
+                   month_photos=np.bincount(all_months - first_month,
+                                            minlength=nmonths).astype(np.int32))
+
+    def related(self, tag, count=10):
+        """Get the tags most related to a tag.
+
+        tag = a tag; it's normalized like the tag records (see tagrules.py),
+              so a synonym finds its canonical tag
+        count = number of tags to return
+
+        Returns a list of (tag, photos with both tags, cosine score) tuples,
+        best first; empty if the tag isn't in the vocabulary.
+        """
+        normalized = tagrules.default_rules().normalize(tag)
+        tagno = self.tag_numbers.get(normalized[0]) if normalized else None
+        if tagno is None:
+            return []
+        columns, scores, together = self._row_scores(tagno)
+        best = _top(scores, count)
+        return [(self.vocabulary[columns[pos]], int(together[pos]), float(scores[pos]))
+                for pos in best]
+
+    def suggest(self, tags=(), taken=None, count=10, month_weight=0.5, months=1):
+        """Suggest tags for a photo.
+
+        tags = tags the photo already has, normalized like the tag records
+               (tags that aren't in the vocabulary are ignored)
+        taken = optional capture date, 'YYYY', 'YYYY-MM', 'YYYY-MM-DD' or
+                'YYYY-MM-DD HH:MM:SS' (a year covers all of its months)
+        count = number of tags to return
+        month_weight = weight of the capture-date score relative to the
+                       related-tags score
+        months = number of months either side of the capture month to use
+
+        Each tag's score is its mean cosine similarity to the photo's tags,
+        plus month_weight times the fraction of photos taken around the same
+        time that have it. Returns a list of (tag, score) tuples, best first,
+        not including the photo's own tags. Raises ValueError if taken isn't
+        a valid date.
+        """
+        scores = np.zeros(len(self.vocabulary))
+        tagnos = [self.tag_numbers[tag] for tag in tagrules.default_rules().normalize_keywords(tags)
+                  if tag in self.tag_numbers]
+        for tagno in tagnos:
+            columns, row_scores, _ = self._row_scores(tagno)
+            scores[columns] += row_scores / len(tagnos)
+        if taken:
+            first_month, last_month = _months(taken)
+            first = max(first_month - months - self.first_month, 0)
+            last = min(last_month + months + 1 - self.first_month, len(self.month_photos))
+            if first < last:
+                start, end = self.month_offsets[first], self.month_offsets[last]
+                month_scores = np.bincount(self.month_columns[start:end],
+                                           weights=self.month_counts[start:end],
+                                           minlength=len(self.vocabulary))
+                scores += month_weight * month_scores / max(
+                    self.month_photos[first:last].sum(), 1)
+        scores[tagnos] = 0
+        return [(self.vocabulary[tagno], float(scores[tagno])) for tagno in _top(scores, count)]
+
+    def _row_scores(self, tagno):
+        """Get the cosine scores of the tags that appear with a tag.
+
+        Returns (columns, scores, counts) arrays.
+        """
+        start, end = self.tag_offsets[tagno], self.tag_offsets[tagno + 1]
+        columns = self.tag_columns[start:end]
+        together = self.tag_counts[start:end]
+        scores = together / np.sqrt(float(self.counts[tagno]) * self.counts[columns])
+        return (columns, scores, together)
+
+#-------------------------------------------------------------------------------
+def load_matrix(filename=None):
+    """Load the saved co-occurrence matrices, building them first if necessary.
+
+    filename = optional filename; default is cache/cooccur.npz
+
+    The matrices are rebuilt from the photo table if they haven't been
+    saved, or if the table has changed since they were saved.
+    """
+    filename = filename or matrix_filename()
+    table = phototable.load_table() # (rebuilt first if the tag records have changed)
+    if os.path.isfile(filename) and \
+        os.path.getmtime(phototable.table_filename()) <= os.path.getmtime(filename):
+        with np.load(filename) as arrays:
+            columns = {name: arrays[name] for name in arrays.files}
+        columns['vocabulary'] = phototable.split_strings(columns['vocabulary'])
+        return Cooccurrence(**columns)
+    matrix = Cooccurrence.from_table(table)
+    save_matrix(matrix, filename)
+    return matrix
+
+#-------------------------------------------------------------------------------
+def matrix_filename():
+    """Get filename for the saved co-occurrence matrices.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/cooccur.npz')
+
+#-------------------------------------------------------------------------------
+def save_matrix(matrix, filename=None):
+    """Save co-occurrence matrices to disk.
+
+    matrix = Cooccurrence
+    filename = optional filename; default is cache/cooccur.npz
+    """
+    filename = filename or matrix_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename + '.tmp', 'wb') as fhandle:
+        np.savez_compressed(fhandle, vocabulary=phototable.join_strings(matrix.vocabulary),
+                            counts=matrix.counts, tag_offsets=matrix.tag_offsets,
+                            tag_columns=matrix.tag_columns, tag_counts=matrix.tag_counts,
+                            first_month=np.int64(matrix.first_month),
+                            month_offsets=matrix.month_offsets,
+                            month_columns=matrix.month_columns,
+                            month_counts=matrix.month_counts,
+                            month_photos=matrix.month_photos)
+    os.replace(filename + '.tmp', filename)
+
+#-------------------------------------------------------------------------------
+def _csr(rows, columns, nrows, ncolumns):
+    """Count (row, column) pairs into a compressed sparse row matrix.
+
+    rows/columns = int arrays, one entry per pair
+    nrows/ncolumns = shape of the matrix
+
+    Returns (offsets, columns, counts): offsets is an int64 array of nrows + 1
+    row starts, and columns/counts are int32 arrays of the nonzero cells.
+    """
+    cells, counts = np.unique(rows.astype(np.int64) * ncolumns + columns, return_counts=True)
+    offsets = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells // ncolumns, minlength=nrows), out=offsets[1:])
+    return (offsets, (cells % ncolumns).astype(np.int32), counts.astype(np.int32))
+
+#-------------------------------------------------------------------------------
+def _months(taken):
+    """Get the months covered by a capture date.
+
+    taken = 'YYYY', 'YYYY-MM', 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+
+    Returns (first, last) month numbers (months since 1970-01). Raises
+    ValueError if taken isn't a valid date.
+    """
+    match = re.match(r'(\d{4})(?:-(\d{2})(?:-\d{2})?)?(?:$|[ T])', taken)
+    if not match or (match.group(2) and not 1 <= int(match.group(2)) <= 12):
+        raise ValueError('invalid date: {0} (use YYYY, YYYY-MM or YYYY-MM-DD)'.format(taken))
+    year = (int(match.group(1)) - 1970) * 12
+    if match.group(2):
+        return (year + int(match.group(2)) - 1, year + int(match.group(2)) - 1)
+    return (year, year + 11)
+
+#-------------------------------------------------------------------------------
+def _top(scores, count):
+    """Get the positions of the highest positive scores, best first.
+    """
+    if len(scores) > count:
+        candidates = np.argpartition(-scores, count)[:count]
+    else:
+        candidates = np.arange(len(scores))
+    candidates = candidates[scores[candidates] > 0]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Related tags and tag suggestions.')
+    PARSER.add_argument('command', choices=['related', 'suggest', 'untagged'])
+    PARSER.add_argument('tags', nargs='*', help='tag(s)')
+    PARSER.add_argument('--date', help='capture date for suggest, YYYY[-MM[-DD]]')
+    PARSER.add_argument('--count', type=int, default=10, help='number of tags to show')
+    PARSER.add_argument('--max-keywords', type=int, default=1,
+                        help='for untagged: photos with at most this many keywords')
+    PARSER.add_argument('--limit', type=int, default=20,
+                        help='for untagged: number of photos to show')
+    ARGS = PARSER.parse_args()
+
+    MATRIX = load_matrix()
+    START = time.perf_counter()
+    if ARGS.command == 'related':
+        if len(ARGS.tags) != 1:
+            print('ERROR: related needs one tag')
+            sys.exit(1)
+        for TAG, TOGETHER, SCORE in MATRIX.related(ARGS.tags[0], ARGS.count):
+            print('{0:30} {1:6} photos  {2:.3f}'.format(TAG, TOGETHER, SCORE))
+    elif ARGS.command == 'suggest':
+        try:
+            SUGGESTED = MATRIX.suggest(ARGS.tags, ARGS.date, ARGS.count)
+        except ValueError as err:
+            print('ERROR: {0}'.format(err))
+            sys.exit(1)
+        for TAG, SCORE in SUGGESTED:
+            print('{0:30} {1:.3f}'.format(TAG, SCORE))
+    else:
+        TABLE = phototable.load_table()
+        START = time.perf_counter()
+        KEYWORD_COUNTS = np.diff(TABLE.keyword_offsets)
+        for PHOTONO in np.flatnonzero(KEYWORD_COUNTS <= ARGS.max_keywords)[:ARGS.limit]:
+            RECORD = TABLE.record(PHOTONO)
+            SUGGESTED = MATRIX.suggest(RECORD['keywords'], RECORD['taken'], ARGS.count)
+            print('{0} {1} {2} -> {3}'.format(
+                RECORD['taken'], RECORD['photo_url'], RECORD['keywords'],
+                ', '.join(TAG for TAG, _ in SUGGESTED)))
+    print('{0:.1f} ms'.format((time.perf_counter() - START) * 1000))
@@ -0,0 +1,286 @@
+""" exifts.py
+fast header-only reader for EXIF DateTimeOriginal
+
+Reads only the first few KB of a JPEG, TIFF or NEF file and walks the TIFF
+IFD structure directly to tag 0x9003, without building an image object or
+decoding any other EXIF tags. Run this module to benchmark it against the PIL
+approach on the files in testdata/.
+
+The camera model (tag 0x0110 in IFD0) can be read the same way, for
+grouping photos by camera (see clockoffset.py), as can the embedded JPEG
+thumbnail in IFD1, for perceptual hashing (see phash.py).
+"""
+import os
+import struct
+import time
+
+HEADER_SIZE = 4096 # bytes read up front; most files need no other reads
+
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+#-------------------------------------------------------------------------------
+def benchmark(filenames, iterations=100):
+    """Compare exif_timestamp() to pil_timestamp() on a set of files.
+
+    filenames = list of photo files
+    iterations = number of times to read each file
+
+    Prints per-file timings, speedup, and peak memory allocated per call.
+    """
+    import tracemalloc
+
+    results = {}
+    for func in [exif_timestamp, pil_timestamp]:
+        for filename in filenames:
+            assert exif_timestamp(filename) == pil_timestamp(filename)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for filename in filenames:
+                func(filename)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func(filenames[0])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[func.__name__] = (elapsed / (iterations * len(filenames)), peak)
+        print('{0:15} {1:10.1f} usec/file {2:10,} bytes peak'.format(
+            func.__name__, results[func.__name__][0] * 1e6, peak))
+
+    print('speedup: {0:.1f}x'.format(
+        results['pil_timestamp'][0] / results['exif_timestamp'][0]))
+
+#-------------------------------------------------------------------------------
+def exif_model(filename):
+    """Get the EXIF camera model for a photo.
+
+    filename = a JPEG, TIFF or TIFF-based raw (NEF) file
+
+    Returns the model as a string, or None if the file has no Model tag (or
+    isn't a JPEG/TIFF file).
+    """
+    return _read_tiff_value(filename, _tiff_model) or None
+
+#-------------------------------------------------------------------------------
+def exif_thumbnail(filename):
+    """Get the embedded EXIF thumbnail of a photo.
+
+    filename = a JPEG, TIFF or TIFF-based raw (NEF) file
+
+    Returns a tuple (thumbnail, orientation): thumbnail is the JPEG data of
+    the IFD1 thumbnail (None if there isn't one), and orientation is the
+    EXIF Orientation value of the photo (1 = not rotated), which applies to
+    the thumbnail too. Returns (None, 1) if the file isn't a JPEG/TIFF file.
+    """
+    return _read_tiff_value(filename, _tiff_thumbnail) or (None, 1)
+
+#-------------------------------------------------------------------------------
+def exif_timestamp(filename):
+    """Get the EXIF DateTimeOriginal value for a photo.
+
+    filename = a JPEG, TIFF or TIFF-based raw (NEF) file
+
+    Returns the timestamp as a 'YYYY-MM-DD HH:MM:SS' string, or None if the
+    file has no DateTimeOriginal tag (or isn't a JPEG/TIFF file).
+    """
+    value = _read_tiff_value(filename, _tiff_datetime_original)
+    if not value:
+        return None
+    return value.replace(':', '-', 2)
+
+#-------------------------------------------------------------------------------
+def file_timestamp(filename):
+    """Get the capture timestamp for a photo.
+
+    filename = any photo file
+
+    Returns the EXIF DateTimeOriginal if available, otherwise the file's
+    modified time, as a 'YYYY-MM-DD HH:MM:SS' string.
+    """
+    retval = exif_timestamp(filename)
+    if retval is None:
+        unixtime = os.path.getmtime(filename)
+        retval = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(unixtime))
+    return retval
+
+#-------------------------------------------------------------------------------
+def pil_timestamp(filename):
+    """Get DateTimeOriginal using PIL, as filename_ts() originally did.
+
+    Only used for benchmark comparisons.
+    """
+    from PIL import Image
+    from PIL.ExifTags import TAGS
+    retval = None
+    imagefile = Image.open(filename)
+    try:
+        exifdata = imagefile._getexif()
+        for tag, value in exifdata.items():
+            decoded = TAGS.get(tag, tag)
+            if decoded == 'DateTimeOriginal':
+                retval = value.replace(':', '-', 2)
+                break
+    except:
+        pass
+    return retval
+
+#-------------------------------------------------------------------------------
+def _ascii_value(fhandle, header, tiff_start, byteorder, entry):
+    """Get the value of an ASCII IFD entry, as a string.
+    """
+    count = struct.unpack(byteorder + 'L', entry[4:8])[0]
+    if count <= 4:
+        value = entry[8:8 + count]
+    else:
+        value_offset = struct.unpack(byteorder + 'L', entry[8:12])[0]
+        value = _read_at(fhandle, header, tiff_start + value_offset, count)
+    return value.split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+
+#-------------------------------------------------------------------------------
+def _ifd_entry(fhandle, header, tiff_start, byteorder, ifd_offset, tag):
+    """Find a tag in an IFD.
+
+    Returns the raw 12-byte IFD entry, or None if the tag isn't present.
+    """
+    start = tiff_start + ifd_offset
+    count = struct.unpack(byteorder + 'H', _read_at(fhandle, header, start, 2))[0]
+    entries = _read_at(fhandle, header, start + 2, count * 12)
+    for pos in range(0, len(entries) - 11, 12):
+        entry_tag = struct.unpack(byteorder + 'H', entries[pos:pos + 2])[0]
+        if entry_tag == tag:
+            return entries[pos:pos + 12]
+    return None
+
+#-------------------------------------------------------------------------------
+def _jpeg_exif_offset(fhandle, header):
+    """Find the start of the TIFF structure inside a JPEG's APP1 segment.
+
+    Returns the file offset, or None if the JPEG has no EXIF segment.
+    """
+    offset = 2 # skip SOI marker
+    while True:
+        segment = _read_at(fhandle, header, offset, 4)
+        if len(segment) < 4 or segment[0] != 0xff:
+            return None
+        marker = segment[1]
+        if marker in (0xda, 0xd9): # start of scan/end of image: no EXIF
+            return None
+        length = struct.unpack('>H', segment[2:4])[0]
+        if marker == 0xe1 and _read_at(fhandle, header, offset + 4, 6) == b'Exif\x00\x00':
+            return offset + 10
+        offset += 2 + length
+
+#-------------------------------------------------------------------------------
+def _read_at(fhandle, header, offset, size):
+    """Read bytes at a file offset, from the header buffer if possible.
+    """
+    if offset + size <= len(header):
+        return header[offset:offset + size]
+    fhandle.seek(offset)
+    return fhandle.read(size)
+
+#-------------------------------------------------------------------------------
+def _read_tiff_value(filename, reader):
+    """Locate the TIFF structure in a file's header, and read a value from it.
+
+    filename = a JPEG, TIFF or TIFF-based raw (NEF) file
+    reader = function(fhandle, header, tiff_start) that returns the value
+
+    Returns the value, or None if the file isn't a JPEG/TIFF file or its EXIF
+    data is truncated or corrupt.
+    """
+    with open(filename, 'rb') as fhandle:
+        header = fhandle.read(HEADER_SIZE)
+        try:
+            if header[:2] == b'\xff\xd8':
+                tiff_start = _jpeg_exif_offset(fhandle, header)
+                if tiff_start is None:
+                    return None
+            elif header[:4] in (b'II*\x00', b'MM\x00*'):
+                tiff_start = 0
+            else:
+                return None
+            return reader(fhandle, header, tiff_start)
+        except (struct.error, ValueError):
+            return None # truncated or corrupt EXIF data
+
+#-------------------------------------------------------------------------------
+def _tiff_datetime_original(fhandle, header, tiff_start):
+    """Walk IFD0 to the Exif IFD and return the DateTimeOriginal string.
+
+    fhandle = open file
+    header = bytes already read from the start of the file
+    tiff_start = file offset of the TIFF header (offsets are relative to it)
+    """
+    byteorder = '<' if _read_at(fhandle, header, tiff_start, 2) == b'II' else '>'
+    ifd_offset = struct.unpack(byteorder + 'L',
+                               _read_at(fhandle, header, tiff_start + 4, 4))[0]
+
+    exif_ifd = _ifd_entry(fhandle, header, tiff_start, byteorder, ifd_offset, TAG_EXIF_IFD)
+    if exif_ifd is None:
+        return None
+    entry = _ifd_entry(fhandle, header, tiff_start, byteorder,
+                       struct.unpack(byteorder + 'L', exif_ifd[8:12])[0],
+                       TAG_DATETIME_ORIGINAL)
+    if entry is None:
+        return None
+
+    return _ascii_value(fhandle, header, tiff_start, byteorder, entry)
+
+#-------------------------------------------------------------------------------
+def _tiff_model(fhandle, header, tiff_start):
+    """Find the Model tag in IFD0 and return its value.
+
+    fhandle/header/tiff_start = see _tiff_datetime_original()
+    """
+    byteorder = '<' if _read_at(fhandle, header, tiff_start, 2) == b'II' else '>'
+    ifd_offset = struct.unpack(byteorder + 'L',
+                               _read_at(fhandle, header, tiff_start + 4, 4))[0]
+    entry = _ifd_entry(fhandle, header, tiff_start, byteorder, ifd_offset, TAG_MODEL)
+    if entry is None:
+        return None
+    return _ascii_value(fhandle, header, tiff_start, byteorder, entry)
+
+#-------------------------------------------------------------------------------
+def _tiff_thumbnail(fhandle, header, tiff_start):
+    """Find the IFD1 thumbnail and the IFD0 Orientation tag.
+
+    fhandle/header/tiff_start = see _tiff_datetime_original()
+
+    Returns a tuple (thumbnail, orientation), as for exif_thumbnail().
+    """
+    byteorder = '<' if _read_at(fhandle, header, tiff_start, 2) == b'II' else '>'
+    ifd_offset = struct.unpack(byteorder + 'L',
+                               _read_at(fhandle, header, tiff_start + 4, 4))[0]
+    entry = _ifd_entry(fhandle, header, tiff_start, byteorder, ifd_offset, TAG_ORIENTATION)
+    orientation = struct.unpack(byteorder + 'H', entry[8:10])[0] if entry else 1
+
+    # the offset of IFD1 follows the last entry of IFD0
+    count = struct.unpack(byteorder + 'H',
+                          _read_at(fhandle, header, tiff_start + ifd_offset, 2))[0]
+    ifd1_offset = struct.unpack(byteorder + 'L', _read_at(
+        fhandle, header, tiff_start + ifd_offset + 2 + count * 12, 4))[0]
+    if not ifd1_offset:
+        return (None, orientation)
+    offset_entry = _ifd_entry(fhandle, header, tiff_start, byteorder, ifd1_offset,
+                              TAG_THUMBNAIL_OFFSET)
+    length_entry = _ifd_entry(fhandle, header, tiff_start, byteorder, ifd1_offset,
+                              TAG_THUMBNAIL_LENGTH)
+    if offset_entry is None or length_entry is None:
+        return (None, orientation)
+    offset = struct.unpack(byteorder + 'L', offset_entry[8:12])[0]
+    length = struct.unpack(byteorder + 'L', length_entry[8:12])[0]
+    thumbnail = _read_at(fhandle, header, tiff_start + offset, length)
+    if len(thumbnail) != length or thumbnail[:2] != b'\xff\xd8':
+        return (None, orientation)
+    return (thumbnail, orientation)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import glob
+    SOURCE_FOLDER = os.path.dirname(os.path.realpath(__file__))
+    benchmark(sorted(glob.glob(os.path.join(SOURCE_FOLDER, 'testdata', '*.jpg'))))
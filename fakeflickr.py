@@ -0,0 +1,177 @@
+""" fakeflickr.py
+local stand-in for the Flickr REST API, for testing the harvesting code
+
+Serves synthetic photostreams for any user ID, in the same JSON format as
+the real API (format=json&nojsoncallback=1). Supported methods:
+flickr.people.getPhotos, flickr.photos.getInfo
+
+Usage: python fakeflickr.py [--port 8000] [--photos 250] [--users a,b]
+                            [--error-rate 0.0]
+Then pass endpoint='http://localhost:8000/services/rest/' to the harvester.
+"""
+import argparse
+import http.server
+import json
+import random
+import threading
+import urllib.parse
+
+import tsindex
+
+#-------------------------------------------------------------------------------
+class _settings:
+    photos_per_user = 250 # number of photos in each synthetic photostream
+    users = dict() # user_id -> list of photos (dictionaries), newest first
+    photos_by_id = dict() # photo ID -> photo (dictionary)
+    lock = threading.Lock()
+    calls = 0 # total API calls served
+    connections = 0 # total connections accepted
+    error_rate = 0.0 # fraction of calls answered with HTTP 503, to test retries
+
+#-------------------------------------------------------------------------------
+class FakeFlickrHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler that answers Flickr REST API calls.
+    """
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real API
+
+    def setup(self):
+        """Count connections, to verify that clients reuse them.
+        """
+        super().setup()
+        with _settings.lock:
+            _settings.connections += 1
+
+    def do_GET(self):
+        """Handle a GET request to /services/rest/.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        params = {key: values[0] for key, values in query.items()}
+        with _settings.lock:
+            _settings.calls += 1
+        if random.random() < _settings.error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        method = params.get('method')
+        if method == 'flickr.people.getPhotos':
+            payload = get_photos(params)
+        elif method == 'flickr.photos.getInfo':
+            payload = get_info(params)
+        else:
+            payload = {'stat': 'fail', 'code': 112,
+                       'message': 'Method "{0}" not found'.format(method)}
+
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=W0622
+        """Don't log each request to the console.
+        """
+        pass
+
+#-------------------------------------------------------------------------------
+def get_info(params):
+    """Handle the flickr.photos.getInfo method.
+    """
+    photo = _settings.photos_by_id.get(params.get('photo_id', ''))
+    if not photo:
+        return {'stat': 'fail', 'code': 1, 'message': 'Photo not found'}
+
+    return {'stat': 'ok',
+            'photo': {'id': photo['id'], 'secret': 'abc123', 'server': '1234', 'farm': 1,
+                      'title': {'_content': photo['title']},
+                      'dates': {'taken': photo['taken'],
+                                'posted': str(photo['posted'])},
+                      'tags': {'tag': [{'raw': tag, '_content': tag.replace(' ', '')}
+                                       for tag in photo['tags']]}}}
+
+#-------------------------------------------------------------------------------
+def get_photos(params):
+    """Handle the flickr.people.getPhotos method.
+    """
+    photos = user_photos(params.get('user_id', ''))
+    if 'min_upload_date' in params:
+        photos = [photo for photo in photos
+                  if photo['posted'] >= int(params['min_upload_date'])]
+    per_page = min(int(params.get('per_page', 100)), 500)
+    page = int(params.get('page', 1))
+    pages = max((len(photos) + per_page - 1) // per_page, 1)
+
+    extras = params.get('extras', '').split(',')
+
+    photolist = []
+    for photo in photos[(page - 1) * per_page:page * per_page]:
+        entry = {'id': photo['id'], 'owner': photo['owner'],
+                 'secret': 'abc123', 'server': '1234', 'farm': 1,
+                 'title': photo['title'], 'ispublic': 1,
+                 'isfriend': 0, 'isfamily': 0}
+        if 'date_upload' in extras:
+            entry['dateupload'] = str(photo['posted'])
+        if 'date_taken' in extras:
+            entry['datetaken'] = photo['taken']
+            entry['datetakengranularity'] = '0'
+        if 'tags' in extras:
+            entry['tags'] = ' '.join(tag.replace(' ', '').lower() for tag in photo['tags'])
+        photolist.append(entry)
+
+    return {'stat': 'ok',
+            'photos': {'page': page, 'pages': pages, 'perpage': per_page,
+                       'total': str(len(photos)), 'photo': photolist}}
+
+#-------------------------------------------------------------------------------
+def user_photos(user_id):
+    """Get the synthetic photostream for a user, generating it if needed.
+
+    Returns a list of photos (dictionaries), newest first.
+    """
+    with _settings.lock:
+        if user_id not in _settings.users:
+            rand = random.Random(user_id)
+            vocabulary = ['dog', 'alice', 'seattle', 'beach', 'road trip', 'sunset',
+                          'mountains', 'Golden Gate', 'family', 'snow', 'park', 'cat']
+            photos = []
+            first_id = rand.randint(1000, 9999) * 10**7
+            posted = 1220000000
+            for photo_no in range(_settings.photos_per_user):
+                posted += rand.randint(60, 86400)
+                taken = posted - rand.randint(0, 30 * 86400)
+                photos.append({'id': str(first_id + photo_no),
+                               'owner': user_id,
+                               'title': 'Photo {0}'.format(photo_no + 1),
+                               'taken': tsindex.epoch_to_ts(taken),
+                               'posted': posted,
+                               'tags': rand.sample(vocabulary, rand.randint(0, 4))})
+            photos.reverse()
+            for photo in photos:
+                _settings.photos_by_id[photo['id']] = photo
+            _settings.users[user_id] = photos
+        return _settings.users[user_id]
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Local stand-in for the Flickr API.')
+    PARSER.add_argument('--port', type=int, default=8000)
+    PARSER.add_argument('--photos', type=int, default=250,
+                        help='number of photos per user')
+    PARSER.add_argument('--users', default='dogerino,dougerino',
+                        help='comma-separated user IDs to generate at startup')
+    PARSER.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of calls that fail with HTTP 503')
+    ARGS = PARSER.parse_args()
+
+    _settings.photos_per_user = ARGS.photos
+    _settings.error_rate = ARGS.error_rate
+    for USER_ID in ARGS.users.split(','):
+        user_photos(USER_ID)
+    SERVER = http.server.ThreadingHTTPServer(('localhost', ARGS.port), FakeFlickrHandler)
+    print('Flickr stand-in listening on http://localhost:{0}/services/rest/'.format(ARGS.port))
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,163 @@
+""" flickrclient.py
+pooled Flickr API client with retries and memoized credentials
+
+All Flickr REST API calls go through a FlickrClient, which keeps a pooled
+keep-alive session (so each call is a single HTTP round trip on an open
+connection), reads the API key once, retries with exponential backoff on
+connection errors, 5xx responses and rate limiting (HTTP 429), and raises
+FlickrError for 'stat: fail' payloads instead of returning them. Responses
+can be answered from, and saved to, an on-disk cache (see respcache.py).
+"""
+import configparser
+import functools
+import json
+import os
+import time
+
+import metrics
+import respcache
+
+API_ENDPOINT = 'https://api.flickr.com/services/rest/'
+DEFAULT_APP = 'dougerino-jamiesearcher'
+
+#-------------------------------------------------------------------------------
+class FlickrError(Exception):
+    """A Flickr API call returned 'stat: fail'.
+
+    code = Flickr error code
+    message = Flickr error message
+    """
+    def __init__(self, method, code, message):
+        super().__init__('{0} failed - {1} (code {2})'.format(method, message, code))
+        self.code = code
+        self.message = message
+
+#-------------------------------------------------------------------------------
+class FlickrClient:
+    """Flickr REST API client.
+
+    app = section of ../_private/flickr.ini that contains the API key
+    endpoint = URL of the Flickr REST API
+    limiter = optional rate limiter, with an acquire() method that waits
+              until a call can be made (e.g., harvest.TokenBucket)
+    pool_size = maximum number of connections kept open, which should be at
+                least the number of threads making calls
+    retries = number of times to retry a call that can be retried
+    backoff = seconds to wait before the first retry; doubles each time
+    timeout = seconds to wait for a response
+    cache = optional respcache.ResponseCache; cached responses are returned
+            without an API call, and new responses are added to it
+    """
+    def __init__(self, app=DEFAULT_APP, *, endpoint=None, limiter=None, pool_size=10,
+                 retries=5, backoff=1.0, timeout=60, cache=None):
+        import requests # only loaded when API calls are made (slow to import)
+        self.api_key = get_apikey(app)
+        self.cache = cache
+        self.endpoint = endpoint or API_ENDPOINT
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def call(self, method, **params):
+        """Call a Flickr API method.
+
+        method = API method, e.g. 'flickr.photos.getInfo'
+        params = method-specific parameters
+
+        Returns the JSON payload as a dictionary. Raises FlickrError if
+        Flickr returns 'stat: fail', requests.RequestException if the call
+        still fails after all retries, or respcache.NotCached if the cache is
+        in offline mode and doesn't have the response.
+        """
+        if self.cache:
+            payload = self.cache.get(method, params, self._cache_endpoint())
+            if payload is not None:
+                return payload
+
+        import requests
+        querystring = dict(params, method=method, api_key=self.api_key,
+                           format='json', nojsoncallback=1)
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                with metrics.timer('api_call'):
+                    response = self.session.get(self.endpoint, params=querystring,
+                                                timeout=self.timeout)
+                metrics.api_call(method, len(response.content))
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                payload = json.loads(response.text)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as err:
+                if attempt >= self.retries:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                if getattr(err.response, 'headers', None) and \
+                    err.response.headers.get('Retry-After', '').isdigit():
+                    wait = max(wait, int(err.response.headers['Retry-After']))
+                # (the exception text includes the URL, and therefore the API key)
+                reason = 'HTTP {0}'.format(err.response.status_code) \
+                    if isinstance(err, requests.HTTPError) else type(err).__name__
+                print('retrying {0} in {1:.0f} seconds - {2}'.format(method, wait, reason))
+                metrics.count('api.retries')
+                time.sleep(wait)
+                attempt += 1
+                continue
+            if payload.get('stat') == 'fail':
+                raise FlickrError(method, payload.get('code'), payload.get('message'))
+            if self.cache:
+                self.cache.put(method, params, payload, self._cache_endpoint())
+            return payload
+
+    def close(self):
+        """Close the session's pooled connections.
+        """
+        self.session.close()
+
+    def _cache_endpoint(self):
+        """Get the endpoint that identifies this client's cached responses
+        (None for the real API).
+        """
+        return None if self.endpoint == API_ENDPOINT else self.endpoint
+
+#-------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def default_client(app=DEFAULT_APP):
+    """Get the shared client for an application.
+
+    app = section of ../_private/flickr.ini that contains the API key
+
+    Returns a FlickrClient, created on the first call for each app, that
+    uses API_ENDPOINT and the shared response cache.
+    """
+    return FlickrClient(app, cache=respcache.default_cache())
+
+#-------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def get_apikey(app):
+    """Get Flickr API key for specified application.
+
+    app = identifier for a section in the ../_private/flickr.ini file where
+          API keys are stored
+
+    Returns the API key. Prints an error to the console if not found. The
+    file is only read once per app.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    datafile = os.path.join(source_folder, '../_private/flickr.ini')
+
+    config = configparser.ConfigParser()
+    config.read(datafile)
+    try:
+        retval = config.get(app, 'api_key')
+    except configparser.NoSectionError:
+        print('ERROR: could not find api_key for ' + app + '!')
+        retval = None
+
+    return retval
@@ -1,18 +1,96 @@
 """ flickrtags.py
 harvest Flickr tags and write to *-keyword.txt files
 
+Writing the keywords of matched photos is done by writeback.py.
+
 Flickr API documentation: https://www.flickr.com/services/api/
 """
-from collections import Counter
-import configparser
+import contextlib
 import datetime
 import glob
+import itertools
 import json
 import os
 import sys
 import time
 
-import requests
+import flickrclient
+import metacache
+import metrics
+import respcache
+import rollups
+import tagrules
+import tagstore
+import tsindex
+
+PHOTO_HOME = 'd:\\doug\\photos' #/// get from phototag config settings
+USERS = ['dogerino', 'dougerino'] # Flickr accounts whose data is harvested
+
+#-------------------------------------------------------------------------------
+class _settings:
+    store_batch = None # photo ID -> tag record, waiting to be merged into the store
+    store_lock = None # function that returns a context manager held while merging
+    flush_every = 5000 # number of batched records that triggers a merge
+
+#-------------------------------------------------------------------------------
+@contextlib.contextmanager
+def batched_store(flush_every=5000, lock=None):
+    """Batch the tag store updates made by write_cache().
+
+    flush_every = number of records to collect before merging them into the
+                  store
+    lock = optional function that returns a context manager to hold while
+           the store and rollups are updated, when several processes write
+           them (e.g. workqueue.WorkQueue.locked)
+
+    Merging into the store rewrites the whole file (see tagstore.py), so
+    merging every page as it's written makes a full harvest O(pages x store).
+    Inside this context, the tags pages are still written right away, but
+    their records are merged into the store (and the rollups updated) once
+    per flush_every records and on exit. If the process is killed before
+    then, python tagstore.py migrate rebuilds the store from the pages.
+    """
+    if _settings.store_batch is not None:
+        yield # already batching
+        return
+    _settings.store_batch = dict()
+    _settings.store_lock = lock
+    _settings.flush_every = flush_every
+    try:
+        yield
+    finally:
+        try:
+            _flush_store()
+        finally:
+            _settings.store_batch = None
+            _settings.store_lock = None
+
+#-------------------------------------------------------------------------------
+def bulk_tag_record(user_id, photo, raw_tags=False):
+    """Create the tag data record for a photo retrieved with extras.
+
+    user_id = Flickr user ID
+    photo = the JSON representation of a photo as returned by the
+            people.getPhotos API call with extras=date_taken,tags
+    raw_tags = whether to call photo_detail() to get raw tags, if the photo
+               has tags
+
+    By default the keywords are the tags extra, which has Flickr's
+    normalized form of each tag ('roadtrip' for a photo tagged 'road trip'),
+    and no API call is made. With raw_tags, they're the raw tags, as
+    cache_tags() stores them, at the cost of a photos.getInfo call for each
+    photo that has tags.
+
+    Returns a dictionary, in the same format as tag_record().
+    """
+    if raw_tags and photo['tags']:
+        photo_info = photo_detail(photo)
+    else:
+        # same structure as photos.getInfo output, for the fields we use
+        photo_info = {'photo': {'dates': {'taken': photo['datetaken']},
+                                'tags': {'tag': [{'raw': tag} for tag
+                                                 in photo['tags'].split()]}}}
+    return tag_record(user_id, photo, photo_info)
 
 #-------------------------------------------------------------------------------
 def cache_filename(*, user_id, pageno, datatype):
@@ -29,42 +107,58 @@ def cache_filename(*, user_id, pageno, datatype):
     return os.path.join(source_folder, 'cache/' + filename)
 
 #-------------------------------------------------------------------------------
-def cache_photostream(user_id):
+@metrics.timed('cache_photostream')
+def cache_photostream(user_id, bulk=False, raw_tags=False):
     """Retrieve a user's list of photos and save locally.
 
     user_id = the Flickr user whose photos will be listed
+    bulk = whether to also get the tag data in the same API calls, using
+           the date_taken and tags extras, 500 photos per page
+    raw_tags = in bulk mode, whether to call photo_detail() for photos that
+               have tags, to get the raw tags (as typed, with spaces) instead
+               of the normalized tags returned by the tags extra
 
     Files are written to the cache subfolder, one per page of API results.
+    In bulk mode, the <user>-tags-pageXXX.json files are written as well (in
+    the same format as cache_tags()), so cache_tags() doesn't need to be run.
     """
-    per_page = '100'
-    api_key = get_apikey('dougerino-jamiesearcher')
-
-    endpoint = 'https://api.flickr.com/services/rest/' + \
-        '?method=flickr.people.getPhotos' + \
-        '&api_key=' + api_key + \
-        '&user_id=' + user_id + \
-        '&per_page=' + per_page + '&format=json&nojsoncallback=1'
-
-    response = requests.get(endpoint)
-    jsondata = json.loads(response.text)
-    write_cache(user_id=user_id, pageno=1, datatype='photostream', jsondata=jsondata)
-
-    tot_pages = jsondata['photos']['pages']
-    for pageno in range(2, tot_pages + 1):
-        endpoint = 'https://api.flickr.com/services/rest/' + \
-            '?method=flickr.people.getPhotos' + \
-            '&api_key=' + api_key + \
-            '&user_id=' + user_id + \
-            '&per_page=' + per_page + \
-            '&page=' + str(pageno) + \
-            '&format=json&nojsoncallback=1'
-
-        response = requests.get(endpoint)
-        jsondata = json.loads(response.text)
-
-        write_cache(user_id=user_id, pageno=pageno, datatype='photostream', jsondata=jsondata)
-        #if pageno >= 3:
-        #    break
+    client = flickrclient.default_client()
+    params = {'user_id': user_id, 'per_page': '500' if bulk else '100'}
+    if bulk:
+        params['extras'] = 'date_taken,tags'
+
+    with batched_store():
+        jsondata = client.call('flickr.people.getPhotos', **params)
+        write_cache(user_id=user_id, pageno=1, datatype='photostream', jsondata=jsondata)
+        if bulk:
+            cache_tags_bulk(user_id=user_id, pageno=1, jsondata=jsondata, raw_tags=raw_tags)
+
+        tot_pages = jsondata['photos']['pages']
+        for pageno in range(2, tot_pages + 1):
+            jsondata = client.call('flickr.people.getPhotos', page=str(pageno), **params)
+
+            write_cache(user_id=user_id, pageno=pageno, datatype='photostream',
+                        jsondata=jsondata)
+            if bulk:
+                cache_tags_bulk(user_id=user_id, pageno=pageno, jsondata=jsondata,
+                                raw_tags=raw_tags)
+            #if pageno >= 3:
+            #    break
+
+    if bulk:
+        # remove any pages left over from a harvest with 100 photos per page,
+        # so that they don't get read as duplicate data
+        for datatype in ['photostream', 'tags']:
+            pageno = tot_pages + 1
+            while os.path.isfile(cache_filename(user_id=user_id, pageno=pageno,
+                                                datatype=datatype)):
+                filename = cache_filename(user_id=user_id, pageno=pageno, datatype=datatype)
+                print('--> removing ' + filename)
+                if datatype == 'tags' and not tagstore.store_exists():
+                    with open(filename, 'r') as fhandle:
+                        rollups.update_rollups([], json.loads(fhandle.read()))
+                os.remove(filename)
+                pageno += 1
 
 #-------------------------------------------------------------------------------
 def cache_tags(*, user_id, pageno):
@@ -88,26 +182,7 @@ def cache_tags(*, user_id, pageno):
     photo_limit = None # set this to a small number for quick testing of a few photos
     for photo in photolist:
         photo_info = photo_detail(photo)
-
-        photo_url = 'http://flickr.com/photos/' + user_id + '/' + photo['id']
-        taken = photo_info['photo']['dates']['taken']
-        title = photo['title'].strip().lower()
-
-        keywords = [tag['raw'].strip().lower() for tag in photo_info['photo']['tags']['tag']]
-        keywords.append('flickr-' + user_id)
-
-        taglist = ','.join(sorted(keywords))
-
-        try:
-            print(photo_url + ' - ' + taken + ' - ' + title + ' - ' + taglist)
-        except UnicodeEncodeError as e:
-            print('*** UnicodeEncodeError ***')
-
-        master_list.append({'user_id': user_id,
-                            'title': title,
-                            'taken': taken,
-                            'keywords': keywords,
-                            'photo_url': photo_url})
+        master_list.append(tag_record(user_id, photo, photo_info))
 
         if photo_limit:
             photo_limit -= 1
@@ -117,6 +192,26 @@ def cache_tags(*, user_id, pageno):
     write_cache(user_id=user_id, pageno=pageno, datatype='tags', jsondata=master_list)
 
 #-------------------------------------------------------------------------------
+def cache_tags_bulk(*, user_id, pageno, jsondata, raw_tags=False):
+    """Write the tag data for a page of photostream retrieved in bulk mode.
+
+    user_id = Flickr user ID
+    pageno = page # of results
+    jsondata = the JSON output of a people.getPhotos API call that included
+               extras=date_taken,tags
+    raw_tags = whether to call photo_detail() to get raw tags for photos
+               that have tags (photos with no tags never need the call)
+
+    Writes the same <user>-tags-pageXXX.json file as cache_tags(), without
+    making an API call per photo.
+    """
+    master_list = [bulk_tag_record(user_id, photo, raw_tags)
+                   for photo in jsondata['photos']['photo']]
+
+    write_cache(user_id=user_id, pageno=pageno, datatype='tags', jsondata=master_list)
+
+#-------------------------------------------------------------------------------
+@metrics.timed('filename_ts')
 def filename_ts(filename=None):
     """Return timestamp as a string.
 
@@ -128,118 +223,60 @@ def filename_ts(filename=None):
     if not filename:
         return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
 
-    return_val = None
-
-    unixtime = os.path.getmtime(filename)
-    retval = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(unixtime))
-
-    # attempt to read EXIF data to get DateTimeOriginal 
-    from PIL import Image
-    from PIL.ExifTags import TAGS
-    imagefile = Image.open(filename)
-    try:
-        exifdata = imagefile._getexif()
-        for tag, value in exifdata.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == 'DateTimeOriginal':
-                retval = value.replace(':', '-', 2)
-                break
-    except:
-        pass
-
-    return retval
+    return metacache.file_timestamp(filename)
 
 #-------------------------------------------------------------------------------
-def generate_stats():
+@metrics.timed('generate_stats')
+def generate_stats(users=None, start='2004-10', end='2016-08'):
     """Generate statistics from cached Flickr tag data.
+
+    users = list of user IDs whose data is cached
+    start/end = range of months for the year/month totals, 'YYYY-MM'
+
+    The statistics come from the per-user/per-month rollups (see rollups.py).
+    Rollups for users that haven't been summarized yet are built in a single
+    streaming pass over their tag records, then saved for next time.
     """
     #/// create a CSV showing # photos and tags per photo, summarized by month since August 2008
 
-    users = ['dogerino', 'dougerino'] # list of user IDs whose data is cached
-    keywords = [] # master list of tags
+    users = users or USERS
 
-    # Generate year/month totals for photos uploaded to dogerino and dougerino, so
-    # that we can do a stacked bar chart showing the migration from 100% dougerino to
-    # mostly dogerino we're interested in Oct 2004 through August 2016 ...
-    ymtotals = dict()
-    for year in range(2004, 2017):
-        for month in range(1, 13):
-            if (year == 2004 and month < 10) or (year == 2016 and month > 8):
-                continue
-            yearmonth = str(year) + '-' + str(month).zfill(2)
-            for user_id in users:
-                ymtotals[yearmonth + '-' + user_id + '-keywords'] = 0
-                ymtotals[yearmonth + '-' + user_id + '-photos'] = 0
+    ymtotals = rollups.load_rollups() or dict()
+    missing = [user_id for user_id in users if user_id not in ymtotals]
+    if missing:
+        for user_id in missing:
+            ymtotals[user_id] = dict()
+        rollups.apply_records(ymtotals, itertools.chain.from_iterable(
+            tag_records(user_id) for user_id in missing))
+        rollups.save_rollups(ymtotals)
 
+    # print photo/tag totals for each user ID
+    summary = rollups.summarize(ymtotals, users)
     for user_id in users:
-        tot_photos = 0
-        tot_tags = 0
-        for filename in glob.glob('cache/' + user_id + '-tags-*.json'):
-            with open(filename, 'r') as fhandle:
-                jsondata = json.loads(fhandle.read())
-                for photo in jsondata:
-                    # increment totals
-                    tot_photos += 1
-                    ymdictkey = photo['taken'][:7] + '-' + user_id + '-photos'
-                    if ymdictkey in ymtotals:
-                        ymtotals[ymdictkey] += 1
-                    tot_tags += len(photo['keywords']) - 1 # -1 because of 'flickr-userid' tag
-                    # add keywords to master list of tags
-                    ymdictkey = photo['taken'][:7] + '-' + user_id + '-keywords'
-                    for keyword in photo['keywords']:
-                        # don't include auto-generated tags (flickr-dogerino/flickr-dougerino)
-                        if not keyword.lower().startswith('flickr-'):
-                            keywords.append(keyword)
-                            if ymdictkey in ymtotals:
-                                ymtotals[ymdictkey] += 1
-
-        # print photo/tag totals for this user ID
-        print('{0} = {1} photos, {2} tags total'.format(user_id, tot_photos, tot_tags))
+        print('{0} = {1} photos, {2} tags total'.format(
+            user_id, summary['photos'][user_id], summary['tags'][user_id]))
 
     # print most common tags
-    tagtotals = Counter(keywords)
+    tagtotals = summary['tagcounts']
     print('Total unique tags across ' + '/'.join(users) + ': {}'.format(len(tagtotals)))
     for tag, cnt in tagtotals.most_common(20):
         print(tag, cnt)
 
-    # print year/month totals (in CSV format)
+    # Print year/month totals (in CSV format) for photos uploaded to each user, so
+    # that we can do a stacked bar chart showing the migration from 100% dougerino to
+    # mostly dogerino; by default we're interested in Oct 2004 through August 2016 ...
     columns = ['yearmonth']
     for user_id in users:
         columns.append(user_id + '-photos')
         columns.append(user_id + '-keywords')
     print(','.join(columns))
-    for year in range(2004, 2017):
-        for month in range(1, 13):
-            if (year == 2004 and month < 10) or (year == 2016 and month > 8):
-                continue
-            yearmonth = str(year) + '-' + str(month).zfill(2)
-            values = [yearmonth]
-            for user_id in users:
-                values.append(str(ymtotals[yearmonth + '-' + user_id + '-photos']))
-                values.append(str(ymtotals[yearmonth + '-' + user_id + '-keywords']))
-            print(','.join(values))
-
-#-------------------------------------------------------------------------------
-def get_apikey(app):
-    """Get Flickr API key for specified application.
-
-    app = identifier for a section in the ../_private/flickr.ini file where
-          API keys are stored
-
-    Returns the API key. Prints an error to the console if not found.
-    """
-    source_folder = os.path.dirname(os.path.realpath(__file__))
-    datafile = os.path.join(source_folder, '../_private/flickr.ini')
-
-    config = configparser.ConfigParser()
-    config.read(datafile)
-    try:
-        retval = config.get(app, 'api_key')
-    except configparser.NoSectionError:
-        print('ERROR: could not find api_key for ' + app + '!')
-        retval = None
-
-    return retval
+    for yearmonth in rollups.month_range(start, end):
+        values = [yearmonth]
+        for user_id in users:
+            totals = ymtotals[user_id].get(yearmonth, dict())
+            values.append(str(totals.get('photos', 0)))
+            values.append(str(totals.get('keywords', 0)))
+        print(','.join(values))
 
 #-------------------------------------------------------------------------------
 def get_tags_example(user_id):
@@ -263,6 +300,7 @@ def get_tags_example(user_id):
         print(photo_url + ' - ' + taken + ' - ' + title + ' - ' + taglist)
 
 #-------------------------------------------------------------------------------
+@metrics.timed('photo_detail')
 def photo_detail(photo):
     """Get detailed information for a photo.
 
@@ -270,34 +308,52 @@ def photo_detail(photo):
             people.getPhotos API call.
 
     Returns the JSON output of the photos.getInfo API call for this photo.
+    Raises flickrclient.FlickrError if the call fails.
     """
-    photo_id = photo['id']
-    api_key = get_apikey('dougerino-jamiesearcher')
-
-    endpoint = 'https://api.flickr.com/services/rest/' + \
-        '?method=flickr.photos.getInfo' + \
-        '&api_key=' + api_key + \
-        '&photo_id=' + photo_id + \
-        '&format=json&nojsoncallback=1'
-
-    response = requests.get(endpoint)
-    return json.loads(response.text)
+    return flickrclient.default_client().call('flickr.photos.getInfo', photo_id=photo['id'])
 
 #-------------------------------------------------------------------------------
 def photostream(user_id):
     """Returns the list of photos for specified user.
     """
     per_page = '10' # max=500 for production use later; need to handle pagination
-    api_key = get_apikey('dougerino-jamiesearcher')
+    return flickrclient.default_client().call('flickr.people.getPhotos',
+                                              user_id=user_id, per_page=per_page)
 
-    endpoint = 'https://api.flickr.com/services/rest/' + \
-        '?method=flickr.people.getPhotos' + \
-        '&api_key=' + api_key + \
-        '&user_id=' + user_id + \
-        '&per_page=' + per_page + '&format=json&nojsoncallback=1'
+#-------------------------------------------------------------------------------
+def rebuild_tags(user_id, raw_tags=False):
+    """Rewrite a user's tags pages from cached data, without any API calls.
 
-    response = requests.get(endpoint)
-    return json.loads(response.text)
+    user_id = Flickr user ID
+    raw_tags = for pages harvested in bulk mode, whether to use raw tags from
+               the cached photos.getInfo responses (see cache_photostream)
+
+    Each cached photostream page is converted to a tags page again, using
+    the current tag_record(). Pages harvested in bulk mode already have the
+    tag data; for other pages, the photos.getInfo responses come from the
+    response cache (see respcache.py), in offline mode. Raises
+    respcache.NotCached if a response isn't in the cache.
+    """
+    cache = respcache.default_cache()
+    offline = cache.offline
+    cache.offline = True
+    try:
+        with batched_store():
+            pageno = 1
+            while os.path.isfile(cache_filename(user_id=user_id, pageno=pageno,
+                                                datatype='photostream')):
+                filename = cache_filename(user_id=user_id, pageno=pageno, datatype='photostream')
+                with open(filename, 'r') as fhandle:
+                    jsondata = json.loads(fhandle.read())
+                photolist = jsondata['photos']['photo']
+                if photolist and 'datetaken' in photolist[0]:
+                    cache_tags_bulk(user_id=user_id, pageno=pageno, jsondata=jsondata,
+                                    raw_tags=raw_tags)
+                else:
+                    cache_tags(user_id=user_id, pageno=pageno)
+                pageno += 1
+    finally:
+        cache.offline = offline
 
 #-------------------------------------------------------------------------------
 def seconds_delta(timestamp1, timestamp2):
@@ -325,16 +381,166 @@ def str_to_datetime(timestamp):
     return datetime.datetime(year, month, day, hours, minutes, seconds)
 
 #-------------------------------------------------------------------------------
-def ts_filename(timestamp):
+def sync_photostream(user_id, raw_tags=False):
+    """Retrieve tag data for photos uploaded since the last sync.
+
+    user_id = Flickr user ID
+    raw_tags = whether to call photo_detail() to get raw tags (see
+               cache_photostream)
+
+    New photos are merged, keyed by photo ID, into <user>-tags-sync.json in
+    the cache folder. This file has the same format as the tags pages, so it
+    is read along with them, and the existing pages are never invalidated.
+
+    The high-water marks are stored in cache/sync-state.json:
+    baseline_id = highest photo ID in the tags pages at the first sync; any
+                  photo with a higher ID is new since the full harvest
+    max_upload = latest upload date (Unix time) seen so far, used as the
+                 min_upload_date for the next sync
+
+    If the tags pages are re-harvested from scratch, delete the sync file and
+    the user's entry in sync-state.json, since the pages will include the
+    synced photos.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    state_file = os.path.join(source_folder, 'cache/sync-state.json')
+    sync_file = os.path.join(source_folder, 'cache/' + user_id + '-tags-sync.json')
+
+    state = dict()
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as fhandle:
+            state = json.loads(fhandle.read())
+    if user_id not in state:
+        baseline_id = 0
+        for filename in glob.glob(os.path.join(source_folder,
+                                               'cache/' + user_id + '-tags-page*.json')):
+            with open(filename, 'r') as fhandle:
+                for photo in json.loads(fhandle.read()):
+                    baseline_id = max(baseline_id, int(photo['photo_url'].split('/')[-1]))
+        state[user_id] = {'baseline_id': baseline_id, 'max_upload': 0}
+    user_state = state[user_id]
+
+    records = dict() # photo ID -> tag record
+    if os.path.isfile(sync_file):
+        with open(sync_file, 'r') as fhandle:
+            for photo in json.loads(fhandle.read()):
+                records[photo['photo_url'].split('/')[-1]] = photo
+
+    params = {'user_id': user_id, 'per_page': '500',
+              'extras': 'date_upload,date_taken,tags'}
+    if user_state['max_upload']:
+        params['min_upload_date'] = str(user_state['max_upload'])
+
+    new_photos = 0
+    synced = [] # records retrieved in this sync
+    replaced = [] # records in the sync file that were retrieved again
+    pageno = 1
+    while True:
+        jsondata = flickrclient.default_client().call('flickr.people.getPhotos',
+                                                      page=str(pageno), **params)
+        photolist = jsondata['photos']['photo'] # newest first
+        for photo in photolist:
+            if int(photo['id']) <= user_state['baseline_id']:
+                break # already in the tags pages, and so are all older photos
+            if photo['id'] not in records:
+                new_photos += 1
+            else:
+                replaced.append(records[photo['id']])
+            records[photo['id']] = bulk_tag_record(user_id, photo, raw_tags)
+            synced.append(records[photo['id']])
+            user_state['max_upload'] = max(user_state['max_upload'], int(photo['dateupload']))
+        else:
+            if pageno < jsondata['photos']['pages']:
+                pageno += 1
+                continue
+        break
+
+    print('{0} new photos for {1} ({2} API calls)'.format(new_photos, user_id, pageno))
+    print('--> writing ' + sync_file)
+    with open(sync_file, 'w') as fhandle:
+        fhandle.write(json.dumps([records[photo_id] for photo_id
+                                  in sorted(records, key=int, reverse=True)],
+                                 indent=4, sort_keys=True))
+    with open(state_file, 'w') as fhandle:
+        fhandle.write(json.dumps(state, indent=4, sort_keys=True))
+    if tagstore.store_exists():
+        replaced = tagstore.upsert_records(synced)
+    rollups.update_rollups(synced, replaced)
+
+#-------------------------------------------------------------------------------
+def tag_record(user_id, photo, photo_info):
+    """Create the tag data record for a photo.
+
+    user_id = Flickr user ID
+    photo = the JSON representation of a photo as returned by the
+            people.getPhotos API call
+    photo_info = the JSON output of the photos.getInfo API call for the photo
+
+    Returns a dictionary, in the format written to <user>-tags-pageXXX.json.
+    """
+    photo_url = 'http://flickr.com/photos/' + user_id + '/' + photo['id']
+    taken = photo_info['photo']['dates']['taken']
+    title = photo['title'].strip().lower()
+
+    keywords = [tag['raw'].strip().lower() for tag in photo_info['photo']['tags']['tag']]
+    keywords.append('flickr-' + user_id)
+
+    taglist = ','.join(sorted(keywords))
+
+    try:
+        print(photo_url + ' - ' + taken + ' - ' + title + ' - ' + taglist)
+    except UnicodeEncodeError as e:
+        print('*** UnicodeEncodeError ***')
+
+    return {'user_id': user_id,
+            'title': title,
+            'taken': taken,
+            'keywords': keywords,
+            'photo_url': photo_url}
+
+#-------------------------------------------------------------------------------
+def tag_records(user_id, normalize=True):
+    """Read the cached tag records for a user.
+
+    user_id = Flickr user ID
+    normalize = whether to normalize the keywords with the rules in
+                tagrules.ini (see tagrules.py), which also drop the
+                flickr-* tags; False gives the records as harvested
+
+    Reads from the consolidated store (see tagstore.py) if it has been
+    created, otherwise from the <user>-tags-*.json files in the cache folder.
+    Generates the tag records (dictionaries).
+    """
+    if normalize:
+        yield from tagrules.default_rules().apply(tag_records(user_id, normalize=False))
+        return
+    if tagstore.store_exists():
+        yield from tagstore.read_records(user_id)
+        return
+
+    for filename in glob.glob('cache/' + user_id + '-tags-*.json'):
+        with open(filename, 'r') as fhandle:
+            contents = fhandle.read()
+        metrics.count('bytes.read', len(contents))
+        yield from json.loads(contents)
+
+#-------------------------------------------------------------------------------
+def ts_filename(timestamp, index=None, photo_home=None):
     """Convert a Flickr timestamp to a list of possible matching files in the
     photos folder hierarchy.
 
     timestamp = 'YYYY-MM-DD HH:MM:SS' format assumed (all components required)
+    index = optional timestamp index (see tsindex.py); if provided, matches
+            are found in the index instead of by searching the folders
+    photo_home = optional root folder of the photo backups; default is
+                 PHOTO_HOME (ignored if an index is provided)
 
     Returns a list of 0 or more possible matching filenames.
     """
     matches = []
-    photo_home = 'd:\\doug\\photos' #/// get from phototag config settings
+    photo_home = photo_home or PHOTO_HOME
+    if index:
+        photo_home = index['photo_home']
     month_folder = os.path.join(photo_home,
                                 timestamp[:4],
                                 timestamp[5:7])
@@ -344,6 +550,8 @@ def ts_filename(timestamp):
                                  timestamp[:4],
                                  timestamp[5:7])
 
+    if index:
+        return ts_lookup(index, [posted_photos, day_folder, month_folder], timestamp)
 
     matches.extend(ts_search(posted_photos, timestamp))
     if not matches:
@@ -356,6 +564,35 @@ def ts_filename(timestamp):
     return matches
 
 #-------------------------------------------------------------------------------
+def ts_lookup(index, folders, timestamp):
+    """Search a timestamp index for photos matching a timestamp.
+
+    index = timestamp index (see tsindex.py)
+    folders = list of folders to search, in order of preference
+    timestamp = timestamp to match, 'YYYY-MM-DD HH:MM:SS'
+
+    Same results as calling ts_search() for each folder until a match is
+    found, but with no filesystem I/O.
+    """
+    nseconds = 8
+    candidates = tsindex.lookup(index, timestamp, nseconds)
+    for folder in folders:
+        infolder = [(filename, diff) for filename, diff in candidates
+                    if os.path.dirname(filename) == folder]
+        matchlist = [filename for filename, diff in infolder if diff == 0]
+        for filename in matchlist:
+            print(filename + ' <- EXACT MATCH')
+        if not matchlist:
+            for filename, diff in infolder:
+                print(filename + ' <- timestamps differ by {0} seconds'.format(diff))
+                matchlist.append(filename)
+        if matchlist:
+            return matchlist
+
+    return []
+
+#-------------------------------------------------------------------------------
+@metrics.timed('ts_search')
 def ts_search(folder, timestamp):
     """Search a folder for photos matching a timestamp.
 
@@ -394,6 +631,7 @@ def ts_search(folder, timestamp):
     return matchlist
 
 #-------------------------------------------------------------------------------
+@metrics.timed('write_cache')
 def write_cache(*, user_id, pageno, datatype, jsondata):
     """Write photo tag data to local cache for one page of photostream.
 
@@ -405,19 +643,58 @@ def write_cache(*, user_id, pageno, datatype, jsondata):
     <user>-tags-pageXXX.json
     """
     filename = cache_filename(user_id=user_id, pageno=pageno, datatype=datatype)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
     print('--> writing ' + filename)
 
+    replaced = []
+    if datatype == 'tags' and not tagstore.store_exists() and os.path.isfile(filename):
+        with open(filename, 'r') as fhandle:
+            replaced = json.loads(fhandle.read())
+
+    contents = json.dumps(jsondata, indent=4, sort_keys=True)
     with open(filename, 'w') as fhandle:
-        fhandle.write(json.dumps(jsondata, indent=4, sort_keys=True))
+        fhandle.write(contents)
+    metrics.count('bytes.written', len(contents))
+
+    if datatype == 'tags':
+        if tagstore.store_exists() and _settings.store_batch is not None:
+            _settings.store_batch.update((tagstore.photo_id(record), record)
+                                         for record in jsondata)
+            if len(_settings.store_batch) >= _settings.flush_every:
+                _flush_store()
+            return
+        if tagstore.store_exists():
+            replaced = tagstore.upsert_records(jsondata)
+        rollups.update_rollups(jsondata, replaced)
+
+#-------------------------------------------------------------------------------
+def _flush_store():
+    """Merge the batched tag records into the store, and update the rollups.
+    """
+    records = list(_settings.store_batch.values())
+    if not records:
+        return
+    with _settings.store_lock() if _settings.store_lock else contextlib.nullcontext():
+        rollups.update_rollups(records, tagstore.upsert_records(records))
+    _settings.store_batch.clear()
 
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
 
+    # (phototag.py runs each of these steps as a command-line subcommand)
+
     # DATA HARVESTING - completed ----------------------------------------------
 
+    # to see where the time goes, record timers/counters in cache/metrics.json
+    # (print them with python metrics.py) ...
+    #metrics.enable()
+
     #get_tags_example('dogerino')
     #cache_photostream('dogerino')
     #cache_photostream('dougerino')
+    # or get the (normalized) tags in the same calls, ~100x fewer API calls
+    # than cache_tags(); raw_tags=True adds a photos.getInfo call per tagged photo:
+    #cache_photostream('dogerino', bulk=True)
     # need to break the work into chunks that are under 3600 API calls (the
     # hourly limit), then wait at least an hour between chunks ...
     # dogerino: DONE
@@ -427,6 +704,20 @@ if __name__ == '__main__':
     #end = 121
     #for pageno in range(start, end + 1):
     #    cache_tags(user_id=user_id, pageno=pageno)
+    # (harvest.py now does this in one run, at the maximum allowed rate)
+
+    # after the full harvest, new uploads only need a few API calls ...
+    #sync_photostream('dogerino')
+    #sync_photostream('dougerino')
+
+    # after a change to tag_record(), rewrite the tags pages from the cached
+    # photostream pages and API responses, with no API calls ...
+    #rebuild_tags('dogerino')
+    #rebuild_tags('dougerino')
+
+    # one-time conversion of the tags pages to the consolidated store, which
+    # is then read by tag_records() and kept current by write_cache() ...
+    #tagstore.migrate()
 
     # MATCHING TIMESTAMPS TO FILENAMES -----------------------------------------
 
@@ -437,16 +728,16 @@ if __name__ == '__main__':
     #    print(TS)
     #    print(ts_filename(TS))
 
+    # build the timestamp index once, then lookups don't touch the filesystem
+    #tsindex.save_index(tsindex.build_index(PHOTO_HOME))
+    INDEX = tsindex.load_index()
+
     TESTRUN = 50
-    for user_id in ['dogerino', 'dougerino']:
-        for datasource in glob.glob('cache/' + user_id + '-tags-*.json'):
-            print('SOURCE -> ' + datasource)
-            with open(datasource, 'r') as fhandle:
-                jsondata = json.loads(fhandle.read())
-                for photo in jsondata:
-                    TS = photo['taken']
-                    print('\ntimestamp to match: ' + TS)
-                    PHOTOFILENAME = ts_filename(TS)
-                    TESTRUN -= 1
-                    if TESTRUN == 0:
-                        sys.exit()
+    for user_id in USERS:
+        for photo in tag_records(user_id):
+            TS = photo['taken']
+            print('\ntimestamp to match: ' + TS)
+            PHOTOFILENAME = ts_filename(TS, INDEX)
+            TESTRUN -= 1
+            if TESTRUN == 0:
+                sys.exit()
@@ -0,0 +1,244 @@
+""" harvest.py
+concurrent, rate-limited, resumable harvester for Flickr tag data
+
+Harvests every page of a user's photostream in one run: the photostream
+pages (people.getPhotos) are cached as needed, then photos.getInfo calls for
+all photos are made concurrently, throttled by a token bucket set to the API
+quota. Each photo's tag record is appended to a checkpoint file as soon as
+it's retrieved, so an interrupted harvest resumes where it left off. The
+<user>-tags-pageXXX.json files are written as each page is completed.
+API responses are cached (see respcache.py), so re-harvesting photos that
+were retrieved in the last 30 days costs no API calls.
+
+Usage: python harvest.py <user_id> [--workers 8] [--calls-per-hour 3600]
+                                   [--endpoint URL] [--offline] [--metrics]
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import requests
+
+from flickrclient import API_ENDPOINT, FlickrClient, FlickrError
+import metrics
+import respcache
+from flickrtags import batched_store, cache_filename, tag_record, write_cache
+
+#-------------------------------------------------------------------------------
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.
+
+    rate = tokens added per second
+    capacity = maximum number of tokens (burst size)
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#-------------------------------------------------------------------------------
+def checkpoint_filename(user_id):
+    """Get filename for a user's harvest checkpoint file.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/' + user_id + '-harvest.jsonl')
+
+#-------------------------------------------------------------------------------
+def harvest(user_id, *, app='dougerino-jamiesearcher', workers=8,
+            calls_per_hour=3600, burst=10, endpoint=API_ENDPOINT, offline=False):
+    """Harvest all tag data for a user's photostream.
+
+    user_id = Flickr user ID
+    app = section of ../_private/flickr.ini that contains the API key
+    workers = number of concurrent API calls
+    calls_per_hour = API quota; calls are spread evenly over the hour
+    burst = number of calls that can be made at once after an idle period
+    endpoint = URL of the Flickr REST API
+    offline = if True, only responses in the response cache (see respcache.py)
+              are used, and no API calls are made
+
+    Pages whose <user>-tags-pageXXX.json file already exists are skipped.
+    Returns the number of photos that couldn't be retrieved (0 = complete).
+    """
+    limiter = TokenBucket((calls_per_hour - burst) / 3600, burst)
+    cache = respcache.default_cache()
+    client = FlickrClient(app, endpoint=endpoint, limiter=limiter, pool_size=workers,
+                          cache=cache)
+    # the cache is shared by the whole process, so offline mode only lasts
+    # for this harvest
+    previous, cache.offline = cache.offline, offline
+    try:
+        with batched_store():
+            return _harvest_pages(user_id, client, workers)
+    finally:
+        cache.offline = previous
+        client.close()
+
+#-------------------------------------------------------------------------------
+def harvest_photostream(user_id, client):
+    """Cache any photostream pages that aren't already cached.
+
+    user_id = Flickr user ID
+    client = FlickrClient used for the API calls
+
+    Returns the total number of pages in the user's photostream.
+    """
+    params = {'user_id': user_id, 'per_page': '100'}
+    filename = cache_filename(user_id=user_id, pageno=1, datatype='photostream')
+    if os.path.isfile(filename):
+        with open(filename, 'r') as datafile:
+            jsondata = json.loads(datafile.read())
+    else:
+        jsondata = client.call('flickr.people.getPhotos', **params)
+        write_cache(user_id=user_id, pageno=1, datatype='photostream', jsondata=jsondata)
+
+    tot_pages = jsondata['photos']['pages']
+    for pageno in range(2, tot_pages + 1):
+        if os.path.isfile(cache_filename(user_id=user_id, pageno=pageno,
+                                         datatype='photostream')):
+            continue
+        jsondata = client.call('flickr.people.getPhotos', page=str(pageno), **params)
+        write_cache(user_id=user_id, pageno=pageno, datatype='photostream', jsondata=jsondata)
+
+    return tot_pages
+
+#-------------------------------------------------------------------------------
+def read_checkpoint(user_id):
+    """Read a user's harvest checkpoint file.
+
+    Returns a dictionary of tag records (photo ID -> record) for photos that
+    have already been harvested.
+    """
+    done = dict()
+    filename = checkpoint_filename(user_id)
+    if not os.path.isfile(filename):
+        return done
+    with open(filename, 'r') as checkpoint:
+        for line in checkpoint:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue # partial line written when harvest was interrupted
+            done[entry['id']] = entry['record']
+    print('{0} photos already harvested for {1}'.format(len(done), user_id))
+    return done
+
+#-------------------------------------------------------------------------------
+def write_page(user_id, pageno, photolist, done):
+    """Write the tags file for a page whose photos have all been harvested.
+
+    user_id = Flickr user ID
+    pageno = page number of the photostream
+    photolist = photos on the page, in photostream order
+    done = dictionary of tag records (photo ID -> record)
+    """
+    write_cache(user_id=user_id, pageno=pageno, datatype='tags',
+                jsondata=[done[photo['id']] for photo in photolist])
+
+#-------------------------------------------------------------------------------
+def _harvest_pages(user_id, client, workers):
+    """Harvest the pages of a user's photostream that haven't been written yet.
+
+    user_id = Flickr user ID
+    client = FlickrClient used for the API calls
+    workers = number of concurrent API calls
+
+    Returns the number of photos that couldn't be retrieved.
+    """
+    tot_pages = harvest_photostream(user_id, client)
+    done = read_checkpoint(user_id)
+
+    pages = dict() # pageno -> list of photos for pages not yet harvested
+    for pageno in range(1, tot_pages + 1):
+        if os.path.isfile(cache_filename(user_id=user_id, pageno=pageno, datatype='tags')):
+            continue
+        filename = cache_filename(user_id=user_id, pageno=pageno, datatype='photostream')
+        with open(filename, 'r') as datafile:
+            pages[pageno] = json.loads(datafile.read())['photos']['photo']
+    remaining = {pageno: sum(1 for photo in photolist if photo['id'] not in done)
+                 for pageno, photolist in pages.items()}
+
+    failures = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+        open(checkpoint_filename(user_id), 'a') as checkpoint:
+
+        futures = dict() # future -> (pageno, photo)
+        for pageno, photolist in pages.items():
+            if not remaining[pageno]:
+                write_page(user_id, pageno, photolist, done) # completed before interruption
+            for photo in photolist:
+                if photo['id'] not in done:
+                    future = executor.submit(client.call, 'flickr.photos.getInfo',
+                                             photo_id=photo['id'])
+                    futures[future] = (pageno, photo)
+
+        for future in concurrent.futures.as_completed(futures):
+            pageno, photo = futures[future]
+            try:
+                photo_info = future.result()
+            except (requests.RequestException, ValueError, FlickrError,
+                    respcache.NotCached) as err:
+                print('ERROR: photo {0} - {1}'.format(photo['id'], err))
+                failures += 1
+                continue
+
+            done[photo['id']] = tag_record(user_id, photo, photo_info)
+            checkpoint.write(json.dumps({'id': photo['id'], 'record': done[photo['id']]}) + '\n')
+            checkpoint.flush()
+
+            remaining[pageno] -= 1
+            if not remaining[pageno]:
+                write_page(user_id, pageno, pages[pageno], done)
+
+    elapsed = max(time.time() - start, 0.001)
+    print('{0} photos harvested, {1} failed, {2:.0f} seconds, {3:.0f} calls/hour'.format(
+        len(futures) - failures, failures, elapsed, len(futures) * 3600 / elapsed))
+    if not failures:
+        os.remove(checkpoint_filename(user_id)) # all pages have been written
+    return failures
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Harvest Flickr tags for a user.')
+    PARSER.add_argument('user_id', help='Flickr user ID')
+    PARSER.add_argument('--app', default='dougerino-jamiesearcher',
+                        help='section of ../_private/flickr.ini with the API key')
+    PARSER.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent API calls')
+    PARSER.add_argument('--calls-per-hour', type=int, default=3600,
+                        help='API quota')
+    PARSER.add_argument('--endpoint', default=API_ENDPOINT,
+                        help='Flickr REST API endpoint (e.g., fakeflickr.py)')
+    PARSER.add_argument('--offline', action='store_true',
+                        help='use only cached API responses (no API calls)')
+    PARSER.add_argument('--metrics', action='store_true',
+                        help='record timers/counters in cache/metrics.json')
+    ARGS = PARSER.parse_args()
+
+    if ARGS.metrics:
+        metrics.enable(interval=60)
+
+    harvest(ARGS.user_id, app=ARGS.app, workers=ARGS.workers,
+            calls_per_hour=ARGS.calls_per_hour, endpoint=ARGS.endpoint, offline=ARGS.offline)
@@ -0,0 +1,129 @@
+""" loadtest.py
+load test for the search service
+
+Sends search requests to a running searchserver.py from a pool of threads,
+each with its own keep-alive connection, and reports the throughput and
+the latency percentiles. The queries are made from the service's most
+common tags (from /status): single tags, pairs of tags, and prefixes, each
+with a random page number.
+
+Usage: python loadtest.py [--url http://127.0.0.1:8080] [--threads 8]
+                          [--requests 2000]
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+#-------------------------------------------------------------------------------
+def make_queries(tags, count, seed=1):
+    """Make a list of search request paths.
+
+    tags = list of tags to build the queries from
+    count = number of paths to make
+    seed = random seed, so that runs are repeatable
+
+    Returns a list of paths, e.g. '/search?q=dog+beach&page=2'.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5 or len(tags) < 2:
+            query = rng.choice(tags)
+        elif kind < 0.8:
+            query = ' '.join(rng.sample(tags, 2))
+        else:
+            query = rng.choice(tags)[:3] + '*'
+        paths.append('/search?' + urllib.parse.urlencode(
+            {'q': query, 'page': rng.randint(1, 3), 'per_page': 20}))
+    return paths
+
+#-------------------------------------------------------------------------------
+def percentile(values, fraction):
+    """Get a percentile of a sorted list of values (nearest rank).
+    """
+    if not values:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+#-------------------------------------------------------------------------------
+def run_load(url, paths, threads=8):
+    """Send requests to the search service, and measure them.
+
+    url = base URL of the service, e.g. 'http://127.0.0.1:8080'
+    paths = list of request paths, from make_queries()
+    threads = number of concurrent clients
+
+    Returns a dictionary with requests, errors, seconds, and latencies (a
+    sorted list of seconds per request).
+    """
+    location = urllib.parse.urlparse(url)
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client(worker_paths):
+        connection = http.client.HTTPConnection(location.hostname, location.port or 80,
+                                                timeout=30)
+        times, failed = [], 0
+        for path in worker_paths:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close() # reconnects on the next request
+            times.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(times)
+            errors.append(failed)
+
+    workers = [threading.Thread(target=client, args=(paths[workerno::threads],))
+               for workerno in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {'requests': len(latencies), 'errors': sum(errors),
+            'seconds': time.perf_counter() - start, 'latencies': sorted(latencies)}
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Load test for searchserver.py.')
+    PARSER.add_argument('--url', default='http://127.0.0.1:8080')
+    PARSER.add_argument('--threads', type=int, default=8, help='number of concurrent clients')
+    PARSER.add_argument('--requests', type=int, default=2000, help='total number of requests')
+    ARGS = PARSER.parse_args()
+
+    LOCATION = urllib.parse.urlparse(ARGS.url)
+    try:
+        CONNECTION = http.client.HTTPConnection(LOCATION.hostname, LOCATION.port or 80,
+                                                timeout=30)
+        CONNECTION.request('GET', '/status')
+        STATUS = json.loads(CONNECTION.getresponse().read())
+        CONNECTION.close()
+    except (OSError, ValueError) as err:
+        print('ERROR: could not get status from {0} - {1}'.format(ARGS.url, err))
+        sys.exit(1)
+    if not STATUS['top_tags']:
+        print('ERROR: the service has no tags to query')
+        sys.exit(1)
+
+    RESULT = run_load(ARGS.url, make_queries(STATUS['top_tags'], ARGS.requests), ARGS.threads)
+    LATENCIES = RESULT['latencies']
+    print('{0} requests, {1} errors, {2:.2f} seconds, {3:.0f} requests/sec'.format(
+        RESULT['requests'], RESULT['errors'], RESULT['seconds'],
+        RESULT['requests'] / RESULT['seconds']))
+    print('latency ms: p50 {0:.2f}, p90 {1:.2f}, p99 {2:.2f}, max {3:.2f}'.format(
+        *(1000 * percentile(LATENCIES, fraction) for fraction in (0.5, 0.9, 0.99, 1.0))))
@@ -0,0 +1,186 @@
+""" matcher.py
+batch sort-merge join of Flickr timestamps against the photo backups
+
+All Flickr 'taken' timestamps and all file timestamps (from the timestamp
+index, see tsindex.py) are converted to integer epoch seconds and sorted,
+then a single windowed merge join finds every exact and near match.
+
+Files with the same name (ignoring the extension) and the same timestamp
+are one shot: a RAW+JPEG pair (DSC_1234.NEF/.jpg), or a copy of an original
+in 'posted photos'. Each shot is one candidate, and the photo is matched to
+its preferred file, in the same order as flickrtags.ts_filename(): posted
+photos, then the day folder, then the month folder (then anywhere else),
+and JPEG before RAW within a folder. When photos compete for shots (or a
+photo has several equally close shots), the candidates are resolved into a
+one-to-one assignment by smallest delta.
+
+Usage: python matcher.py [--window 8]
+"""
+import argparse
+from collections import Counter
+import json
+import os
+import sys
+
+import tsindex
+
+#-------------------------------------------------------------------------------
+def load_matches(filename=None):
+    """Load saved match results.
+
+    filename = optional filename; default is cache/matches.json
+
+    Returns a dictionary of photo_url -> match (see match_photos()), or an
+    empty dictionary if no matches have been saved.
+    """
+    filename = filename or matches_filename()
+    if not os.path.isfile(filename):
+        return dict()
+    with open(filename, 'r', encoding='utf-8') as fhandle:
+        return json.loads(fhandle.read())
+
+#-------------------------------------------------------------------------------
+def match_photos(records, index, window=8):
+    """Match Flickr photos to files in the photo backups.
+
+    records = iterable of tag records (dictionaries)
+    index = timestamp index, as returned by tsindex.load_index()
+    window = maximum difference in seconds for a near match
+
+    Returns a dictionary of photo_url -> match, where match is a dictionary:
+    filename = full path of the matched file, or None
+    delta = seconds between the Flickr and file timestamps, or None
+    status = 'exact', 'near', 'ambiguous' (matched, but other photos or
+             shots were equally good candidates) or 'unmatched'
+    """
+    # Flickr side: (epoch, photo_url), sorted
+    photos = sorted((tsindex.ts_to_epoch(record['taken']), record['photo_url'])
+                    for record in records)
+    file_ts = index['timestamps'] # already sorted
+
+    # windowed merge join: candidate pairs of (delta, photo #, shot), where
+    # a shot is (timestamp, lowercase name without extension)
+    shot_files = dict() # shot -> its files (file #s), preferred first
+    candidates = set()
+    first = 0 # first file that could be in the window for the current photo
+    for photono, (epoch, _) in enumerate(photos):
+        while first < len(file_ts) and file_ts[first] < epoch - window:
+            first += 1
+        fileno = first
+        while fileno < len(file_ts) and file_ts[fileno] <= epoch + window:
+            shot = (file_ts[fileno], os.path.splitext(
+                os.path.basename(index['filenames'][fileno]))[0].lower())
+            shot_files.setdefault(shot, set()).add(fileno)
+            candidates.add((abs(file_ts[fileno] - epoch), photono, shot))
+            fileno += 1
+    shot_files = {shot: sorted(filenos, key=lambda fileno: _preference(
+        index['filenames'][fileno])) for shot, filenos in shot_files.items()}
+
+    # a match is ambiguous if the photo's best delta is shared by more than one
+    # shot, or the photo's best shot is also a best-delta candidate for
+    # another photo
+    best_delta = dict() # photo # -> smallest delta
+    for delta, photono, _ in candidates:
+        if delta < best_delta.get(photono, window + 1):
+            best_delta[photono] = delta
+    best_shots = Counter() # photo # -> number of shots at the best delta
+    shot_claims = Counter() # shot -> number of photos that want it
+    for delta, photono, shot in candidates:
+        if delta == best_delta[photono]:
+            best_shots[photono] += 1
+            shot_claims[shot] += 1
+
+    # one-to-one assignment, smallest delta first
+    assigned_photos = dict() # photo # -> (delta, shot)
+    assigned_shots = set()
+    for delta, photono, shot in sorted(candidates):
+        if photono in assigned_photos or shot in assigned_shots:
+            continue
+        assigned_photos[photono] = (delta, shot)
+        assigned_shots.add(shot)
+
+    matches = dict()
+    for photono, (_, photo_url) in enumerate(photos):
+        if photono not in assigned_photos:
+            matches[photo_url] = {'filename': None, 'delta': None, 'status': 'unmatched'}
+            continue
+        delta, shot = assigned_photos[photono]
+        if best_shots[photono] > 1 or shot_claims[shot] > 1:
+            status = 'ambiguous'
+        else:
+            status = 'exact' if delta == 0 else 'near'
+        matches[photo_url] = {'filename': os.path.join(index['photo_home'],
+                                                       index['filenames'][shot_files[shot][0]]),
+                              'delta': delta,
+                              'status': status}
+    return matches
+
+#-------------------------------------------------------------------------------
+def matches_filename():
+    """Get filename for the saved match results.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/matches.json')
+
+#-------------------------------------------------------------------------------
+def print_report(matches):
+    """Print the number of photos with each match status.
+    """
+    totals = Counter(match['status'] for match in matches.values())
+    print('total photos processed: {0}'.format(len(matches)))
+    for status in ['exact', 'near', 'phash', 'ambiguous', 'unmatched']:
+        print('{0:22} {1}'.format('total ' + status + ':', totals[status]))
+
+#-------------------------------------------------------------------------------
+def save_matches(matches, filename=None):
+    """Save match results to disk.
+
+    matches = dictionary returned by match_photos()
+    filename = optional filename; default is cache/matches.json
+    """
+    filename = filename or matches_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename, 'w', encoding='utf-8') as fhandle:
+        fhandle.write(json.dumps(matches, separators=(',', ':'), ensure_ascii=False))
+
+#-------------------------------------------------------------------------------
+def _preference(relpath):
+    """Get the sort key that ranks the files of a shot, preferred first.
+
+    relpath = filename relative to photo_home
+
+    Folders are ranked like flickrtags.ts_filename(): 'posted photos/YYYY/MM',
+    then YYYY/MM/DD, then YYYY/MM, then anything else. Within a folder,
+    extensions are ranked in the order of tsindex.PHOTO_EXTENSIONS.
+    """
+    parts = relpath.replace('\\', '/').split('/')
+    if parts[0].lower() == 'posted photos':
+        folder_rank = 0
+    elif len(parts) in (3, 4) and all(part.isdigit() for part in parts[:-1]):
+        folder_rank = 1 if len(parts) == 4 else 2 # day folder, month folder
+    else:
+        folder_rank = 3
+    extension = os.path.splitext(relpath)[1].lower()
+    extension_rank = tsindex.PHOTO_EXTENSIONS.index(extension) \
+        if extension in tsindex.PHOTO_EXTENSIONS else len(tsindex.PHOTO_EXTENSIONS)
+    return (folder_rank, extension_rank, relpath)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Match Flickr photos to backup files.')
+    PARSER.add_argument('--window', type=int, default=8,
+                        help='maximum seconds between timestamps for a near match')
+    ARGS = PARSER.parse_args()
+
+    from flickrtags import USERS, tag_records
+    RECORDS = [record for user_id in USERS
+               for record in tag_records(user_id)]
+    INDEX = tsindex.load_index()
+    if not INDEX:
+        print('ERROR: no timestamp index; run tsindex.py first')
+        sys.exit(1)
+    MATCHES = match_photos(RECORDS, INDEX, ARGS.window)
+    save_matches(MATCHES)
+    print_report(MATCHES)
@@ -0,0 +1,226 @@
+""" metacache.py
+persistent store of parsed photo metadata, keyed by (filename, size, mtime)
+
+Capture timestamps are stored in a local SQLite database (cache/metadata.db)
+so that files which haven't changed since the last run are never re-parsed.
+Camera models (used by clockoffset.py) and perceptual hashes (phash.py) are
+stored in the same rows, and computed the first time they're asked for.
+
+Usage: python metacache.py validate|prune
+"""
+import atexit
+import os
+import sqlite3
+import sys
+
+import exifts
+import metrics
+
+#-------------------------------------------------------------------------------
+class _settings:
+    connection = None # open connection to the metadata store
+    pending = 0 # number of uncommitted writes
+    commit_every = 1000 # commit after this many writes
+
+#-------------------------------------------------------------------------------
+def close_store():
+    """Commit any pending writes and close the metadata store.
+    """
+    if _settings.connection:
+        _settings.connection.commit()
+        _settings.connection.close()
+        _settings.connection = None
+        _settings.pending = 0
+
+#-------------------------------------------------------------------------------
+def file_model(filename):
+    """Get the camera model for a photo, parsing it only if necessary.
+
+    filename = any photo file
+
+    Returns the same value as exifts.exif_model() (None if the file has no
+    model), from the metadata store if the file hasn't changed since its
+    model was last parsed.
+    """
+    stat = os.stat(filename)
+    model = get_value(filename, stat, 'model')
+    metrics.cache_lookup('metacache.model', model is not None)
+    if model is not None:
+        return model or None
+    model = exifts.exif_model(filename)
+    put_value(filename, stat, 'model', model or '')
+    return model
+
+#-------------------------------------------------------------------------------
+def file_timestamp(filename):
+    """Get the capture timestamp for a photo, parsing it only if necessary.
+
+    filename = any photo file
+
+    Returns the same value as exifts.file_timestamp(), from the metadata store
+    if the file's size and modified time haven't changed since it was last
+    parsed.
+    """
+    stat = os.stat(filename)
+    taken = get_timestamp(filename, stat)
+    metrics.cache_lookup('metacache', taken is not None)
+    if taken is None:
+        taken = exifts.file_timestamp(filename)
+        put_timestamp(filename, stat, taken)
+    return taken
+
+#-------------------------------------------------------------------------------
+def get_timestamp(filename, stat):
+    """Look up a file's capture timestamp in the metadata store.
+
+    filename = full path of a photo file
+    stat = the file's os.stat() result
+
+    Returns the stored timestamp, or None if the file isn't in the store or
+    has been modified since it was stored.
+    """
+    row = open_store().execute(
+        'SELECT taken FROM files WHERE filename=? AND size=? AND mtime=?',
+        (filename, stat.st_size, stat.st_mtime_ns)).fetchone()
+    return row[0] if row else None
+
+#-------------------------------------------------------------------------------
+def get_value(filename, stat, column):
+    """Look up a stored value other than the timestamp for a file.
+
+    filename = full path of a photo file
+    stat = the file's os.stat() result
+    column = 'model' or 'phash'
+
+    Returns the stored value, or None if the file isn't in the store, has
+    been modified since it was stored, or doesn't have that value yet.
+    """
+    row = open_store().execute(
+        'SELECT ' + column + ' FROM files WHERE filename=? AND size=? AND mtime=?',
+        (filename, stat.st_size, stat.st_mtime_ns)).fetchone()
+    return row[0] if row else None
+
+#-------------------------------------------------------------------------------
+def open_store(filename=None):
+    """Open the metadata store, creating it if needed.
+
+    filename = optional filename; default is cache/metadata.db
+
+    Returns the SQLite connection. The connection is shared, so subsequent
+    calls return the same connection until close_store() is called.
+    """
+    if _settings.connection:
+        return _settings.connection
+
+    if not filename:
+        source_folder = os.path.dirname(os.path.realpath(__file__))
+        filename = os.path.join(source_folder, 'cache/metadata.db')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    connection = sqlite3.connect(filename)
+    connection.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, '
+                       'size INTEGER, mtime INTEGER, taken TEXT, model TEXT, phash TEXT)')
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(files)')]
+    for column in ['model', 'phash']:
+        if column not in columns:
+            # store created before this value was added
+            connection.execute('ALTER TABLE files ADD COLUMN ' + column + ' TEXT')
+    _settings.connection = connection
+    atexit.register(close_store)
+    return connection
+
+#-------------------------------------------------------------------------------
+def prune():
+    """Remove entries for files that have been deleted, moved or modified.
+
+    Returns the number of entries removed.
+    """
+    stale = [filename for filename, status in validate() if status != 'ok']
+    connection = open_store()
+    connection.executemany('DELETE FROM files WHERE filename=?',
+                           [(filename,) for filename in stale])
+    connection.commit()
+    return len(stale)
+
+#-------------------------------------------------------------------------------
+def put_timestamp(filename, stat, taken, model=None):
+    """Save a file's capture timestamp in the metadata store.
+
+    filename = full path of a photo file
+    stat = the file's os.stat() result
+    taken = capture timestamp, 'YYYY-MM-DD HH:MM:SS'
+    model = camera model ('' if the file has no model), or None if it
+            hasn't been parsed
+    """
+    connection = open_store()
+    connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL)',
+                       (filename, stat.st_size, stat.st_mtime_ns, taken, model))
+    _written(connection)
+
+#-------------------------------------------------------------------------------
+def put_value(filename, stat, column, value):
+    """Save a value other than the timestamp for a file.
+
+    filename = full path of a photo file
+    stat = the file's os.stat() result
+    column = 'model' or 'phash'
+    value = the value (a string)
+
+    If the file isn't in the store (or has changed), its timestamp is parsed
+    and stored too.
+    """
+    connection = open_store()
+    cursor = connection.execute(
+        'UPDATE files SET ' + column + '=? WHERE filename=? AND size=? AND mtime=?',
+        (value, filename, stat.st_size, stat.st_mtime_ns))
+    if cursor.rowcount:
+        _written(connection)
+        return
+    put_timestamp(filename, stat, exifts.file_timestamp(filename))
+    connection.execute('UPDATE files SET ' + column + '=? WHERE filename=?',
+                       (value, filename))
+
+#-------------------------------------------------------------------------------
+def validate():
+    """Check every entry in the metadata store against the filesystem.
+
+    Generates (filename, status) tuples, where status is 'ok', 'missing'
+    (deleted or moved) or 'changed' (size or modified time differs).
+    """
+    rows = open_store().execute('SELECT filename, size, mtime FROM files').fetchall()
+    for filename, size, mtime in rows:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            yield (filename, 'missing')
+            continue
+        if stat.st_size == size and stat.st_mtime_ns == mtime:
+            yield (filename, 'ok')
+        else:
+            yield (filename, 'changed')
+
+#-------------------------------------------------------------------------------
+def _written(connection):
+    """Count a write, and commit periodically.
+    """
+    _settings.pending += 1
+    if _settings.pending >= _settings.commit_every:
+        connection.commit()
+        _settings.pending = 0
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ['validate', 'prune']:
+        print('Usage: python metacache.py validate|prune')
+        sys.exit(1)
+
+    if sys.argv[1] == 'validate':
+        TOTALS = {'ok': 0, 'missing': 0, 'changed': 0}
+        for FILENAME, STATUS in validate():
+            TOTALS[STATUS] += 1
+            if STATUS != 'ok':
+                print(FILENAME + ' <- ' + STATUS.upper())
+        print('{ok} ok, {missing} missing, {changed} changed'.format(**TOTALS))
+    else:
+        print('{0} entries removed'.format(prune()))
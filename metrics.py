@@ -0,0 +1,259 @@
+""" metrics.py
+lightweight timers, counters and API call accounting for the hot paths
+
+Metrics are disabled by default, and then each instrumented call costs one
+attribute check. After enable(), the instrumented functions record:
+- call counts and latencies (total, mean, p50/p90/p99, max) per timer
+- bytes read and written
+- API calls per method (and response bytes)
+- cache hits and misses, with hit ratios
+
+The summary is written to a JSON file at exit, and optionally every N
+seconds while running, so a long harvest or scan can be monitored to see
+whether it's bound by the network, disk or EXIF parsing.
+
+Usage: python metrics.py [<metrics.json>]  (print a saved summary)
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+#-------------------------------------------------------------------------------
+class _settings:
+    enabled = False # whether metrics are being recorded
+    filename = None # JSON file the summary is written to
+    lock = threading.Lock()
+    timers = dict() # timer name -> {'count', 'total', 'max', 'samples'}
+    counters = dict() # counter name -> value
+    max_samples = 10000 # latency samples kept per timer, for percentiles
+    started = None # time.time() when metrics were enabled
+
+#-------------------------------------------------------------------------------
+class _Timer:
+    """Context manager returned by timer() when metrics are enabled.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+#-------------------------------------------------------------------------------
+def api_call(method, nbytes=0):
+    """Record an API call.
+
+    method = API method, e.g. 'flickr.photos.getInfo'
+    nbytes = size of the response
+    """
+    if _settings.enabled:
+        count('api.' + method)
+        count('bytes.api', nbytes)
+
+#-------------------------------------------------------------------------------
+def cache_lookup(cache, hit):
+    """Record a cache hit or miss.
+
+    cache = name of the cache, e.g. 'metacache'
+    hit = True if the value was found in the cache
+    """
+    if _settings.enabled:
+        count('cache.' + cache + ('.hits' if hit else '.misses'))
+
+#-------------------------------------------------------------------------------
+def count(name, amount=1):
+    """Add to a counter.
+    """
+    if _settings.enabled:
+        with _settings.lock:
+            _settings.counters[name] = _settings.counters.get(name, 0) + amount
+
+#-------------------------------------------------------------------------------
+def default_filename():
+    """Get the default filename for the metrics summary.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/metrics.json')
+
+#-------------------------------------------------------------------------------
+def enable(filename=None, interval=None):
+    """Start recording metrics.
+
+    filename = JSON file for the summary; default is cache/metrics.json
+    interval = optional number of seconds between periodic writes of the
+               summary; it's always written at exit
+    """
+    if _settings.enabled:
+        return
+    _settings.enabled = True
+    _settings.filename = filename or default_filename()
+    _settings.started = time.time()
+    atexit.register(write_summary)
+    if interval:
+        def periodic():
+            while _settings.enabled:
+                time.sleep(interval)
+                write_summary()
+        threading.Thread(target=periodic, daemon=True).start()
+
+#-------------------------------------------------------------------------------
+def print_summary(totals=None):
+    """Print a metrics summary.
+
+    totals = dictionary returned by summary(); default is the current totals
+    """
+    totals = totals or summary()
+    print('elapsed: {0:.1f} seconds'.format(totals['elapsed']))
+    for name, timer in sorted(totals['timers'].items()):
+        print('{0:24} {1:9,} calls {2:10.3f} sec  mean {3:8.3f} ms  '
+              'p50 {4:8.3f}  p90 {5:8.3f}  p99 {6:8.3f}  max {7:8.3f}'.format(
+                  name, timer['count'], timer['total'], timer['mean'] * 1000,
+                  timer['p50'] * 1000, timer['p90'] * 1000, timer['p99'] * 1000,
+                  timer['max'] * 1000))
+    for name, value in sorted(totals['counters'].items()):
+        print('{0:40} {1:15,}'.format(name, value))
+    for name, ratio in sorted(totals['hit_ratios'].items()):
+        print('{0:40} {1:15.1%}'.format(name + ' hit ratio', ratio))
+
+#-------------------------------------------------------------------------------
+def record(name, seconds):
+    """Record one call's latency for a timer.
+
+    name = timer name
+    seconds = elapsed time
+    """
+    with _settings.lock:
+        timer = _settings.timers.get(name)
+        if timer is None:
+            timer = _settings.timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                              'samples': []}
+        timer['count'] += 1
+        timer['total'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+        # reservoir sampling: a bounded, uniform sample for the percentiles
+        if len(timer['samples']) < _settings.max_samples:
+            timer['samples'].append(seconds)
+        else:
+            slot = random.randrange(timer['count'])
+            if slot < _settings.max_samples:
+                timer['samples'][slot] = seconds
+
+#-------------------------------------------------------------------------------
+def reset():
+    """Discard all recorded metrics.
+    """
+    with _settings.lock:
+        _settings.timers = dict()
+        _settings.counters = dict()
+        _settings.started = time.time()
+
+#-------------------------------------------------------------------------------
+def summary():
+    """Summarize the recorded metrics.
+
+    Returns a dictionary with these keys:
+    elapsed = seconds since metrics were enabled
+    timers = dictionary of timer name -> {count, total, mean, p50, p90, p99, max}
+    counters = dictionary of counter name -> value
+    hit_ratios = dictionary of cache name -> hits / (hits + misses)
+    """
+    with _settings.lock:
+        timers = dict()
+        for name, timer in _settings.timers.items():
+            samples = sorted(timer['samples'])
+            timers[name] = {'count': timer['count'],
+                            'total': timer['total'],
+                            'mean': timer['total'] / timer['count'],
+                            'p50': _percentile(samples, 50),
+                            'p90': _percentile(samples, 90),
+                            'p99': _percentile(samples, 99),
+                            'max': timer['max']}
+        counters = dict(_settings.counters)
+
+    hit_ratios = dict()
+    for name, value in counters.items():
+        if name.startswith('cache.') and name.endswith('.hits'):
+            cache = name[len('cache.'):-len('.hits')]
+            misses = counters.get('cache.' + cache + '.misses', 0)
+            hit_ratios[cache] = value / (value + misses)
+    for name in counters:
+        if name.startswith('cache.') and name.endswith('.misses'):
+            hit_ratios.setdefault(name[len('cache.'):-len('.misses')], 0.0)
+
+    return {'elapsed': time.time() - (_settings.started or time.time()),
+            'timers': timers, 'counters': counters, 'hit_ratios': hit_ratios}
+
+#-------------------------------------------------------------------------------
+def timed(name):
+    """Decorator that records each call of a function under a timer.
+
+    name = timer name
+
+    When metrics are disabled, the only overhead is a check of a flag. For
+    generator functions, only the time to create the generator is recorded,
+    so use timer() inside the generator instead.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _settings.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+#-------------------------------------------------------------------------------
+def timer(name):
+    """Context manager that records the time spent in a block under a timer.
+
+    name = timer name
+    """
+    if not _settings.enabled:
+        return contextlib.nullcontext()
+    return _Timer(name)
+
+#-------------------------------------------------------------------------------
+def write_summary(filename=None):
+    """Write the metrics summary to a JSON file.
+
+    filename = optional filename; default is the one passed to enable()
+    """
+    filename = filename or _settings.filename or default_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tempfile = filename + '.tmp'
+    with open(tempfile, 'w') as fhandle:
+        fhandle.write(json.dumps(summary(), indent=4, sort_keys=True))
+    os.replace(tempfile, filename)
+
+#-------------------------------------------------------------------------------
+def _percentile(samples, percent):
+    """Get a percentile from a sorted list of samples (0.0 if empty).
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    FILENAME = sys.argv[1] if len(sys.argv) > 1 else default_filename()
+    if not os.path.isfile(FILENAME):
+        print('ERROR: no metrics file ' + FILENAME)
+        sys.exit(1)
+    with open(FILENAME, 'r') as fhandle:
+        print_summary(json.loads(fhandle.read()))
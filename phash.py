@@ -0,0 +1,424 @@
+""" phash.py
+perceptual-hash fallback matcher for photos whose timestamps don't match
+(requires PIL)
+
+Flickr doesn't keep the original filename, so a photo with no file inside
+the timestamp window (see matcher.py) would otherwise lose its tags. As a
+fallback, photos are matched by content: each original gets a 64-bit
+difference hash (dHash) computed from its embedded EXIF thumbnail, or from
+a draft-mode (1/8 scale) JPEG decode if it has none, and the hashes are
+indexed in a multi-index hash table. For each unmatched Flickr photo, a
+small Flickr size is downloaded once into cache/flickrimages/, hashed the
+same way, and looked up by Hamming distance; a lookup only probes a few
+dozen buckets and checks the hashes in them, so it stays fast with hundreds
+of thousands of originals (a BK-tree visits most of its nodes for 64-bit
+hashes and a radius of a few bits).
+
+Hashing runs in a pool of worker processes, and the hashes of the originals
+are saved in the metadata store (see metacache.py) so that each file is only
+hashed once; the downloaded Flickr images are small, and are hashed again on
+each run instead of filling the store with files that aren't originals.
+Photos matched this way get status 'phash' and the Hamming 'distance'.
+
+Usage: python phash.py [--distance 6] [--workers N] [--no-fetch]
+                       [--image-host https://live.staticflickr.com]
+"""
+import argparse
+import io
+import itertools
+import os
+import sys
+import time
+import urllib.parse
+
+import exifts
+import metacache
+import metrics
+import tsindex
+
+HASH_SIZE = 8 # hash is HASH_SIZE x HASH_SIZE bits
+FLICKR_SIZE = 't' # Flickr size suffix of the downloaded images; t = 100 pixels
+IMAGE_HOST = 'https://live.staticflickr.com' # where the real API's images are served
+
+# PIL transpose method (Image.Transpose value) for each EXIF orientation
+ORIENTATION_TRANSPOSE = {2: 0, # FLIP_LEFT_RIGHT
+                         3: 3, # ROTATE_180
+                         4: 1, # FLIP_TOP_BOTTOM
+                         5: 5, # TRANSPOSE
+                         6: 4, # ROTATE_270
+                         7: 6, # TRANSVERSE
+                         8: 2} # ROTATE_90
+
+#-------------------------------------------------------------------------------
+class HashIndex:
+    """Multi-index hash table of integer hashes, for Hamming-distance lookups.
+
+    bits = number of bits in each hash
+    chunks = number of pieces each hash is split into; each piece is indexed
+             in its own dictionary
+
+    If two hashes are within a distance r, at least one of their pieces
+    differs by at most r // chunks bits (pigeonhole principle). So a search
+    only looks up each piece of the query, and the variants of it with that
+    many bits flipped, and then checks the full distance of the few hashes
+    found.
+    """
+    def __init__(self, bits=HASH_SIZE * HASH_SIZE, chunks=4):
+        self.chunk_bits = bits // chunks
+        self.tables = [dict() for _ in range(chunks)] # piece -> list of entry #s
+        self.hashes = [] # entry # -> hash
+        self.values = [] # entry # -> value
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, hash_value, value):
+        """Add a value to the index.
+
+        hash_value = integer hash
+        value = value to return from search(), e.g. a filename
+        """
+        entry = len(self.hashes)
+        self.hashes.append(hash_value)
+        self.values.append(value)
+        for chunkno, table in enumerate(self.tables):
+            table.setdefault(self._piece(hash_value, chunkno), []).append(entry)
+
+    def search(self, hash_value, radius):
+        """Find the values whose hashes are within a Hamming distance.
+
+        hash_value = integer hash
+        radius = maximum Hamming distance
+
+        Returns a list of (distance, value) tuples, nearest first.
+        """
+        flips = radius // len(self.tables)
+        entries = set()
+        for chunkno, table in enumerate(self.tables):
+            piece = self._piece(hash_value, chunkno)
+            for nflips in range(flips + 1):
+                for positions in itertools.combinations(range(self.chunk_bits), nflips):
+                    variant = piece
+                    for position in positions:
+                        variant ^= 1 << position
+                    entries.update(table.get(variant, ()))
+        found = []
+        for entry in entries:
+            distance = hamming(hash_value, self.hashes[entry])
+            if distance <= radius:
+                found.append((distance, self.values[entry]))
+        found.sort()
+        return found
+
+    def _piece(self, hash_value, chunkno):
+        """Get one of the pieces of a hash.
+        """
+        return (hash_value >> (chunkno * self.chunk_bits)) & ((1 << self.chunk_bits) - 1)
+
+#-------------------------------------------------------------------------------
+def dhash(image):
+    """Compute the difference hash of an image.
+
+    image = PIL image
+
+    Returns a HASH_SIZE * HASH_SIZE bit integer; each bit is whether a pixel
+    of the image (reduced to grayscale, HASH_SIZE + 1 x HASH_SIZE) is
+    brighter than its right-hand neighbour. Resizing, recompression and
+    small colour adjustments change only a few bits.
+    """
+    from PIL import Image
+    pixels = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            pos = row * (HASH_SIZE + 1) + col
+            value = value << 1 | (pixels[pos] > pixels[pos + 1])
+    return value
+
+#-------------------------------------------------------------------------------
+def fetch_images(photo_ids, workers=8, client=None, image_host=None):
+    """Download a small size of Flickr photos into the local image set.
+
+    photo_ids = iterable of Flickr photo IDs
+    workers = number of concurrent downloads
+    client = FlickrClient for the photos.getInfo calls and downloads
+             (default client if None)
+    image_host = scheme and host the images are downloaded from; default
+                 is IMAGE_HOST for the real API, or the host of the client's
+                 endpoint otherwise (e.g. a local stand-in for the API)
+
+    Images already in cache/flickrimages/ aren't downloaded again. The
+    image URL comes from photos.getInfo, which is answered from the
+    response cache (see respcache.py) for harvested photos. Returns the
+    number of images downloaded.
+    """
+    import concurrent.futures
+    import flickrclient
+    missing = [photo_id for photo_id in photo_ids
+               if not os.path.isfile(image_filename(photo_id))]
+    if not missing:
+        return 0
+    client = client or flickrclient.default_client()
+    image_host = (image_host or _image_host(client)).rstrip('/')
+
+    def download(photo_id):
+        try:
+            info = client.call('flickr.photos.getInfo', photo_id=photo_id)['photo']
+            url = '{0}/{1}/{2}_{3}_{4}.jpg'.format(
+                image_host, info['server'], photo_id, info['secret'], FLICKR_SIZE)
+            response = client.session.get(url, timeout=client.timeout)
+            response.raise_for_status()
+        except Exception as err: # pylint: disable=W0703
+            print('ERROR: could not download photo {0} - {1}'.format(
+                photo_id, type(err).__name__))
+            return False
+        filename = image_filename(photo_id)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + '.tmp', 'wb') as fhandle:
+            fhandle.write(response.content)
+        os.replace(filename + '.tmp', filename)
+        metrics.count('bytes.written', len(response.content))
+        return True
+
+    print('downloading {0} Flickr images'.format(len(missing)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(download, missing))
+
+#-------------------------------------------------------------------------------
+def hamming(hash1, hash2):
+    """Get the Hamming distance (number of differing bits) of two hashes.
+    """
+    return bin(hash1 ^ hash2).count('1')
+
+#-------------------------------------------------------------------------------
+def hash_files(filenames, workers=None, chunksize=50, store=True):
+    """Get perceptual hashes for a set of files.
+
+    filenames = iterable of full paths
+    workers = number of worker processes; default is the number of CPUs,
+              and 1 hashes everything in this process
+    chunksize = number of files sent to a worker at a time
+    store = whether to use the metadata store; if False, every file is
+            hashed and nothing is saved
+
+    Hashes already in the metadata store are not recomputed; the rest are
+    computed in parallel and saved as they arrive. Generates (filename, hash)
+    tuples for the files that could be hashed.
+    """
+    import concurrent.futures
+    workers = workers or os.cpu_count()
+    start = time.time()
+    stats = dict() # filename -> os.stat() result, for files being hashed
+    totals = {'scanned': 0, 'parsed': 0}
+
+    def hashed(results):
+        for filename, value in results:
+            if store:
+                metacache.put_value(filename, stats.pop(filename), 'phash',
+                                    '' if value is None else format(value, '016x'))
+            metrics.count('files.hashed')
+            totals['parsed'] += 1
+            if value is not None:
+                yield (filename, value)
+
+    executor = None if workers == 1 else \
+        concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    pending = set() # futures for chunks being hashed
+    chunk = []
+    for filename in filenames:
+        if store:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stored = metacache.get_value(filename, stat, 'phash')
+            metrics.cache_lookup('metacache.phash', stored is not None)
+            if stored is not None:
+                totals['scanned'] += 1
+                if stored:
+                    yield (filename, int(stored, 16))
+                continue
+            stats[filename] = stat
+        elif not os.path.isfile(filename):
+            continue
+        totals['scanned'] += 1
+        chunk.append(filename)
+        if len(chunk) < chunksize:
+            continue
+        if executor:
+            pending.add(executor.submit(_hash_chunk, chunk))
+            if len(pending) >= workers * 4:
+                # limit the number of chunks in flight; process what's done
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from hashed(future.result())
+        else:
+            yield from hashed(_hash_chunk(chunk))
+        chunk = []
+    if chunk:
+        if executor:
+            pending.add(executor.submit(_hash_chunk, chunk))
+        else:
+            yield from hashed(_hash_chunk(chunk))
+    if executor:
+        for future in concurrent.futures.as_completed(pending):
+            yield from hashed(future.result())
+        executor.shutdown()
+    if totals['parsed']:
+        tsindex.print_throughput(totals, start)
+
+#-------------------------------------------------------------------------------
+def image_filename(photo_id):
+    """Get filename for a photo in the local set of Flickr images.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/flickrimages', photo_id + '.jpg')
+
+#-------------------------------------------------------------------------------
+def image_hash(filename):
+    """Compute the perceptual hash of a photo file.
+
+    filename = a JPEG (or other format PIL can open)
+
+    Uses the embedded EXIF thumbnail if there is one (without the black
+    bars that cameras add to fit it to 160x120), or else a draft-mode
+    decode, which for a JPEG decodes at 1/8 scale or smaller. The EXIF
+    orientation is applied, so the hash matches the upright image that
+    Flickr serves. Returns the hash, or None if the file can't be decoded.
+    """
+    from PIL import Image
+    try:
+        thumbnail, orientation = exifts.exif_thumbnail(filename)
+        with Image.open(io.BytesIO(thumbnail) if thumbnail else filename) as image:
+            if thumbnail:
+                image = _trim_borders(image.convert('L'))
+            else:
+                image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+                image = image.convert('L')
+    except (OSError, SyntaxError, ValueError):
+        return None # not an image, or truncated/corrupt
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return dhash(image)
+
+#-------------------------------------------------------------------------------
+def match_unmatched(matches, index, workers=None, max_distance=6, fetch=True,
+                    image_host=None):
+    """Match the unmatched photos of a timestamp match by perceptual hash.
+
+    matches = dictionary returned by matcher.match_photos(), updated in place
+    index = timestamp index, as returned by tsindex.load_index()
+    workers = number of worker processes for hashing
+    max_distance = maximum Hamming distance for a match
+    fetch = whether to download Flickr images that aren't in the local set
+    image_host = where to download them from (see fetch_images)
+
+    Files already matched to other photos aren't considered. Each photo is
+    matched to its nearest file, nearest pairs first, one-to-one; a photo
+    whose nearest distance is shared by several files is matched but marked
+    'ambiguous'. Returns the number of photos matched.
+    """
+    unmatched = {photo_url.rstrip('/').split('/')[-1]: photo_url
+                 for photo_url, match in matches.items() if match['status'] == 'unmatched'}
+    if not unmatched:
+        return 0
+    claimed = {match['filename'] for match in matches.values() if match['filename']}
+    hashes = HashIndex()
+    for filename, value in hash_files(
+            (filename for filename in (os.path.join(index['photo_home'], relpath)
+                                       for relpath in index['filenames'])
+             if filename not in claimed), workers):
+        hashes.add(value, filename)
+
+    if fetch:
+        fetch_images(unmatched, image_host=image_host)
+    candidates = [] # (distance, photo_url, filename)
+    best_files = dict() # photo_url -> number of files at the nearest distance
+    images = {image_filename(photo_id): photo_url for photo_id, photo_url in unmatched.items()}
+    for image, value in hash_files((image for image in images if os.path.isfile(image)),
+                                   workers, store=False):
+        found = hashes.search(value, max_distance)
+        if found:
+            best_files[images[image]] = sum(1 for distance, _ in found if distance == found[0][0])
+            candidates.extend((distance, images[image], filename) for distance, filename in found)
+
+    candidates.sort()
+    assigned_files = set()
+    matched = 0
+    for distance, photo_url, filename in candidates:
+        if matches[photo_url]['status'] != 'unmatched' or filename in assigned_files:
+            continue
+        assigned_files.add(filename)
+        matches[photo_url] = {'filename': filename, 'delta': None, 'distance': distance,
+                              'status': 'ambiguous' if best_files[photo_url] > 1 else 'phash'}
+        matched += 1
+    return matched
+
+#-------------------------------------------------------------------------------
+def _hash_chunk(filenames):
+    """Hash a list of files, in a worker process.
+
+    Returns a list of (filename, hash) tuples; hash is None for files that
+    couldn't be decoded.
+    """
+    return [(filename, image_hash(filename)) for filename in filenames]
+
+#-------------------------------------------------------------------------------
+def _image_host(client):
+    """Get the host to download a client's photos from.
+
+    Returns IMAGE_HOST for the real API, or the scheme and host of the
+    client's endpoint.
+    """
+    import flickrclient
+    if client.endpoint == flickrclient.API_ENDPOINT:
+        return IMAGE_HOST
+    url = urllib.parse.urlparse(client.endpoint)
+    return '{0}://{1}'.format(url.scheme, url.netloc)
+
+#-------------------------------------------------------------------------------
+def _trim_borders(image):
+    """Crop the black bars from a letterboxed (or pillarboxed) thumbnail.
+
+    image = grayscale PIL image
+
+    Bars are only removed if they're on opposite sides and about the same
+    size, so dark areas at one edge of a photo aren't cropped.
+    """
+    bbox = image.point(lambda value: 255 if value > 16 else 0).getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    width, height = image.size
+    if left == 0 and right == width and top > 0 and abs(top - (height - bottom)) <= 2:
+        return image.crop((0, top, width, bottom))
+    if top == 0 and bottom == height and left > 0 and abs(left - (width - right)) <= 2:
+        return image.crop((left, 0, right, height))
+    return image
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Match photos by perceptual hash.')
+    PARSER.add_argument('--distance', type=int, default=6,
+                        help='maximum Hamming distance for a match (of 64 bits)')
+    PARSER.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default = # of CPUs)')
+    PARSER.add_argument('--no-fetch', action='store_true',
+                        help="don't download Flickr images; use only the local set")
+    PARSER.add_argument('--image-host', default=None,
+                        help='where to download Flickr images (default = ' + IMAGE_HOST + ')')
+    ARGS = PARSER.parse_args()
+
+    import matcher
+    INDEX = tsindex.load_index()
+    MATCHES = matcher.load_matches()
+    if not INDEX or not MATCHES:
+        print('ERROR: run tsindex.py and matcher.py first')
+        sys.exit(1)
+    print('{0} photos matched by perceptual hash'.format(
+        match_unmatched(MATCHES, INDEX, ARGS.workers, ARGS.distance, not ARGS.no_fetch,
+                        ARGS.image_host)))
+    matcher.save_matches(MATCHES)
+    matcher.print_report(MATCHES)
@@ -0,0 +1,367 @@
+""" phototable.py
+compact columnar table of the harvested Flickr photos (requires numpy)
+
+Instead of a dictionary of five strings per photo, the tag records are held
+in parallel NumPy arrays, sorted by photo ID:
+- photo_ids = int64 Flickr photo IDs
+- taken = int64 capture times, seconds since the epoch (see tsindex.py)
+- users = int16 user numbers, indexes into the interned user IDs
+- keyword_offsets/keyword_ids = each photo's keywords, as int32 indexes into
+  a shared vocabulary (photo n's keywords are keyword_ids[offsets[n]:offsets[n+1]])
+- titles, as one UTF-8 buffer plus offsets
+
+The photo_url is rebuilt from the user ID and photo ID when needed. Filters
+on date and account are vectorized, and statistics like generate_stats()
+are array operations. The keywords are normalized by the rules in
+tagrules.ini (see tagrules.py) as the records are read, so the flickr-* tags
+aren't in the table. The table is saved in cache/phototable.npz, and rebuilt
+from the tag records when they or the rules change.
+
+Usage: python phototable.py [--user USER] [--start YYYY-MM] [--end YYYY-MM]
+"""
+import argparse
+import array
+import glob
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+import tagrules
+import tagstore
+import tsindex
+
+#-------------------------------------------------------------------------------
+class PhotoTable:
+    """Columnar table of photos; see the module docstring for the columns.
+
+    Create with from_records() or load_table().
+    """
+    def __init__(self, *, photo_ids, taken, users, user_names, keyword_offsets,
+                 keyword_ids, vocabulary, title_offsets, title_text):
+        self.photo_ids = photo_ids
+        self.taken = taken
+        self.users = users
+        self.user_names = list(user_names)
+        self.keyword_offsets = keyword_offsets
+        self.keyword_ids = keyword_ids
+        self.vocabulary = list(vocabulary)
+        self.title_offsets = title_offsets
+        self.title_text = title_text
+        self.user_numbers = {user_id: userno for userno, user_id in enumerate(self.user_names)}
+        self.keyword_numbers = {keyword: wordno for wordno, keyword
+                                in enumerate(self.vocabulary)}
+        # photo number of each entry in keyword_ids
+        self.keyword_photos = np.repeat(np.arange(len(photo_ids), dtype=np.int32),
+                                        np.diff(keyword_offsets))
+
+    def __len__(self):
+        return len(self.photo_ids)
+
+    @classmethod
+    def from_records(cls, records):
+        """Build a table from tag records, in one streaming pass.
+
+        records = iterable of tag records (dictionaries); if a photo ID
+                  appears more than once, the last record is used
+        """
+        photo_ids, taken, users = array.array('q'), array.array('q'), array.array('h')
+        keyword_counts, keyword_ids = array.array('q'), array.array('q')
+        title_lengths = array.array('q')
+        titles = []
+        user_numbers, keyword_numbers = dict(), dict()
+        for record in records:
+            photo_ids.append(tagstore.photo_id(record))
+            taken.append(tsindex.ts_to_epoch(record['taken']))
+            users.append(user_numbers.setdefault(record['user_id'], len(user_numbers)))
+            keyword_counts.append(len(record['keywords']))
+            for keyword in record['keywords']:
+                keyword_ids.append(keyword_numbers.setdefault(keyword, len(keyword_numbers)))
+            title = record['title'].encode('utf-8')
+            titles.append(title)
+            title_lengths.append(len(title))
+
+        photo_ids = np.frombuffer(photo_ids, dtype=np.int64)
+        keyword_counts = np.frombuffer(keyword_counts, dtype=np.int64)
+        keyword_offsets = np.concatenate(([0], np.cumsum(keyword_counts)))
+        keyword_ids = np.frombuffer(keyword_ids, dtype=np.int64).astype(np.int32)
+        title_lengths = np.frombuffer(title_lengths, dtype=np.int64)
+        title_offsets = np.concatenate(([0], np.cumsum(title_lengths)))
+        title_text = np.frombuffer(b''.join(titles), dtype=np.uint8)
+
+        # sort by photo ID, keeping the last record for any duplicate ID
+        order = np.argsort(photo_ids, kind='stable')
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = photo_ids[order][1:] != photo_ids[order][:-1]
+        order = order[last]
+
+        table = cls(photo_ids=photo_ids[order],
+                    taken=np.frombuffer(taken, dtype=np.int64)[order],
+                    users=np.frombuffer(users, dtype=np.int16)[order],
+                    user_names=list(user_numbers),
+                    keyword_offsets=np.concatenate(([0], np.cumsum(keyword_counts[order]))),
+                    keyword_ids=_gather(keyword_ids, keyword_offsets, order),
+                    vocabulary=list(keyword_numbers),
+                    title_offsets=np.concatenate(([0], np.cumsum(title_lengths[order]))),
+                    title_text=_gather(title_text, title_offsets, order))
+        return table
+
+    def keyword_counts(self, mask=None):
+        """Count keyword occurrences.
+
+        mask = optional boolean array selecting photos (see select())
+
+        Returns an array of counts, indexed by vocabulary number.
+        """
+        keyword_ids = self.keyword_ids if mask is None else \
+            self.keyword_ids[mask[self.keyword_photos]]
+        return np.bincount(keyword_ids, minlength=len(self.vocabulary))
+
+    def month_numbers(self):
+        """Get each photo's capture month, as months since January 1970.
+        """
+        return self.taken.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+
+    def monthly_totals(self, mask=None):
+        """Count photos and keywords per user and month.
+
+        mask = optional boolean array selecting photos
+
+        Returns a dictionary of user ID -> 'YYYY-MM' -> {'photos', 'keywords'},
+        with the same values as the photos/keywords totals in rollups.py.
+        """
+        months = self.month_numbers()
+        first = int(months.min()) if len(months) else 0
+        nmonths = int(months.max()) - first + 1 if len(months) else 0
+        cells = self.users.astype(np.int64) * nmonths + (months - first)
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        photos = np.bincount(cells[mask], minlength=len(self.user_names) * nmonths)
+        keep = mask[self.keyword_photos]
+        keywords = np.bincount(cells[self.keyword_photos[keep]],
+                               minlength=len(self.user_names) * nmonths)
+
+        totals = dict()
+        for cell in np.flatnonzero(photos):
+            userno, monthno = divmod(int(cell), nmonths)
+            year, month = divmod(first + monthno, 12)
+            totals.setdefault(self.user_names[userno], dict())[
+                '{0}-{1:02}'.format(1970 + year, month + 1)] = \
+                {'photos': int(photos[cell]), 'keywords': int(keywords[cell])}
+        return totals
+
+    def record(self, photono):
+        """Get a photo as a tag record (dictionary), as written to the cache.
+        """
+        user_id = self.user_names[self.users[photono]]
+        first, last = self.keyword_offsets[photono], self.keyword_offsets[photono + 1]
+        title_first, title_last = self.title_offsets[photono], self.title_offsets[photono + 1]
+        return {'user_id': user_id,
+                'title': self.title_text[title_first:title_last].tobytes().decode('utf-8'),
+                'taken': tsindex.epoch_to_ts(int(self.taken[photono])),
+                'keywords': [self.vocabulary[wordno] for wordno
+                             in self.keyword_ids[first:last]],
+                'photo_url': 'http://flickr.com/photos/' + user_id + '/' +
+                             str(self.photo_ids[photono])}
+
+    def select(self, start=None, end=None, user_id=None):
+        """Select photos by capture date and account.
+
+        start/end = optional first/last date, 'YYYY-MM', 'YYYY-MM-DD' or
+                    'YYYY-MM-DD HH:MM:SS' (inclusive)
+        user_id = optional Flickr user ID
+
+        Returns a boolean array, True for the selected photos.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if start:
+            mask &= self.taken >= _epoch(start, last=False)
+        if end:
+            mask &= self.taken <= _epoch(end, last=True)
+        if user_id:
+            mask &= self.users == self.user_numbers.get(user_id, -1)
+        return mask
+
+    def summarize(self, users, start=None, end=None):
+        """Summarize photos and tags, like rollups.summarize().
+
+        users = list of Flickr user IDs
+        start/end = optional first/last month to include, 'YYYY-MM'
+
+        Returns a dictionary with these keys:
+        photos = dictionary of user ID -> number of photos
+        tags = dictionary of user ID -> number of keywords
+        tagcounts = dictionary of keyword -> count
+        """
+        mask = self.select(start, end)
+        tags_per_photo = np.diff(self.keyword_offsets)
+        summary = {'photos': dict(), 'tags': dict()}
+        selected = np.zeros(len(self), dtype=bool)
+        for user_id in users:
+            usermask = mask & (self.users == self.user_numbers.get(user_id, -1))
+            selected |= usermask
+            summary['photos'][user_id] = int(usermask.sum())
+            summary['tags'][user_id] = int(tags_per_photo[usermask].sum())
+        counts = self.keyword_counts(selected)
+        summary['tagcounts'] = {self.vocabulary[wordno]: int(counts[wordno])
+                                for wordno in np.flatnonzero(counts)}
+        return summary
+
+    def top_keywords(self, count=20, mask=None):
+        """Get the most common keywords.
+
+        Returns a list of (keyword, count) tuples, most common first.
+        """
+        counts = self.keyword_counts(mask)
+        top = np.argsort(-counts, kind='stable')[:count]
+        return [(self.vocabulary[wordno], int(counts[wordno])) for wordno in top
+                if counts[wordno]]
+
+#-------------------------------------------------------------------------------
+def join_strings(strings):
+    """Encode a list of strings as a uint8 array (newline-separated UTF-8).
+    """
+    return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+#-------------------------------------------------------------------------------
+def load_table(filename=None):
+    """Load the saved photo table, building it first if necessary.
+
+    filename = optional filename; default is cache/phototable.npz
+
+    The table is rebuilt from all of the tag records (from the consolidated
+    store if it exists, otherwise from the tags pages), with normalized
+    keywords, if it hasn't been saved, or if the tag records or the
+    normalization rules have changed since it was saved.
+    """
+    filename = filename or table_filename()
+    if tagstore.store_exists():
+        sources = [tagstore.store_filename()]
+    else:
+        sources = glob.glob(os.path.join(os.path.dirname(tagstore.store_filename()),
+                                         '*-tags-*.json'))
+    if os.path.isfile(tagrules.rules_filename()):
+        sources.append(tagrules.rules_filename())
+    if os.path.isfile(filename) and \
+        all(os.path.getmtime(source) <= os.path.getmtime(filename) for source in sources):
+        with np.load(filename) as arrays:
+            columns = {name: arrays[name] for name in arrays.files}
+        columns['user_names'] = split_strings(columns['user_names'])
+        columns['vocabulary'] = split_strings(columns['vocabulary'])
+        return PhotoTable(**columns)
+
+    if tagstore.store_exists():
+        records = tagstore.read_records()
+    else:
+        records = itertools.chain.from_iterable(_read_page(source) for source in sorted(sources)
+                                                if source.endswith('.json'))
+    table = PhotoTable.from_records(tagrules.default_rules().apply(records))
+    save_table(table, filename)
+    return table
+
+#-------------------------------------------------------------------------------
+def save_table(table, filename=None):
+    """Save a photo table to disk.
+
+    table = PhotoTable
+    filename = optional filename; default is cache/phototable.npz
+    """
+    filename = filename or table_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename + '.tmp', 'wb') as fhandle:
+        np.savez(fhandle, photo_ids=table.photo_ids, taken=table.taken, users=table.users,
+                 user_names=join_strings(table.user_names),
+                 keyword_offsets=table.keyword_offsets, keyword_ids=table.keyword_ids,
+                 vocabulary=join_strings(table.vocabulary),
+                 title_offsets=table.title_offsets, title_text=table.title_text)
+    os.replace(filename + '.tmp', filename)
+
+#-------------------------------------------------------------------------------
+def split_strings(encoded):
+    """Decode a uint8 array created by join_strings() to a list of strings.
+    """
+    text = encoded.tobytes().decode('utf-8')
+    return text.split('\n') if text else []
+
+#-------------------------------------------------------------------------------
+def table_filename():
+    """Get filename for the saved photo table.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/phototable.npz')
+
+#-------------------------------------------------------------------------------
+def _epoch(date, last):
+    """Convert a date prefix to epoch seconds.
+
+    date = 'YYYY-MM', 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+    last = if True, the last second of the month/day; else the first second
+    """
+    if len(date) == 7:
+        if not last:
+            return tsindex.ts_to_epoch(date + '-01 00:00:00')
+        year, month = int(date[:4]), int(date[5:7])
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return tsindex.ts_to_epoch('{0}-{1:02}-01 00:00:00'.format(year, month)) - 1
+    if len(date) == 10:
+        return tsindex.ts_to_epoch(date + (' 23:59:59' if last else ' 00:00:00'))
+    return tsindex.ts_to_epoch(date)
+
+#-------------------------------------------------------------------------------
+def _gather(values, offsets, order):
+    """Reorder variable-length rows of a flattened array.
+
+    values = flattened array of all rows
+    offsets = row n is values[offsets[n]:offsets[n + 1]]
+    order = row numbers, in the new order
+
+    Returns the flattened array of the rows in the new order.
+    """
+    lengths = offsets[1:] - offsets[:-1]
+    starts = offsets[:-1][order]
+    counts = lengths[order]
+    if not counts.sum():
+        return values[:0]
+    # index of each output element = its row's start + its position in the row
+    row_starts = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return values[row_starts + np.arange(counts.sum())]
+
+#-------------------------------------------------------------------------------
+def _read_page(filename):
+    """Read the tag records from a <user>-tags-*.json file.
+    """
+    with open(filename, 'r') as fhandle:
+        return json.loads(fhandle.read())
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Columnar table of Flickr photos.')
+    PARSER.add_argument('--user', action='append', help='Flickr user ID (repeatable)')
+    PARSER.add_argument('--start', help='first month, YYYY-MM')
+    PARSER.add_argument('--end', help='last month, YYYY-MM')
+    ARGS = PARSER.parse_args()
+
+    import flickrtags
+    USERS = ARGS.user or flickrtags.USERS
+    START = time.perf_counter()
+    TABLE = load_table()
+    print('{0} photos loaded in {1:.3f} seconds'.format(len(TABLE),
+                                                      time.perf_counter() - START))
+    print('{0:,} bytes of arrays'.format(sum(
+        column.nbytes for column in [TABLE.photo_ids, TABLE.taken, TABLE.users,
+                                     TABLE.keyword_offsets, TABLE.keyword_ids,
+                                     TABLE.title_offsets, TABLE.title_text])))
+    START = time.perf_counter()
+    SUMMARY = TABLE.summarize(USERS, ARGS.start, ARGS.end)
+    for USER_ID in USERS:
+        print('{0} = {1} photos, {2} tags total'.format(
+            USER_ID, SUMMARY['photos'][USER_ID], SUMMARY['tags'][USER_ID]))
+    MASK = TABLE.select(ARGS.start, ARGS.end) & np.isin(
+        TABLE.users, [TABLE.user_numbers.get(USER_ID, -1) for USER_ID in USERS])
+    for TAG, COUNT in TABLE.top_keywords(20, MASK):
+        print(TAG, COUNT)
+    print('summarized in {0:.3f} seconds'.format(time.perf_counter() - START))
@@ -0,0 +1,390 @@
+""" phototag.py
+command-line entry point for harvesting, indexing, matching and searching
+
+Each subcommand imports only the modules it needs, so local commands like
+stats and search don't pay for loading the HTTP stack or the process pool.
+
+Usage: python phototag.py harvest <user_id> [--bulk] [--workers 8] [--offline]
+       python phototag.py sync [<user_id> ...]
+       python phototag.py queue add|work|status|retry [<user_id> ...] [--app APP ...]
+       python phototag.py stats [--user USER] [--start YYYY-MM] [--end YYYY-MM]
+       python phototag.py index <photo_home> [--refresh] [--watch] [--workers N]
+       python phototag.py index --tags
+       python phototag.py offsets [--max-offset 14400] [--resolution 2]
+       python phototag.py match [--window 8] [--offsets] [--phash]
+       python phototag.py writeback [--format xmp|txt] [--ambiguous] [--dry-run]
+       python phototag.py related <tag> [--count 10]
+       python phototag.py suggest [<tag> ...] [--date YYYY[-MM[-DD]]] [--count 10]
+       python phototag.py search <query> [--start DATE] [--end DATE] [--user USER]
+                                         [--files]
+       python phototag.py serve [--port 8080] [--host 127.0.0.1]
+Add --metrics before the subcommand to record timers in cache/metrics.json.
+"""
+import argparse
+import os
+import sys
+
+#-------------------------------------------------------------------------------
+def cmd_harvest(args):
+    """Harvest all tag data for a user's photostream.
+    """
+    if args.bulk:
+        import flickrtags
+        flickrtags.cache_photostream(args.user_id, bulk=True, raw_tags=args.raw_tags)
+        return 0
+    import harvest
+    return 1 if harvest.harvest(args.user_id, app=args.app, workers=args.workers,
+                                calls_per_hour=args.calls_per_hour, endpoint=args.endpoint,
+                                offline=args.offline) else 0
+
+#-------------------------------------------------------------------------------
+def cmd_index(args):
+    """Build or update the timestamp index, or build the tag index.
+    """
+    if args.tags:
+        import itertools
+        import flickrtags
+        import tagindex
+        print('{0} photos indexed'.format(tagindex.build_index(itertools.chain.from_iterable(
+            flickrtags.tag_records(user_id) for user_id in flickrtags.USERS))))
+        return 0
+
+    if not args.photo_home:
+        print('ERROR: photo_home is required (or use --tags)')
+        return 1
+    import tsindex
+    index = tsindex.load_index() if args.refresh or args.watch else None
+    if index and index['photo_home'] == args.photo_home:
+        print('{0} folders rescanned, {1} removed'.format(
+            *tsindex.refresh_index(index, workers=args.workers)))
+    else:
+        index = tsindex.build_index(args.photo_home, workers=args.workers)
+    tsindex.save_index(index)
+    if args.watch:
+        try:
+            tsindex.watch_index(index, workers=args.workers or 1)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_match(args):
+    """Match Flickr photos to files in the photo backups.
+    """
+    import flickrtags
+    import matcher
+    import tsindex
+    index = tsindex.load_index()
+    if not index:
+        print('ERROR: no timestamp index; run phototag.py index first')
+        return 1
+    if args.offsets:
+        import clockoffset
+        index = clockoffset.apply_offsets(index)
+    records = [record for user_id in flickrtags.USERS
+               for record in flickrtags.tag_records(user_id)]
+    matches = matcher.match_photos(records, index, args.window)
+    if args.phash:
+        import phash
+        print('{0} photos matched by perceptual hash'.format(
+            phash.match_unmatched(matches, index, max_distance=args.distance,
+                                  image_host=args.image_host)))
+    matcher.save_matches(matches)
+    matcher.print_report(matches)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_offsets(args):
+    """Detect per-camera clock offsets between the backups and Flickr.
+    """
+    import numpy as np
+    import clockoffset
+    import phototable
+    import tsindex
+    index = tsindex.load_index()
+    if not index:
+        print('ERROR: no timestamp index; run phototag.py index first')
+        return 1
+    models, modelnos = clockoffset.camera_models(index)
+    offsets = clockoffset.detect_offsets(
+        phototable.load_table().taken, np.array(index['timestamps'], dtype=np.int64),
+        models, modelnos, args.max_offset, args.resolution)
+    clockoffset.print_offsets(offsets)
+    clockoffset.save_offsets(offsets)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_queue(args):
+    """Add accounts to the harvest work queue, run workers, or show status.
+    """
+    import flickrtags
+    import workqueue
+    queue = workqueue.WorkQueue(args.queue)
+    if args.action == 'add':
+        for user_id in args.user_id or flickrtags.USERS:
+            print('{0}: {1}'.format(user_id, 'queued' if queue.add_user(user_id, args.bulk)
+                                    else 'already queued'))
+    elif args.action == 'work':
+        if not args.app:
+            print('ERROR: queue work needs at least one --app')
+            return 1
+        workqueue.run_workers(args.app, filename=args.queue, endpoint=args.endpoint,
+                              threads=args.threads, calls_per_hour=args.calls_per_hour,
+                              lease_seconds=args.lease)
+    elif args.action == 'retry':
+        print('{0} failed units queued again'.format(queue.retry_failed()))
+    else:
+        workqueue.print_status(queue)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_related(args):
+    """Print the tags that most often appear with a tag.
+    """
+    import cooccur
+    for tag, together, score in cooccur.load_matrix().related(args.tag, args.count):
+        print('{0:30} {1:6} photos  {2:.3f}'.format(tag, together, score))
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_search(args):
+    """Search the tag index.
+    """
+    import tagindex
+    if not os.path.isfile(tagindex.index_filename()):
+        print('ERROR: no tag index; run phototag.py index --tags first')
+        return 1
+    index = tagindex.TagIndex()
+    matches = dict()
+    if args.files:
+        import matcher
+        matches = matcher.load_matches()
+    try:
+        docnos = index.search(args.query, args.start, args.end, args.user)
+    except ValueError as err:
+        print('ERROR: ' + str(err))
+        return 1
+    for docno in docnos:
+        photo = index.photo(docno)
+        line = photo['taken'] + ' ' + photo['photo_url']
+        if args.files:
+            line += ' ' + str((matches.get(photo['photo_url']) or dict()).get('filename'))
+        print(line)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_serve(args):
+    """Run the local HTTP search service.
+    """
+    import searchserver
+    searchserver.serve(args.host, args.port, args.cache_size, args.reload_interval)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_stats(args):
+    """Print statistics from the cached tag data.
+    """
+    import flickrtags
+    months = dict()
+    if args.start:
+        months['start'] = args.start
+    if args.end:
+        months['end'] = args.end
+    flickrtags.generate_stats(args.user or flickrtags.USERS, **months)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_suggest(args):
+    """Suggest tags for a photo, from its tags and capture date.
+    """
+    import cooccur
+    try:
+        suggested = cooccur.load_matrix().suggest(args.tags, args.date, args.count)
+    except ValueError as err:
+        print('ERROR: {0}'.format(err))
+        return 1
+    for tag, score in suggested:
+        print('{0:30} {1:.3f}'.format(tag, score))
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_sync(args):
+    """Retrieve tag data for photos uploaded since the last sync.
+    """
+    import flickrtags
+    for user_id in args.user_id or flickrtags.USERS:
+        flickrtags.sync_photostream(user_id, raw_tags=args.raw_tags)
+    return 0
+
+#-------------------------------------------------------------------------------
+def cmd_writeback(args):
+    """Write the matched photos' keywords to sidecar files next to the originals.
+    """
+    import itertools
+    import flickrtags
+    import matcher
+    import tagrules
+    import writeback
+    matches = matcher.load_matches()
+    if not matches:
+        print('ERROR: no saved matches; run phototag.py match first')
+        return 1
+    statuses = writeback.WRITE_STATUSES + (['ambiguous'] if args.ambiguous else [])
+    keywords = writeback.file_keywords(matches, itertools.chain.from_iterable(
+        flickrtags.tag_records(user_id, normalize=False) for user_id in flickrtags.USERS),
+                                         statuses, tagrules.load_rules(args.rules))
+    totals = writeback.write_keywords(keywords, args.format, args.workers, args.dry_run)
+    print('{0} sidecars: {1} written, {2} merged, {3} removed, {4} unchanged, {5} foreign, '
+          '{6} errors'.format(sum(totals.values()), totals['written'], totals['merged'],
+                              totals['removed'], totals['unchanged'], totals['foreign'],
+                              totals['error']))
+    return 0
+
+#-------------------------------------------------------------------------------
+def main(argv=None):
+    """Parse the command line and run a subcommand.
+
+    argv = list of arguments; default is sys.argv[1:]
+
+    Returns the exit status.
+    """
+    parser = argparse.ArgumentParser(description='Photo keyword tools.')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record timers/counters in cache/metrics.json')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('harvest', help='harvest tags for a Flickr user')
+    subparser.add_argument('user_id', help='Flickr user ID')
+    subparser.add_argument('--bulk', action='store_true',
+                           help='get normalized tags with the photostream, 500 photos '
+                           'per call (see --raw-tags)')
+    subparser.add_argument('--raw-tags', action='store_true',
+                           help='in bulk mode, get raw tags with photos.getInfo')
+    subparser.add_argument('--app', default='dougerino-jamiesearcher',
+                           help='section of ../_private/flickr.ini with the API key')
+    subparser.add_argument('--workers', type=int, default=8,
+                           help='number of concurrent API calls')
+    subparser.add_argument('--calls-per-hour', type=int, default=3600, help='API quota')
+    subparser.add_argument('--endpoint', default=None,
+                           help='Flickr REST API endpoint (default = the real API)')
+    subparser.add_argument('--offline', action='store_true',
+                           help='use only cached API responses (no API calls)')
+    subparser.set_defaults(func=cmd_harvest)
+
+    subparser = subparsers.add_parser('sync', help='get tags for new uploads')
+    subparser.add_argument('user_id', nargs='*', help='Flickr user IDs (default = all)')
+    subparser.add_argument('--raw-tags', action='store_true',
+                           help='get raw tags with photos.getInfo')
+    subparser.set_defaults(func=cmd_sync)
+
+    subparser = subparsers.add_parser('queue', help='harvest with several workers')
+    subparser.add_argument('action', choices=['add', 'work', 'status', 'retry'])
+    subparser.add_argument('user_id', nargs='*', help='for add: Flickr user IDs (default = all)')
+    subparser.add_argument('--bulk', action='store_true',
+                           help='for add: get normalized tags with the photostream, '
+                           '500 photos per call')
+    subparser.add_argument('--app', action='append',
+                           help='for work: section of ../_private/flickr.ini with an API key '
+                           '(repeatable; one worker process per key)')
+    subparser.add_argument('--threads', type=int, default=8,
+                           help='for work: concurrent API calls per worker')
+    subparser.add_argument('--calls-per-hour', type=int, default=3600,
+                           help='for work: API quota of each key')
+    subparser.add_argument('--lease', type=int, default=300,
+                           help='for work: seconds a claim lasts if not renewed')
+    subparser.add_argument('--endpoint', default=None,
+                           help='for work: Flickr REST API endpoint (default = the real API)')
+    subparser.add_argument('--queue', default=None,
+                           help='queue database (default = cache/workqueue.db)')
+    subparser.set_defaults(func=cmd_queue)
+
+    subparser = subparsers.add_parser('stats', help='print photo/tag statistics')
+    subparser.add_argument('--user', action='append', help='Flickr user ID (repeatable)')
+    subparser.add_argument('--start', help='first month, YYYY-MM')
+    subparser.add_argument('--end', help='last month, YYYY-MM')
+    subparser.set_defaults(func=cmd_stats)
+
+    subparser = subparsers.add_parser('index', help='build the timestamp or tag index')
+    subparser.add_argument('photo_home', nargs='?', help='root folder of the photo backups')
+    subparser.add_argument('--tags', action='store_true',
+                           help='build the tag index instead of the timestamp index')
+    subparser.add_argument('--refresh', action='store_true',
+                           help='rescan only changed folders of the saved index')
+    subparser.add_argument('--watch', action='store_true',
+                           help='keep the index updated as files change (Linux)')
+    subparser.add_argument('--workers', type=int, default=None,
+                           help='number of worker processes (default = # of CPUs)')
+    subparser.set_defaults(func=cmd_index)
+
+    subparser = subparsers.add_parser('match', help='match Flickr photos to backup files')
+    subparser.add_argument('--window', type=int, default=8,
+                           help='maximum seconds between timestamps for a near match')
+    subparser.add_argument('--offsets', action='store_true',
+                           help='apply the clock offsets saved by the offsets command')
+    subparser.add_argument('--phash', action='store_true',
+                           help='match the remaining photos by perceptual hash')
+    subparser.add_argument('--distance', type=int, default=6,
+                           help='maximum Hamming distance for a perceptual hash match')
+    subparser.add_argument('--image-host', default=None,
+                           help='where to download Flickr images for --phash '
+                           '(default = https://live.staticflickr.com)')
+    subparser.set_defaults(func=cmd_match)
+
+    subparser = subparsers.add_parser('offsets', help='detect per-camera clock offsets')
+    subparser.add_argument('--max-offset', type=int, default=14400,
+                           help='largest offset to look for, in seconds')
+    subparser.add_argument('--resolution', type=int, default=2,
+                           help='histogram bin width, in seconds')
+    subparser.set_defaults(func=cmd_offsets)
+
+    subparser = subparsers.add_parser('writeback', help='write keywords next to the originals')
+    subparser.add_argument('--format', choices=['xmp', 'txt'], default='xmp',
+                           help='XMP sidecars or *-keyword.txt files')
+    subparser.add_argument('--workers', type=int, default=8, help='number of writer threads')
+    subparser.add_argument('--ambiguous', action='store_true',
+                           help='also write keywords for ambiguous matches')
+    subparser.add_argument('--dry-run', action='store_true',
+                           help="count the files that would change, but don't write them")
+    subparser.add_argument('--rules', default=None,
+                           help='keyword normalization rules (default = tagrules.ini)')
+    subparser.set_defaults(func=cmd_writeback)
+
+    subparser = subparsers.add_parser('related', help='tags that appear with a tag')
+    subparser.add_argument('tag', help='a tag')
+    subparser.add_argument('--count', type=int, default=10, help='number of tags to show')
+    subparser.set_defaults(func=cmd_related)
+
+    subparser = subparsers.add_parser('suggest', help='suggest tags for a photo')
+    subparser.add_argument('tags', nargs='*', help="the photo's existing tags")
+    subparser.add_argument('--date', help='capture date, YYYY[-MM[-DD]]')
+    subparser.add_argument('--count', type=int, default=10, help='number of tags to show')
+    subparser.set_defaults(func=cmd_suggest)
+
+    subparser = subparsers.add_parser('search', help='search the tag index')
+    subparser.add_argument('query', help="e.g. 'dog AND (beach OR park) NOT snow', 'sea*'")
+    subparser.add_argument('--start', help='earliest taken date, YYYY-MM-DD')
+    subparser.add_argument('--end', help='latest taken date, YYYY-MM-DD')
+    subparser.add_argument('--user', help='Flickr user ID')
+    subparser.add_argument('--files', action='store_true',
+                           help='include the matched local file (see match)')
+    subparser.set_defaults(func=cmd_search)
+
+    subparser = subparsers.add_parser('serve', help='run the local HTTP search service')
+    subparser.add_argument('--host', default='127.0.0.1',
+                           help='interface to listen on (0.0.0.0 = all)')
+    subparser.add_argument('--port', type=int, default=8080)
+    subparser.add_argument('--cache-size', type=int, default=1024,
+                           help='number of queries kept in the LRU cache')
+    subparser.add_argument('--reload-interval', type=float, default=5.0,
+                           help='seconds between checks for changed tag data')
+    subparser.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        import metrics
+        metrics.enable()
+    return args.func(args)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    sys.exit(main())
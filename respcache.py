@@ -0,0 +1,258 @@
+""" respcache.py
+on-disk cache of Flickr API responses
+
+Every successful API call made through a FlickrClient (see flickrclient.py)
+is saved, zlib-compressed, in a local SQLite database (cache/responses.db),
+keyed by the method and parameters (not including the API key), and by the
+endpoint if it isn't the real API (e.g. fakeflickr.py). A repeated
+call is answered from the cache without using any API quota, so tag records
+can be re-derived from the raw photos.getInfo payloads locally, e.g. after
+an interrupted harvest or a change to the record format.
+
+Each method has a time-to-live (photostream pages change when photos are
+uploaded, and photo details when tags are edited on Flickr), and the least
+recently used responses are evicted when the cache exceeds its size limit.
+In offline mode, expired responses are still used, and a call that isn't in
+the cache raises NotCached instead of going to Flickr.
+
+Usage: python respcache.py stats|clear|evict
+"""
+import atexit
+import functools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import metrics
+
+# seconds that a response is valid, by method; None = never expires, 0 = not cached
+DEFAULT_TTL = {'flickr.photos.getInfo': 30 * 86400,
+               'flickr.people.getPhotos': 3600}
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+
+#-------------------------------------------------------------------------------
+class NotCached(LookupError):
+    """An API call wasn't in the cache, and the cache is in offline mode.
+    """
+    pass
+
+#-------------------------------------------------------------------------------
+class ResponseCache:
+    """Compressed, size-limited cache of API responses.
+
+    filename = SQLite database; default is cache/responses.db
+    ttl = dictionary of method -> seconds a response is valid (None = never
+          expires, 0 = don't cache); methods not listed are never cached
+    max_bytes = maximum total size of the compressed responses
+    offline = if True, get() raises NotCached instead of returning None
+    commit_every = number of writes between commits; use 1 when processes
+                   share the cache, since other processes can't write while
+                   a commit is pending
+
+    Can be shared by the threads of a harvest.
+    """
+    def __init__(self, filename=None, *, ttl=None, max_bytes=DEFAULT_MAX_BYTES,
+                 offline=False, commit_every=100):
+        self.filename = filename or cache_filename()
+        self.ttl = dict(DEFAULT_TTL if ttl is None else ttl)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.pending = 0 # number of uncommitted writes
+        self.commit_every = commit_every
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(key TEXT PRIMARY KEY, method TEXT, created REAL, '
+                                'accessed REAL, size INTEGER, body BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS accessed ON responses(accessed)')
+        self.total_bytes = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def cacheable(self, method):
+        """Determine whether responses for a method are cached.
+        """
+        return self.ttl.get(method, 0) != 0
+
+    def clear(self, method=None):
+        """Delete all cached responses, or those for one method.
+        """
+        with self.lock:
+            if method:
+                self.connection.execute('DELETE FROM responses WHERE method=?', (method,))
+            else:
+                self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+            self.pending = 0
+            self.total_bytes = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.connection.execute('VACUUM')
+
+    def close(self):
+        """Commit any pending writes and close the database.
+        """
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def evict(self, max_bytes=None):
+        """Delete least recently used responses until the total size is under
+        a limit.
+
+        max_bytes = size limit; default is the cache's max_bytes
+
+        Returns the number of responses deleted.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        deleted = 0
+        with self.lock:
+            if self.total_bytes <= max_bytes:
+                return 0
+            # evict down to 90% of the limit, so that eviction isn't needed
+            # again on the next write
+            target = max_bytes * 0.9
+            rows = self.connection.execute(
+                'SELECT key, size FROM responses ORDER BY accessed')
+            victims = []
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                victims.append((key,))
+                self.total_bytes -= size
+            self.connection.executemany('DELETE FROM responses WHERE key=?', victims)
+            self.connection.commit()
+            self.pending = 0
+            deleted = len(victims)
+        metrics.count('respcache.evicted', deleted)
+        return deleted
+
+    def get(self, method, params, endpoint=None):
+        """Look up a cached response.
+
+        method = API method, e.g. 'flickr.photos.getInfo'
+        params = dictionary of API call parameters
+        endpoint = URL of the API, if it isn't the real Flickr API
+
+        Returns the payload (dictionary), or None if there's no valid cached
+        response. In offline mode, raises NotCached instead of returning None.
+        """
+        if self.cacheable(method):
+            key = cache_key(method, params, endpoint)
+            now = time.time()
+            with self.lock:
+                row = self.connection.execute(
+                    'SELECT created, body FROM responses WHERE key=?', (key,)).fetchone()
+                ttl = self.ttl.get(method)
+                if row and (ttl is None or self.offline or now - row[0] <= ttl):
+                    self.connection.execute('UPDATE responses SET accessed=? WHERE key=?',
+                                            (now, key))
+                    self._written()
+                    metrics.cache_lookup('respcache', True)
+                    return json.loads(zlib.decompress(row[1]))
+            metrics.cache_lookup('respcache', False)
+        if self.offline:
+            raise NotCached('{0} {1} is not in the response cache'.format(
+                method, json.dumps(_cached_params(params), sort_keys=True)))
+        return None
+
+    def put(self, method, params, payload, endpoint=None):
+        """Save a response in the cache.
+
+        method = API method
+        params = dictionary of API call parameters
+        payload = the response (dictionary)
+        endpoint = URL of the API, if it isn't the real Flickr API
+        """
+        if not self.cacheable(method):
+            return
+        key = cache_key(method, params, endpoint)
+        body = zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM responses WHERE key=?',
+                                          (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                    (key, method, now, now, len(body), body))
+            self.total_bytes += len(body) - (row[0] if row else 0)
+            self._written()
+        metrics.count('bytes.respcache', len(body))
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def stats(self):
+        """Get the number of responses and compressed bytes for each method.
+
+        Returns a dictionary of method -> (responses, bytes).
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT method, COUNT(*), SUM(size) FROM responses GROUP BY method').fetchall()
+        return {method: (count, size) for method, count, size in rows}
+
+    def _written(self):
+        """Count a write, and commit periodically. Caller holds the lock.
+        """
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.connection.commit()
+            self.pending = 0
+
+#-------------------------------------------------------------------------------
+def cache_filename():
+    """Get filename for the response cache database.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/responses.db')
+
+#-------------------------------------------------------------------------------
+def cache_key(method, params, endpoint=None):
+    """Get the cache key for an API call.
+
+    method = API method
+    params = dictionary of API call parameters; the API key and the response
+             format parameters are ignored
+    endpoint = URL of the API, if it isn't the real Flickr API; responses
+               from other endpoints (e.g. fakeflickr.py) get different keys
+
+    Returns a string, the same for any order of the parameters.
+    """
+    key = method + '?' + json.dumps(_cached_params(params), sort_keys=True,
+                                    separators=(',', ':'))
+    return endpoint + ' ' + key if endpoint else key
+
+#-------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def default_cache():
+    """Get the shared response cache (cache/responses.db), opened on the
+    first call and closed at exit.
+    """
+    cache = ResponseCache()
+    atexit.register(cache.close)
+    return cache
+
+#-------------------------------------------------------------------------------
+def _cached_params(params):
+    """Get the parameters that identify an API call's response.
+    """
+    return {name: str(value) for name, value in params.items()
+            if name not in ('api_key', 'method', 'format', 'nojsoncallback')}
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('stats', 'clear', 'evict'):
+        print('Usage: python respcache.py stats|clear|evict')
+        sys.exit(1)
+
+    CACHE = ResponseCache()
+    if sys.argv[1] == 'clear':
+        CACHE.clear()
+    elif sys.argv[1] == 'evict':
+        print('{0} responses evicted'.format(CACHE.evict()))
+    for METHOD, (COUNT, SIZE) in sorted(CACHE.stats().items()):
+        print('{0:30} {1:8,} responses {2:14,} bytes'.format(METHOD, COUNT, SIZE))
+    CACHE.close()
@@ -0,0 +1,174 @@
+""" rollups.py
+per-user, per-month rollups of the Flickr tag data
+
+Photo and tag counts are aggregated by user and month (of the 'taken' date)
+in a single streaming pass over the tag records, and saved in
+cache/rollups.json. The keywords are counted after normalization (see
+tagrules.py), so the flickr-* tags aren't counted. When tag records are
+harvested or replaced, the rollups are updated incrementally, so statistics
+for any date range or account come from the rollups without rescanning the
+cache. They're rebuilt if tagrules.ini changes.
+
+Usage: python rollups.py rebuild
+       python rollups.py summary [--user USER] [--start YYYY-MM] [--end YYYY-MM]
+"""
+import argparse
+from collections import Counter
+import itertools
+import json
+import os
+
+import tagrules
+
+#-------------------------------------------------------------------------------
+def apply_records(rollups, records, sign=1):
+    """Add tag records to rollups (or subtract them).
+
+    rollups = dictionary of user ID -> month -> totals
+    records = iterable of tag records (dictionaries), with normalized
+              keywords (see flickrtags.tag_records())
+    sign = 1 to add the records, -1 to subtract them
+
+    The totals for each month are a dictionary with these keys:
+    photos = number of photos
+    keywords = number of keywords
+    tagcounts = dictionary of keyword -> count
+    """
+    for photo in records:
+        yearmonth = photo['taken'][:7]
+        totals = rollups.setdefault(photo['user_id'], dict()).setdefault(
+            yearmonth, {'photos': 0, 'keywords': 0, 'tagcounts': dict()})
+        totals['photos'] += sign
+        totals['keywords'] += sign * len(photo['keywords'])
+        tagcounts = totals['tagcounts']
+        for keyword in photo['keywords']:
+            tagcounts[keyword] = tagcounts.get(keyword, 0) + sign
+            if not tagcounts[keyword]:
+                del tagcounts[keyword]
+        if not totals['photos']:
+            del rollups[photo['user_id']][yearmonth]
+    return rollups
+
+#-------------------------------------------------------------------------------
+def build_rollups(records):
+    """Build rollups from tag records, in one streaming pass.
+
+    records = iterable of tag records (dictionaries)
+
+    Returns the rollups, and saves them to cache/rollups.json.
+    """
+    rollups = apply_records(dict(), records)
+    save_rollups(rollups)
+    return rollups
+
+#-------------------------------------------------------------------------------
+def load_rollups():
+    """Load the saved rollups.
+
+    Returns the rollups, or None if they haven't been built, or were built
+    before the normalization rules (tagrules.ini) last changed.
+    """
+    filename = rollups_filename()
+    if not os.path.isfile(filename):
+        return None
+    rules = tagrules.rules_filename()
+    if os.path.isfile(rules) and os.path.getmtime(rules) > os.path.getmtime(filename):
+        return None
+    with open(filename, 'r', encoding='utf-8') as fhandle:
+        return json.loads(fhandle.read())
+
+#-------------------------------------------------------------------------------
+def month_range(start, end):
+    """Generate the months from start to end (inclusive), as 'YYYY-MM'.
+    """
+    year, month = int(start[:4]), int(start[5:7])
+    while '{0}-{1:02}'.format(year, month) <= end:
+        yield '{0}-{1:02}'.format(year, month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+#-------------------------------------------------------------------------------
+def rollups_filename():
+    """Get filename for the saved rollups.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/rollups.json')
+
+#-------------------------------------------------------------------------------
+def save_rollups(rollups):
+    """Save rollups to cache/rollups.json.
+    """
+    filename = rollups_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as fhandle:
+        fhandle.write(json.dumps(rollups, separators=(',', ':'), ensure_ascii=False))
+
+#-------------------------------------------------------------------------------
+def summarize(rollups, users, start=None, end=None):
+    """Summarize rollups for a set of users and range of months.
+
+    rollups = dictionary of user ID -> month -> totals
+    users = list of Flickr user IDs
+    start/end = optional first/last month to include, 'YYYY-MM'
+
+    Returns a dictionary with these keys:
+    photos = dictionary of user ID -> number of photos
+    tags = dictionary of user ID -> number of keywords
+    tagcounts = Counter of keyword -> count, across all users
+    """
+    summary = {'photos': dict(), 'tags': dict(), 'tagcounts': Counter()}
+    for user_id in users:
+        summary['photos'][user_id] = 0
+        summary['tags'][user_id] = 0
+        for yearmonth, totals in rollups.get(user_id, dict()).items():
+            if (start and yearmonth < start) or (end and yearmonth > end):
+                continue
+            summary['photos'][user_id] += totals['photos']
+            summary['tags'][user_id] += totals['keywords']
+            summary['tagcounts'].update(totals['tagcounts'])
+    return summary
+
+#-------------------------------------------------------------------------------
+def update_rollups(added, replaced=None):
+    """Update the saved rollups for new or replaced tag records.
+
+    added = list of tag records that were written to the cache
+    replaced = list of tag records that were overwritten by them
+
+    The records are as harvested; they're normalized here. Only users whose
+    rollups have already been built are updated.
+    """
+    rollups = load_rollups()
+    if not rollups:
+        return
+    rules = tagrules.default_rules()
+    if replaced:
+        apply_records(rollups, rules.apply(photo for photo in replaced
+                                           if photo['user_id'] in rollups), sign=-1)
+    apply_records(rollups, rules.apply(photo for photo in added
+                                       if photo['user_id'] in rollups))
+    save_rollups(rollups)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Flickr tag rollups.')
+    PARSER.add_argument('command', choices=['rebuild', 'summary'])
+    PARSER.add_argument('--user', action='append', help='Flickr user ID (repeatable)')
+    PARSER.add_argument('--start', help='first month, YYYY-MM')
+    PARSER.add_argument('--end', help='last month, YYYY-MM')
+    ARGS = PARSER.parse_args()
+
+    import flickrtags
+    USERS = ARGS.user or flickrtags.USERS
+    if ARGS.command == 'rebuild' or not load_rollups():
+        from flickrtags import tag_records
+        ROLLUPS = build_rollups(itertools.chain.from_iterable(
+            tag_records(user_id) for user_id in USERS))
+    else:
+        ROLLUPS = load_rollups()
+    SUMMARY = summarize(ROLLUPS, USERS, ARGS.start, ARGS.end)
+    for USER_ID in USERS:
+        print('{0} = {1} photos, {2} tags total'.format(
+            USER_ID, SUMMARY['photos'][USER_ID], SUMMARY['tags'][USER_ID]))
+    for TAG, COUNT in SUMMARY['tagcounts'].most_common(20):
+        print(TAG, COUNT)
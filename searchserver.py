@@ -0,0 +1,270 @@
+""" searchserver.py
+local HTTP search service for the tag index (requires numpy)
+
+Loads the tag data once (the photo table and tag index, which are rebuilt
+from the cached tag records if they've changed; see phototable.py and
+tagindex.py) plus the match results (matcher.py), and answers queries over
+HTTP with JSON results:
+
+GET /search?q=dog+AND+beach&start=2010-01-01&end=2012-12-31&user=dogerino
+           &page=1&per_page=50
+    -> {"query", "total", "page", "pages", "per_page", "photos": [...]};
+       each photo has photo_url, photo_id, user_id, taken, title, keywords
+       and the matched local filename (or null)
+GET /status
+    -> number of photos, when the data was loaded, cache statistics, and
+       the most common tags
+The keywords, and the query terms, are normalized by the rules in
+tagrules.ini (see tagrules.py).
+
+Requests are handled on concurrent threads, and the sorted results of
+recent queries are kept in an LRU cache, so paging through a result or
+repeating a query doesn't search again. The tag records, match results and
+rules are checked for changes every few seconds, and reloaded (with a new,
+empty cache) without restarting; requests in progress finish on the old data.
+
+Usage: python searchserver.py [--port 8080] [--host 127.0.0.1]
+                              [--cache-size 1024] [--reload-interval 5]
+See loadtest.py for a load test.
+"""
+import argparse
+import datetime
+import functools
+import glob
+import http.server
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+import matcher
+import phototable
+import tagindex
+import tagrules
+import tagstore
+
+#-------------------------------------------------------------------------------
+class _settings:
+    snapshot = None # current _Snapshot
+    cache_size = 1024 # queries kept in each snapshot's LRU cache
+    max_per_page = 500 # largest page size a client can ask for
+    reload_interval = 5.0 # seconds between checks for changed tag data
+    lock = threading.Lock() # held while a reload is in progress
+
+#-------------------------------------------------------------------------------
+class SearchHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler for the search service.
+    """
+    protocol_version = 'HTTP/1.1' # keep-alive, so clients can reuse connections
+    # send each small response right away; with Nagle's algorithm, the body
+    # waits for the client's delayed ACK of the headers (~40 ms per request)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """Handle a GET request.
+        """
+        url = urllib.parse.urlparse(self.path)
+        params = {key: values[0] for key, values
+                  in urllib.parse.parse_qs(url.query).items()}
+        snapshot = _settings.snapshot
+        try:
+            if url.path == '/search':
+                self._send_json(200, snapshot.page(params))
+            elif url.path == '/status':
+                self._send_json(200, snapshot.status())
+            else:
+                self._send_json(404, {'error': 'not found: ' + url.path})
+        except ValueError as err:
+            self._send_json(400, {'error': str(err)})
+
+    def log_message(self, format, *args): # pylint: disable=W0622
+        """Don't log each request to the console.
+        """
+        pass
+
+    def _send_json(self, status, payload):
+        """Send a JSON response.
+        """
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+#-------------------------------------------------------------------------------
+class _Snapshot:
+    """The data that queries are answered from, loaded once.
+
+    sources = dictionary of source filename -> modified time, at load time
+    """
+    def __init__(self, sources):
+        self.sources = sources
+        self.loaded = datetime.datetime.now().isoformat(timespec='seconds')
+        self.table = phototable.load_table()
+        if not os.path.isfile(tagindex.index_filename()) or \
+            os.path.getmtime(tagindex.index_filename()) < \
+            os.path.getmtime(phototable.table_filename()):
+            tagindex.build_index(self.table.record(photono)
+                                 for photono in range(len(self.table)))
+        # each snapshot maps its own copy of the index, so that tagindex.bin
+        # can be replaced while it's in use (Windows can't replace or delete
+        # a file that's mapped)
+        self.index_file = os.path.join(os.path.dirname(tagindex.index_filename()),
+                                       'searchindex-{0}.bin'.format(time.time_ns()))
+        shutil.copyfile(tagindex.index_filename(), self.index_file)
+        self.index = tagindex.TagIndex(self.index_file)
+        self.matches = matcher.load_matches()
+        self.search = functools.lru_cache(maxsize=_settings.cache_size)(self._search)
+        self.top_tags = [keyword for keyword, _ in self.table.top_keywords(50)]
+
+    def page(self, params):
+        """Answer a /search request.
+
+        params = dictionary of query string parameters
+
+        Returns the response payload (dictionary).
+        """
+        query = params.get('q', '')
+        try:
+            page = max(int(params.get('page', 1)), 1)
+            per_page = min(max(int(params.get('per_page', 50)), 1), _settings.max_per_page)
+        except ValueError:
+            raise ValueError('page and per_page must be integers')
+        docs = self.search(query, params.get('start'), params.get('end'), params.get('user'))
+        photos = [self._photo(docno) for docno in docs[(page - 1) * per_page:page * per_page]]
+        return {'query': query, 'total': len(docs), 'page': page,
+                'pages': (len(docs) + per_page - 1) // per_page, 'per_page': per_page,
+                'photos': photos}
+
+    def status(self):
+        """Answer a /status request.
+        """
+        cache = self.search.cache_info()
+        return {'photos': len(self.table), 'loaded': self.loaded,
+                'cache': {'hits': cache.hits, 'misses': cache.misses,
+                          'size': cache.currsize, 'max_size': cache.maxsize},
+                'top_tags': self.top_tags}
+
+    def _photo(self, docno):
+        """Get the result entry for a photo.
+        """
+        photo = self.index.photo(docno)
+        # both are sorted by photo ID, so this is usually the same number
+        photono = int(np.searchsorted(self.table.photo_ids, int(photo['photo_id'])))
+        if photono < len(self.table) and self.table.photo_ids[photono] == int(photo['photo_id']):
+            record = self.table.record(photono)
+            photo['title'] = record['title']
+            photo['keywords'] = record['keywords']
+        match = self.matches.get(photo['photo_url']) or dict()
+        photo['filename'] = match.get('filename')
+        return photo
+
+    def _search(self, query, start, end, user_id):
+        """Search the tag index (cached by self.search).
+
+        Returns a tuple of photo numbers, newest first.
+        """
+        try:
+            docs = self.index.search(query, start, end, user_id)
+        except (IndexError, KeyError) as err:
+            raise ValueError('invalid query: ' + query) from err
+        return tuple(sorted(docs, key=lambda docno: self.index.taken[docno], reverse=True))
+
+#-------------------------------------------------------------------------------
+def reload_if_changed():
+    """Reload the data if the tag records or match results have changed.
+
+    Returns True if the data was reloaded.
+    """
+    sources = _source_mtimes()
+    with _settings.lock:
+        if _settings.snapshot and sources == _settings.snapshot.sources:
+            return False
+        print('loading tag data')
+        _settings.snapshot = _Snapshot(sources)
+        print('{0} photos loaded'.format(len(_settings.snapshot.table)))
+        _remove_old_indexes(_settings.snapshot.index_file)
+    return True
+
+#-------------------------------------------------------------------------------
+def serve(host='127.0.0.1', port=8080, cache_size=1024, reload_interval=5.0):
+    """Load the data and run the search service until interrupted.
+
+    host = interface to listen on; use 0.0.0.0 for access from other devices
+    port = port to listen on
+    cache_size = number of queries kept in the LRU cache
+    reload_interval = seconds between checks for changed tag data
+    """
+    _settings.cache_size = cache_size
+    _settings.reload_interval = reload_interval
+    reload_if_changed()
+
+    def watch():
+        while True:
+            time.sleep(_settings.reload_interval)
+            try:
+                reload_if_changed()
+            except Exception as err: # pylint: disable=W0703
+                # keep serving the old data, and try again next time
+                print('ERROR: reload failed - {0}'.format(err))
+
+    threading.Thread(target=watch, daemon=True).start()
+    server = http.server.ThreadingHTTPServer((host, port), SearchHandler)
+    server.daemon_threads = True
+    print('serving http://{0}:{1}/search?q=...'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+#-------------------------------------------------------------------------------
+def _remove_old_indexes(current):
+    """Delete the index copies of previous snapshots.
+
+    current = index file of the current snapshot, which is kept
+
+    A copy that's still mapped by requests in progress can't be deleted on
+    Windows; it's deleted after a later reload instead.
+    """
+    for filename in glob.glob(os.path.join(os.path.dirname(current), 'searchindex-*.bin')):
+        if filename != current:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+#-------------------------------------------------------------------------------
+def _source_mtimes():
+    """Get the modified times of the files the data is loaded from.
+
+    Returns a dictionary of filename -> modified time.
+    """
+    if tagstore.store_exists():
+        sources = [tagstore.store_filename()]
+    else:
+        sources = glob.glob(os.path.join(os.path.dirname(tagstore.store_filename()),
+                                         '*-tags-*.json'))
+    sources.append(matcher.matches_filename())
+    sources.append(tagrules.rules_filename())
+    return {source: os.path.getmtime(source) for source in sources if os.path.isfile(source)}
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Local HTTP search service.')
+    PARSER.add_argument('--host', default='127.0.0.1',
+                        help='interface to listen on (0.0.0.0 = all)')
+    PARSER.add_argument('--port', type=int, default=8080)
+    PARSER.add_argument('--cache-size', type=int, default=1024,
+                        help='number of queries kept in the LRU cache')
+    PARSER.add_argument('--reload-interval', type=float, default=5.0,
+                        help='seconds between checks for changed tag data')
+    ARGS = PARSER.parse_args()
+
+    serve(ARGS.host, ARGS.port, ARGS.cache_size, ARGS.reload_interval)
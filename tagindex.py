@@ -0,0 +1,356 @@
+""" tagindex.py
+inverted keyword index and query engine for the harvested Flickr tags
+
+Maps each normalized keyword (see tagrules.py; query terms are normalized the
+same way) to a sorted posting list of photos, stored as
+delta-encoded packed integers in a single binary file (cache/tagindex.bin) that is
+loaded via mmap, so no JSON is parsed at startup. Queries support AND, OR,
+NOT, parentheses, "quoted tags", prefix* matching, and date-range and
+account filters on the photos.
+
+Usage: python tagindex.py build
+       python tagindex.py search <query> [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+"""
+import argparse
+import bisect
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+
+import tagrules
+import tagstore
+import tsindex
+
+MAGIC = b'PTIX0002'
+HEADER = struct.Struct('<8s6Q') # magic, ndocs, nterms, and 4 section offsets
+GAP_FORMATS = {1: 'B', 2: 'H', 4: 'I'} # posting list gap size -> struct format
+
+#-------------------------------------------------------------------------------
+class TagIndex:
+    """A tag index file, loaded via mmap.
+
+    filename = optional filename; default is cache/tagindex.bin
+
+    File layout (all integers little-endian):
+    header = magic, # photos, # terms, offsets of the 4 sections below
+    photos = photo IDs (int64, sorted), taken times (int64 epoch seconds),
+             user numbers (uint16), for each photo
+    users = user IDs, newline-separated UTF-8
+    terms = term start offsets (uint32 x nterms+1), then the sorted terms
+            as UTF-8, then posting list start offsets (uint64 x nterms+1)
+    postings = gaps between photo numbers, for each term (see _encode_gaps)
+
+    Photo numbers are positions in the photos section.
+    """
+    def __init__(self, filename=None):
+        with open(filename or index_filename(), 'rb') as fhandle:
+            self.mmap = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self.mmap)
+        magic, self.ndocs, self.nterms, photos, users, terms, postings = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('not a tag index file')
+
+        ndocs, nterms = self.ndocs, self.nterms
+        self.photo_ids = data[photos:photos + 8 * ndocs].cast('q')
+        self.taken = data[photos + 8 * ndocs:photos + 16 * ndocs].cast('q')
+        self.user_nos = data[photos + 16 * ndocs:photos + 18 * ndocs].cast('H')
+        self.users = bytes(data[users:terms]).decode('utf-8').split('\n')
+        self.term_offsets = data[terms:terms + 4 * (nterms + 1)].cast('I')
+        text_start = terms + 4 * (nterms + 1)
+        self.term_text = data[text_start:text_start + self.term_offsets[nterms]]
+        posting_start = text_start + self.term_offsets[nterms]
+        self.posting_offsets = data[posting_start:posting_start + 8 * (nterms + 1)].cast('Q')
+        self.postings = data[postings:]
+        self.terms = _TermList(self)
+
+    def lookup(self, term):
+        """Get the photo numbers for a term, or for all terms with a prefix
+        if the term ends with *.
+
+        Returns the photo numbers, as a sorted list for a single term or as
+        a set for a prefix.
+        """
+        if term.endswith('*'):
+            prefix = ' '.join(term[:-1].lower().split())
+            docs = set()
+            for termno in range(bisect.bisect_left(self.terms, prefix), self.nterms):
+                if not self.terms[termno].startswith(prefix):
+                    break
+                docs.update(self.posting_list(termno))
+            return docs
+
+        term = normalize(term)
+        if term is None:
+            return [] # dropped by the rules, so never indexed
+        termno = bisect.bisect_left(self.terms, term)
+        if termno < self.nterms and self.terms[termno] == term:
+            return self.posting_list(termno)
+        return []
+
+    def photo(self, docno):
+        """Get information about a photo.
+
+        docno = photo number
+
+        Returns a dictionary with photo_id, user_id, taken and photo_url.
+        """
+        user_id = self.users[self.user_nos[docno]]
+        photo_id = str(self.photo_ids[docno])
+        return {'photo_id': photo_id,
+                'user_id': user_id,
+                'taken': tsindex.epoch_to_ts(self.taken[docno]),
+                'photo_url': 'http://flickr.com/photos/' + user_id + '/' + photo_id}
+
+    def posting_list(self, termno):
+        """Decode the posting list for a term.
+
+        Returns a list of photo numbers, in ascending order.
+        """
+        return _decode_gaps(self.postings[self.posting_offsets[termno]:
+                                             self.posting_offsets[termno + 1]])
+
+    def search(self, query, start=None, end=None, user_id=None):
+        """Search the index.
+
+        query = query string, e.g. 'dog AND (beach OR park) NOT "road trip"';
+                adjacent terms are ANDed, and term* matches a prefix; an
+                empty query matches all photos
+        start/end = optional date range for the photos' taken dates,
+                    'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+        user_id = optional Flickr user ID; only that user's photos are returned
+
+        Returns a sorted list of photo numbers; use photo() for the details.
+        """
+        tokens = re.findall(r'\(|\)|"[^"]*"|[^\s()]+', query)
+        if not tokens:
+            docs, negated, position = [], True, 0
+        else:
+            docs, negated, position = self._parse_or(tokens, 0)
+        if position < len(tokens):
+            raise ValueError('unexpected "{0}" in query'.format(tokens[position]))
+        if negated:
+            docs = set(range(self.ndocs)).difference(docs)
+
+        if start or end:
+            first = _date_epoch(start, 0) if start else None
+            last = _date_epoch(end, 86399) if end else None
+            docs = [docno for docno in docs
+                    if (first is None or self.taken[docno] >= first) and
+                    (last is None or self.taken[docno] <= last)]
+        if user_id:
+            if user_id not in self.users:
+                return []
+            user_no = self.users.index(user_id)
+            docs = [docno for docno in docs if self.user_nos[docno] == user_no]
+        return docs if isinstance(docs, list) else sorted(docs)
+
+    # The parse methods return (docs, negated, position). If negated is True,
+    # the result is all photos except docs; this avoids building the set of
+    # all photos for NOT unless the whole query is negative. Docs can be a
+    # sorted list (single term) or a set; sets are only built when needed.
+
+    def _parse_and(self, tokens, position):
+        """and_expression := unary (['AND'] unary)*
+        """
+        docs, negated, position = self._parse_unary(tokens, position)
+        while position < len(tokens) and tokens[position] not in ('OR', ')'):
+            if tokens[position] == 'AND':
+                position += 1
+            right, right_negated, position = self._parse_unary(tokens, position)
+            if negated and right_negated:
+                docs = set(docs).union(right)
+            elif negated:
+                docs, negated = set(right).difference(docs), False
+            elif right_negated:
+                docs = set(docs).difference(right)
+            elif len(docs) < len(right):
+                docs = set(docs).intersection(right)
+            else:
+                docs = set(right).intersection(docs)
+        return docs, negated, position
+
+    def _parse_or(self, tokens, position):
+        """expression := and_expression ('OR' and_expression)*
+        """
+        docs, negated, position = self._parse_and(tokens, position)
+        while position < len(tokens) and tokens[position] == 'OR':
+            right, right_negated, position = self._parse_and(tokens, position + 1)
+            if negated and right_negated:
+                docs = set(docs).intersection(right)
+            elif negated:
+                docs = set(docs).difference(right)
+            elif right_negated:
+                docs, negated = set(right).difference(docs), True
+            else:
+                docs = set(docs).union(right)
+        return docs, negated, position
+
+    def _parse_unary(self, tokens, position):
+        """unary := 'NOT' unary | '(' expression ')' | term
+        """
+        if position >= len(tokens):
+            raise ValueError('incomplete query')
+        token = tokens[position]
+        if token == 'NOT':
+            docs, negated, position = self._parse_unary(tokens, position + 1)
+            return docs, not negated, position
+        if token == '(':
+            docs, negated, position = self._parse_or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise ValueError('missing ) in query')
+            return docs, negated, position + 1
+        if token in ('AND', 'OR', ')'):
+            raise ValueError('unexpected "{0}" in query'.format(token))
+        return self.lookup(token.strip('"')), False, position + 1
+
+#-------------------------------------------------------------------------------
+class _TermList:
+    """Sequence view of the sorted terms in a TagIndex, for bisect.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.nterms
+
+    def __getitem__(self, termno):
+        offsets = self.index.term_offsets
+        return bytes(self.index.term_text[offsets[termno]:offsets[termno + 1]]).decode('utf-8')
+
+#-------------------------------------------------------------------------------
+def build_index(records, filename=None):
+    """Build the tag index from tag records, and save it.
+
+    records = iterable of tag records (dictionaries) with normalized
+              keywords, e.g. from flickrtags.tag_records()
+    filename = optional filename; default is cache/tagindex.bin
+
+    Returns the number of photos indexed.
+    """
+    photos = dict() # photo ID -> (taken, user_id, keywords)
+    for record in records:
+        photos[tagstore.photo_id(record)] = (tsindex.ts_to_epoch(record['taken']),
+                                             record['user_id'], record['keywords'])
+    photo_ids = sorted(photos)
+    users = sorted({user_id for _, user_id, _ in photos.values()})
+    user_nos = {user_id: user_no for user_no, user_id in enumerate(users)}
+
+    postings = dict() # term -> list of photo numbers
+    for docno, photo_id in enumerate(photo_ids):
+        for keyword in set(photos[photo_id][2]):
+            postings.setdefault(keyword, []).append(docno)
+    terms = sorted(postings)
+
+    photo_section = struct.pack('<{0}q'.format(len(photo_ids)), *photo_ids) + \
+        struct.pack('<{0}q'.format(len(photo_ids)), *[photos[photo_id][0]
+                                                       for photo_id in photo_ids]) + \
+        struct.pack('<{0}H'.format(len(photo_ids)), *[user_nos[photos[photo_id][1]]
+                                                       for photo_id in photo_ids])
+    user_section = '\n'.join(users).encode('utf-8')
+
+    encoded_terms = [term.encode('utf-8') for term in terms]
+    term_offsets = [0] + list(itertools.accumulate(len(term) for term in encoded_terms))
+    encoded_postings = [_encode_gaps(postings[term]) for term in terms]
+    posting_offsets = [0] + list(itertools.accumulate(len(plist) for plist in encoded_postings))
+    term_section = struct.pack('<{0}I'.format(len(term_offsets)), *term_offsets) + \
+        b''.join(encoded_terms) + \
+        struct.pack('<{0}Q'.format(len(posting_offsets)), *posting_offsets)
+
+    photo_offset = HEADER.size
+    user_offset = photo_offset + len(photo_section)
+    term_offset = user_offset + len(user_section)
+    posting_offset = term_offset + len(term_section)
+    header = HEADER.pack(MAGIC, len(photo_ids), len(terms),
+                         photo_offset, user_offset, term_offset, posting_offset)
+
+    filename = filename or index_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename + '.tmp', 'wb') as fhandle:
+        fhandle.write(header + photo_section + user_section + term_section)
+        fhandle.write(b''.join(encoded_postings))
+    os.replace(filename + '.tmp', filename)
+    return len(photo_ids)
+
+#-------------------------------------------------------------------------------
+def index_filename():
+    """Get filename for the tag index.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/tagindex.bin')
+
+#-------------------------------------------------------------------------------
+def normalize(keyword):
+    """Normalize a query term like the indexed keywords (see tagrules.py), so
+    that a synonym finds its canonical tag.
+
+    Returns the normalized keyword, or None if the rules drop it.
+    """
+    keywords = tagrules.default_rules().normalize(keyword)
+    return keywords[0] if keywords else None
+
+#-------------------------------------------------------------------------------
+def _date_epoch(date, default_seconds):
+    """Convert a 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' string to epoch seconds.
+
+    default_seconds = seconds to add to a date without a time (0 = start of
+                      day, 86399 = end of day)
+    """
+    if len(date) > 10:
+        return tsindex.ts_to_epoch(date)
+    return tsindex.ts_to_epoch(date + ' 00:00:00') + default_seconds
+
+#-------------------------------------------------------------------------------
+def _decode_gaps(data):
+    """Decode a posting list of packed gaps.
+
+    Returns the list of photo numbers.
+    """
+    if not data:
+        return []
+    return list(itertools.accumulate(data[1:].cast(GAP_FORMATS[data[0]])))
+
+#-------------------------------------------------------------------------------
+def _encode_gaps(values):
+    """Encode a sorted list of photo numbers as gaps between them.
+
+    The gaps are packed into 1, 2 or 4 bytes each (the smallest size that
+    fits the largest gap), preceded by a byte that indicates the size. This
+    decodes at C speed with memoryview.cast() and itertools.accumulate().
+    """
+    gaps = [value - previous for value, previous in zip(values, [0] + values[:-1])]
+    width = 1 if max(gaps) < 0x100 else 2 if max(gaps) < 0x10000 else 4
+    return bytes([width]) + struct.pack('<{0}{1}'.format(len(gaps), GAP_FORMATS[width]), *gaps)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Flickr tag index.')
+    PARSER.add_argument('command', choices=['build', 'search'])
+    PARSER.add_argument('query', nargs='?', default='')
+    PARSER.add_argument('--start', help='earliest taken date, YYYY-MM-DD')
+    PARSER.add_argument('--end', help='latest taken date, YYYY-MM-DD')
+    PARSER.add_argument('--user', help='Flickr user ID')
+    ARGS = PARSER.parse_args()
+
+    if ARGS.command == 'build':
+        from flickrtags import USERS, tag_records
+        print('{0} photos indexed'.format(build_index(itertools.chain.from_iterable(
+            tag_records(user_id) for user_id in USERS))))
+    else:
+        if not os.path.isfile(index_filename()):
+            print('ERROR: no tag index; run tagindex.py build first')
+            sys.exit(1)
+        INDEX = TagIndex()
+        try:
+            DOCNOS = INDEX.search(ARGS.query, ARGS.start, ARGS.end, ARGS.user)
+        except ValueError as err:
+            print('ERROR: ' + str(err))
+            sys.exit(1)
+        for DOCNO in DOCNOS:
+            PHOTO = INDEX.photo(DOCNO)
+            print(PHOTO['taken'] + ' ' + PHOTO['photo_url'])
@@ -0,0 +1,251 @@
+""" tagrules.py
+keyword normalization rules, for merging tag vocabularies
+
+The rules are read from an ini file (tagrules.ini) with these sections:
+[stop]      tags to drop, one per line; a trailing * drops every tag with
+            that prefix (e.g. flickr-*)
+[synonyms]  variant = canonical, for synonyms and spelling variants
+            (puppy = dog, colour = color); a trailing * on the variant maps
+            every tag with that prefix
+[hierarchy] tag = parent; a tag also gets its parent's keyword, and the
+            parent's parent, and so on (dog = animals, animals = nature)
+[options]   fold_plurals = yes/no; a plural ('dogs', 'boxes', 'puppies')
+            is folded to its singular if the singular is a known tag
+Tags are lowercased and their whitespace collapsed before the rules apply.
+
+The rules are compiled into one hash map of exact tags plus a trie of
+prefix rules, and every distinct tag's result is memoized, so normalizing
+a stream of records costs about one dictionary lookup per tag. The records
+are normalized with default_rules() wherever they're read (see
+flickrtags.tag_records() and phototable.py), so the statistics, search,
+suggestions and sidecars all use the same vocabulary.
+
+Usage: python tagrules.py [--rules tagrules.ini]  (normalize the harvested
+                                                   tags, and print totals)
+"""
+import argparse
+import configparser
+import os
+import sys
+
+#-------------------------------------------------------------------------------
+class _settings:
+    rules = None # TagRules returned by default_rules()
+    mtime = None # modified time of tagrules.ini when they were loaded
+
+#-------------------------------------------------------------------------------
+class TagRules:
+    """Compiled normalization rules.
+
+    stop = iterable of tags to drop; a trailing * makes it a prefix rule
+    synonyms = dictionary of variant -> canonical tag; a trailing * on the
+               variant makes it a prefix rule
+    hierarchy = dictionary of tag -> parent tag
+    fold_plurals = whether to fold plurals to known singulars
+    vocabulary = optional iterable of known tags, for plural folding (the
+                 tags named in the synonyms and hierarchy are always known)
+    """
+    def __init__(self, *, stop=(), synonyms=None, hierarchy=None, fold_plurals=True,
+                 vocabulary=()):
+        synonyms = {_clean(variant): _clean(canonical)
+                    for variant, canonical in (synonyms or dict()).items()}
+        hierarchy = {_clean(tag): _clean(parent) for tag, parent in (hierarchy or dict()).items()}
+        self.fold_plurals = fold_plurals
+        self.known = set(_clean(tag) for tag in vocabulary)
+        self.known.update(synonyms.values())
+        self.known.update(variant for variant in synonyms if not variant.endswith('*'))
+        self.known.update(hierarchy)
+        self.known.update(hierarchy.values())
+        self.exact = dict() # tag -> tuple of output keywords; () = dropped
+        self.prefixes = dict() # trie of prefix rules: char -> subtrie; None -> result
+
+        for canonical in set(synonyms.values()) | set(hierarchy):
+            self.exact[canonical] = _ancestors(canonical, hierarchy)
+        for variant, canonical in synonyms.items():
+            result = _ancestors(canonical, hierarchy)
+            if variant.endswith('*'):
+                self._add_prefix(variant[:-1], result)
+            else:
+                self.exact[variant] = result
+        for tag in stop:
+            tag = _clean(tag)
+            if tag.endswith('*'):
+                self._add_prefix(tag[:-1], ())
+            else:
+                self.exact[tag] = ()
+
+    def apply(self, records):
+        """Normalize the keywords of a stream of tag records.
+
+        records = iterable of tag records (dictionaries)
+
+        Generates copies of the records, with normalized keywords.
+        """
+        for record in records:
+            yield dict(record, keywords=self.normalize_keywords(record['keywords']))
+
+    def normalize(self, tag):
+        """Normalize one tag.
+
+        Returns a tuple of keywords: empty if the tag is dropped, and more
+        than one if it has parents in the hierarchy.
+        """
+        result = self.exact.get(tag)
+        if result is not None:
+            return result
+        cleaned = _clean(tag)
+        result = self.exact.get(cleaned)
+        if result is None:
+            result = self._match_prefix(cleaned)
+        if result is None and self.fold_plurals:
+            singular = _singular(cleaned, self.known)
+            if singular:
+                result = self.exact.get(singular, (singular,))
+        if result is None:
+            result = (cleaned,) if cleaned else ()
+        self.exact[tag] = result # memoize, for the next occurrence
+        return result
+
+    def normalize_keywords(self, keywords):
+        """Normalize a list of keywords.
+
+        Returns a sorted list of distinct keywords.
+        """
+        normalized = set()
+        for keyword in keywords:
+            normalized.update(self.normalize(keyword))
+        return sorted(normalized)
+
+    def _add_prefix(self, prefix, result):
+        """Add a prefix rule to the trie.
+        """
+        node = self.prefixes
+        for char in prefix:
+            node = node.setdefault(char, dict())
+        node[None] = result
+
+    def _match_prefix(self, tag):
+        """Find the longest prefix rule that matches a tag.
+
+        Returns the rule's result, or None if no prefix rule matches.
+        """
+        node = self.prefixes
+        result = node.get(None)
+        for char in tag:
+            node = node.get(char)
+            if node is None:
+                break
+            result = node.get(None, result)
+        return result
+
+#-------------------------------------------------------------------------------
+def default_rules():
+    """Get the shared rules from tagrules.ini.
+
+    Returns a TagRules (see load_rules()), loaded on the first call and
+    again whenever tagrules.ini has changed.
+    """
+    filename = rules_filename()
+    mtime = os.path.getmtime(filename) if os.path.isfile(filename) else None
+    if _settings.rules is None or mtime != _settings.mtime:
+        _settings.rules, _settings.mtime = load_rules(filename), mtime
+    return _settings.rules
+
+#-------------------------------------------------------------------------------
+def load_rules(filename=None, vocabulary=()):
+    """Load and compile the normalization rules.
+
+    filename = optional rules file; default is tagrules.ini in the source
+               folder
+    vocabulary = optional iterable of known tags, for plural folding
+
+    Returns a TagRules. If the file doesn't exist, the only rule is to drop
+    the auto-generated flickr-* tags.
+    """
+    filename = filename or rules_filename()
+    if not os.path.isfile(filename):
+        return TagRules(stop=['flickr-*'], vocabulary=vocabulary)
+
+    # only = separates a tag from its value, because tags can contain :
+    config = configparser.ConfigParser(allow_no_value=True, delimiters=('=',),
+                                       interpolation=None)
+    config.optionxform = str # keep tags as written; they're cleaned when compiled
+    config.read(filename, encoding='utf-8')
+
+    def section(name):
+        return dict(config.items(name)) if config.has_section(name) else dict()
+
+    return TagRules(stop=list(section('stop')),
+                    synonyms=section('synonyms'),
+                    hierarchy=section('hierarchy'),
+                    fold_plurals=config.getboolean('options', 'fold_plurals', fallback=True),
+                    vocabulary=vocabulary)
+
+#-------------------------------------------------------------------------------
+def rules_filename():
+    """Get filename for the default rules file.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'tagrules.ini')
+
+#-------------------------------------------------------------------------------
+def _ancestors(tag, hierarchy):
+    """Get a tag and all of its ancestors in the hierarchy, as a tuple.
+    """
+    result = [tag]
+    while hierarchy.get(result[-1]) and hierarchy[result[-1]] not in result:
+        result.append(hierarchy[result[-1]])
+    return tuple(result)
+
+#-------------------------------------------------------------------------------
+def _clean(tag):
+    """Lowercase a tag, and collapse its whitespace.
+    """
+    return ' '.join(tag.lower().split())
+
+#-------------------------------------------------------------------------------
+def _singular(tag, known):
+    """Get the singular of a plural tag, if it's a known tag.
+
+    Returns the singular, or None.
+    """
+    if len(tag) < 4 or not tag.endswith('s') or tag.endswith('ss'):
+        return None
+    candidates = [tag[:-1]] # dogs
+    if tag.endswith('ies'):
+        candidates.insert(0, tag[:-3] + 'y') # puppies
+    elif tag.endswith('es'):
+        candidates.append(tag[:-2]) # boxes
+    for candidate in candidates:
+        if candidate in known:
+            return candidate
+    return None
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Normalize the harvested tags.')
+    PARSER.add_argument('--rules', default=None, help='rules file (default = tagrules.ini)')
+    ARGS = PARSER.parse_args()
+
+    import time
+    from flickrtags import USERS, tag_records
+    START = time.time()
+    RECORDS = [record for user_id in USERS
+               for record in tag_records(user_id, normalize=False)]
+    LOADED = time.time()
+    if not RECORDS:
+        print('ERROR: no tag records; harvest first')
+        sys.exit(1)
+    RULES = load_rules(ARGS.rules, vocabulary=(keyword.lower() for record in RECORDS
+                                               for keyword in record['keywords']))
+    COMPILED = time.time()
+    NORMALIZED = list(RULES.apply(RECORDS))
+    FINISHED = time.time()
+    print('{0:,} records, {1:,} tag occurrences'.format(
+        len(RECORDS), sum(len(record['keywords']) for record in RECORDS)))
+    print('vocabulary: {0:,} tags -> {1:,} tags'.format(
+        len({keyword for record in RECORDS for keyword in record['keywords']}),
+        len({keyword for record in NORMALIZED for keyword in record['keywords']})))
+    print('load {0:.3f} sec, compile {1:.3f} sec, normalize {2:.3f} sec'.format(
+        LOADED - START, COMPILED - LOADED, FINISHED - COMPILED))
@@ -0,0 +1,162 @@
+""" tagstore.py
+consolidated store of Flickr tag records, keyed by photo ID
+
+All tag records are kept in a single file (cache/tags.jsonl), one line per
+photo in the format <photo ID><tab><compact JSON record>, sorted by photo ID.
+The records are the same dictionaries written to <user>-tags-pageXXX.json,
+so they can be read with a single sequential pass and bounded memory, and
+updates are merged into the file without loading all of it.
+
+Usage: python tagstore.py migrate
+"""
+import contextlib
+import glob
+import heapq
+import json
+import os
+import sys
+
+#-------------------------------------------------------------------------------
+def migrate(filename=None, batch_size=50000):
+    """Create the store from the cache/*-tags-*.json files.
+
+    filename = optional store filename; default is cache/tags.jsonl
+    batch_size = number of records sorted in memory at a time
+
+    Records from all of the tags pages (and sync files) in the same folder as
+    the store are combined into the store. The page files are not deleted.
+    The records are sorted in batches, written to temporary run files, and
+    the runs are merged in one sequential pass, so memory use is bounded by
+    the batch size rather than the size of the cache. Returns the number of
+    records.
+    """
+    filename = filename or store_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    runs = [] # temporary files of sorted lines, one per batch
+    batch = dict() # photo ID -> line to write, later records win
+    total = 0
+
+    def write_run():
+        runfile = filename + '.run' + str(len(runs))
+        with open(runfile, 'w', encoding='utf-8') as output:
+            for line_id in sorted(batch):
+                output.write(str(line_id) + '\t' + batch[line_id])
+        runs.append(runfile)
+        batch.clear()
+
+    try:
+        for datafile in sorted(glob.glob(os.path.join(os.path.dirname(filename),
+                                                      '*-tags-*.json'))):
+            with open(datafile, 'r') as fhandle:
+                for record in json.loads(fhandle.read()):
+                    batch[photo_id(record)] = \
+                        json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+                    total += 1
+            if len(batch) >= batch_size:
+                write_run()
+        write_run()
+
+        # merge the runs; for duplicate photo IDs, the line from the latest
+        # run is written (merge() keeps lines with equal keys in run order)
+        tempfile = filename + '.tmp'
+        with contextlib.ExitStack() as stack:
+            inputs = [stack.enter_context(open(runfile, 'r', encoding='utf-8'))
+                      for runfile in runs]
+            output = stack.enter_context(open(tempfile, 'w', encoding='utf-8'))
+            previous = None
+            for line in heapq.merge(*inputs, key=lambda line: int(line.partition('\t')[0])):
+                if previous and previous.partition('\t')[0] != line.partition('\t')[0]:
+                    output.write(previous)
+                previous = line
+            if previous:
+                output.write(previous)
+        os.replace(tempfile, filename)
+    finally:
+        for runfile in runs:
+            os.remove(runfile)
+    return total
+
+#-------------------------------------------------------------------------------
+def photo_id(record):
+    """Get the Flickr photo ID (as an integer) for a tag record.
+    """
+    return int(record['photo_url'].rsplit('/', 1)[-1])
+
+#-------------------------------------------------------------------------------
+def read_records(user_id=None, filename=None):
+    """Read tag records from the store.
+
+    user_id = optional Flickr user ID; if specified, only that user's photos
+              are returned
+    filename = optional store filename; default is cache/tags.jsonl
+
+    Generates the tag records (dictionaries) in photo ID order.
+    """
+    with open(filename or store_filename(), 'r', encoding='utf-8') as fhandle:
+        for line in fhandle:
+            record = json.loads(line.partition('\t')[2])
+            if user_id and record['user_id'] != user_id:
+                continue
+            yield record
+
+#-------------------------------------------------------------------------------
+def store_exists(filename=None):
+    """Determine whether the consolidated store has been created.
+    """
+    return os.path.isfile(filename or store_filename())
+
+#-------------------------------------------------------------------------------
+def store_filename():
+    """Get filename for the consolidated tag store.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/tags.jsonl')
+
+#-------------------------------------------------------------------------------
+def upsert_records(records, filename=None):
+    """Add or replace records in the store.
+
+    records = list of tag records (dictionaries)
+    filename = optional store filename; default is cache/tags.jsonl
+
+    The new records are sorted and merged with the existing file in one
+    sequential pass, into a temporary file that then replaces the store.
+    Returns a list of the records that were replaced.
+    """
+    filename = filename or store_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    newlines = dict() # photo ID -> line to write, later records win
+    for record in records:
+        newlines[photo_id(record)] = \
+            json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+    new_ids = sorted(newlines)
+
+    replaced = []
+    tempfile = filename + '.tmp'
+    with open(tempfile, 'w', encoding='utf-8') as output:
+        position = 0 # next new record to be written
+        if os.path.isfile(filename):
+            with open(filename, 'r', encoding='utf-8') as existing:
+                for line in existing:
+                    line_id = int(line.partition('\t')[0])
+                    while position < len(new_ids) and new_ids[position] < line_id:
+                        output.write(str(new_ids[position]) + '\t' + newlines[new_ids[position]])
+                        position += 1
+                    if position < len(new_ids) and new_ids[position] == line_id:
+                        replaced.append(json.loads(line.partition('\t')[2]))
+                        continue # replaced by new record, written on next pass
+                    output.write(line)
+        for new_id in new_ids[position:]:
+            output.write(str(new_id) + '\t' + newlines[new_id])
+
+    os.replace(tempfile, filename)
+    return replaced
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print('Usage: python tagstore.py migrate')
+        sys.exit(1)
+
+    print('{0} records migrated to {1}'.format(migrate(), store_filename()))
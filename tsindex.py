@@ -0,0 +1,482 @@
+""" tsindex.py
+persistent index of capture timestamps for the photo backup tree
+
+The index is built by a one-time scan of the photo folder hierarchy, and maps
+each photo's capture timestamp (integer seconds) to its filename. Timestamps
+are stored in sorted order, so that exact and +/- N second lookups are binary
+searches with no filesystem I/O.
+
+Usage: python tsindex.py <photo_home> [--workers N] [--chunksize N]
+                          [--refresh] [--watch] [--metrics]
+
+After the first scan, --refresh rescans only the folders whose modified time
+has changed, and --watch (Linux) uses inotify to update the index as files
+are added, renamed or deleted.
+"""
+import argparse
+import bisect
+import calendar
+import itertools
+import json
+import os
+import time
+
+import exifts
+import metacache
+import metrics
+
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.nef', '.png', '.bmp', '.gif']
+
+#-------------------------------------------------------------------------------
+def build_index(photo_home, workers=None, chunksize=200):
+    """Scan a photo folder hierarchy and build a timestamp index.
+
+    photo_home = root folder of the photo backups
+    workers = number of worker processes for EXIF parsing; default is the
+              number of CPUs, and 1 parses everything in this process
+    chunksize = number of files sent to a worker at a time
+
+    Returns the index, a dictionary with these keys:
+    photo_home = the root folder that was scanned
+    timestamps = sorted list of capture times (seconds since the epoch)
+    filenames = list of filenames (relative to photo_home), in the same order
+    folders = dictionary of folder (relative to photo_home) -> modified time
+              (nanoseconds) when it was scanned, used by refresh_index()
+    """
+    folders = dict()
+    index = {'photo_home': photo_home, 'folders': dict()}
+    entries = _index_entries(index, file_timestamps(scan_tree(photo_home, folders),
+                                                    workers, chunksize))
+    for folder, mtime in folders.items():
+        index['folders'][_relative_folder(index, folder)] = mtime
+    _set_entries(index, entries)
+    return index
+
+#-------------------------------------------------------------------------------
+def epoch_to_ts(epoch):
+    """Convert seconds since the epoch to a 'YYYY-MM-DD HH:MM:SS' string.
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+#-------------------------------------------------------------------------------
+def file_timestamps(files, workers=None, chunksize=200):
+    """Get capture timestamps for a set of files.
+
+    files = iterable of (filename, stat) tuples, e.g. from scan_tree()
+    workers = number of worker processes for EXIF parsing; default is the
+              number of CPUs, and 1 parses everything in this process
+    chunksize = number of files sent to a worker at a time
+
+    Files already in the metadata store (see metacache.py) are not re-parsed.
+    New or modified files are parsed in parallel, and results are saved to
+    the metadata store as they arrive. Generates (filename, timestamp) tuples
+    for the files that could be read, and prints throughput in files/sec.
+    """
+    import concurrent.futures
+    workers = workers or os.cpu_count()
+    start = time.time()
+    stats = {} # filename -> os.stat() result, for files being parsed
+    totals = {'scanned': 0, 'parsed': 0}
+
+    def parsed(results):
+        for filename, taken in results:
+            stat = stats.pop(filename)
+            if taken is None:
+                continue # unreadable file
+            metacache.put_timestamp(filename, stat, taken)
+            metrics.count('files.parsed')
+            totals['parsed'] += 1
+            yield (filename, taken)
+
+    if workers == 1:
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    pending = set() # futures for chunks being parsed
+    chunk = []
+    for filename, stat in files:
+        totals['scanned'] += 1
+        if totals['scanned'] % 10000 == 0:
+            print_throughput(totals, start)
+        taken = metacache.get_timestamp(filename, stat)
+        metrics.cache_lookup('metacache', taken is not None)
+        if taken is not None:
+            yield (filename, taken)
+            continue
+        stats[filename] = stat
+        chunk.append(filename)
+        if len(chunk) < chunksize:
+            continue
+        if executor:
+            pending.add(executor.submit(_parse_chunk, chunk))
+            if len(pending) >= workers * 4:
+                # limit the number of chunks in flight; process what's done
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from parsed(future.result())
+        else:
+            yield from parsed(_parse_chunk(chunk))
+        chunk = []
+
+    if chunk:
+        # the last partial chunk goes to the workers too, so it doesn't hold
+        # up the parent while chunks are still in flight
+        if executor:
+            pending.add(executor.submit(_parse_chunk, chunk))
+        else:
+            yield from parsed(_parse_chunk(chunk))
+    if executor:
+        for future in concurrent.futures.as_completed(pending):
+            yield from parsed(future.result())
+        executor.shutdown()
+    print_throughput(totals, start)
+
+#-------------------------------------------------------------------------------
+def index_filename():
+    """Get filename for the locally cached timestamp index.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/tsindex.json')
+
+#-------------------------------------------------------------------------------
+def load_index(filename=None):
+    """Load a timestamp index from disk.
+
+    filename = optional filename; default is cache/tsindex.json
+
+    Returns the index (see build_index() for structure), or None if no index
+    has been saved.
+    """
+    filename = filename or index_filename()
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as fhandle:
+        return json.loads(fhandle.read())
+
+#-------------------------------------------------------------------------------
+def lookup(index, timestamp, nseconds=0):
+    """Find photos whose capture time is within nseconds of a timestamp.
+
+    index = timestamp index, as returned by build_index() or load_index()
+    timestamp = timestamp to match, 'YYYY-MM-DD HH:MM:SS'
+    nseconds = maximum difference in seconds (0 = exact matches only)
+
+    Returns a list of (filename, delta) tuples, where filename is a full path
+    and delta is the number of seconds between the photo and the timestamp.
+    """
+    epoch = ts_to_epoch(timestamp)
+    timestamps = index['timestamps']
+    first = bisect.bisect_left(timestamps, epoch - nseconds)
+    last = bisect.bisect_right(timestamps, epoch + nseconds)
+    return [(os.path.join(index['photo_home'], index['filenames'][pos]),
+             abs(timestamps[pos] - epoch))
+            for pos in range(first, last)]
+
+#-------------------------------------------------------------------------------
+def print_throughput(totals, start):
+    """Print scanning progress.
+
+    totals = dictionary of 'scanned' and 'parsed' file counts
+    start = time.time() when the scan started
+    """
+    elapsed = max(time.time() - start, 0.001)
+    print('{0} files scanned, {1} parsed, {2:.1f} seconds, {3:.0f} files/sec'.format(
+        totals['scanned'], totals['parsed'], elapsed, totals['scanned'] / elapsed))
+
+#-------------------------------------------------------------------------------
+def refresh_index(index, workers=None, chunksize=200):
+    """Update an index for changes to the photo folder hierarchy.
+
+    index = timestamp index, as returned by build_index() or load_index()
+    workers/chunksize = see file_timestamps()
+
+    Only the folders are scanned, and only the folders whose modified time
+    has changed (files added, deleted or renamed) are rescanned for photos.
+    Note that editing a file in place doesn't change its folder's modified
+    time, so isn't detected.
+
+    Returns a tuple of the number of folders (rescanned, removed).
+    """
+    found = dict()
+    for folder, mtime in scan_folders(index['photo_home']):
+        found[_relative_folder(index, folder)] = mtime
+    recorded = index.get('folders', dict())
+    changed = [folder for folder, mtime in found.items() if recorded.get(folder) != mtime]
+    removed = [folder for folder in recorded if folder not in found]
+    update_folders(index, changed + removed, workers, chunksize)
+    return (len(changed), len(removed))
+
+#-------------------------------------------------------------------------------
+def save_index(index, filename=None):
+    """Save a timestamp index to disk.
+
+    index = timestamp index, as returned by build_index()
+    filename = optional filename; default is cache/tsindex.json
+    """
+    filename = filename or index_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    print('--> writing ' + filename)
+    with open(filename, 'w') as fhandle:
+        fhandle.write(json.dumps(index, separators=(',', ':')))
+
+#-------------------------------------------------------------------------------
+def scan_folders(folder):
+    """Walk a folder hierarchy and list the folders in it.
+
+    folder = root folder to scan
+
+    Generates a (folder, mtime) tuple for each folder, including the root,
+    where mtime is the modified time in nanoseconds.
+    """
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+        direntries = list(os.scandir(folder))
+    except OSError:
+        return # folder was deleted or can't be read
+    yield (folder, mtime)
+    for direntry in direntries:
+        if direntry.is_dir(follow_symlinks=False):
+            yield from scan_folders(direntry.path)
+
+#-------------------------------------------------------------------------------
+def scan_tree(folder, folders=None, recursive=True):
+    """Walk a folder hierarchy and list the photo files in it.
+
+    folder = root folder to scan
+    folders = optional dictionary; if provided, the modified time (in
+              nanoseconds) of each folder scanned is stored in it
+    recursive = whether to scan subfolders
+
+    Generates a (filename, stat) tuple for each photo file, where filename is
+    the full path and stat is the os.stat() result.
+    """
+    try:
+        # get the folder's modified time before listing it, so that changes
+        # made during the scan are picked up by the next refresh
+        mtime = os.stat(folder).st_mtime_ns
+        direntries = list(os.scandir(folder))
+    except OSError:
+        return # folder was deleted or can't be read
+    if folders is not None:
+        folders[folder] = mtime
+    for direntry in direntries:
+        if direntry.is_dir(follow_symlinks=False):
+            if recursive:
+                yield from scan_tree(direntry.path, folders)
+            continue
+        _, fext = os.path.splitext(direntry.name)
+        if fext.lower() in PHOTO_EXTENSIONS:
+            try:
+                yield (direntry.path, direntry.stat())
+            except OSError:
+                continue
+
+#-------------------------------------------------------------------------------
+def ts_to_epoch(timestamp):
+    """Convert a 'YYYY-MM-DD HH:MM:SS' string to seconds since the epoch.
+
+    The timestamp is treated as UTC, so that the result is the same regardless
+    of the local timezone. (Flickr and EXIF timestamps have no timezone.)
+    """
+    return calendar.timegm((int(timestamp[:4]), int(timestamp[5:7]),
+                            int(timestamp[8:10]), int(timestamp[11:13]),
+                            int(timestamp[14:16]), int(timestamp[17:19])))
+
+#-------------------------------------------------------------------------------
+def update_folders(index, folders, workers=1, chunksize=200):
+    """Rescan specific folders and update the index.
+
+    index = timestamp index
+    folders = list of folders (relative to photo_home) that have changed; a
+              folder that no longer exists is removed from the index, along
+              with its subfolders
+    workers/chunksize = see file_timestamps()
+    """
+    recorded = index.setdefault('folders', dict())
+    rescan = set()
+    for folder in folders:
+        if os.path.isdir(os.path.join(index['photo_home'], folder)):
+            rescan.add(folder)
+        else:
+            rescan.update(subfolder for subfolder in recorded
+                          if subfolder == folder or
+                          subfolder.startswith(os.path.join(folder, '')))
+    if not rescan:
+        return
+
+    entries = [(epoch, filename) for epoch, filename
+               in zip(index['timestamps'], index['filenames'])
+               if os.path.dirname(filename) not in rescan]
+
+    scanned = dict()
+    files = itertools.chain.from_iterable(
+        scan_tree(os.path.join(index['photo_home'], folder), scanned, recursive=False)
+        for folder in sorted(rescan))
+    entries.extend(_index_entries(index, file_timestamps(files, workers, chunksize)))
+
+    for folder in rescan:
+        recorded.pop(folder, None)
+    for folder, mtime in scanned.items():
+        recorded[_relative_folder(index, folder)] = mtime
+    _set_entries(index, entries)
+
+#-------------------------------------------------------------------------------
+def watch_index(index, workers=1, chunksize=200, delay=1.0, filename=None):
+    """Watch the photo folder hierarchy and keep the index updated (Linux only).
+
+    index = timestamp index
+    workers/chunksize = see file_timestamps()
+    delay = seconds to wait for more changes before updating the index
+    filename = where to save the index after each update; default is
+               cache/tsindex.json
+
+    Uses inotify to detect files added, deleted, renamed or written in any
+    folder, and rescans just those folders. Runs until interrupted.
+    """
+    import ctypes
+    import ctypes.util
+    import select
+    import struct
+
+    # event flags, from <sys/inotify.h>
+    in_close_write, in_moved_from, in_moved_to = 0x8, 0x40, 0x80
+    in_create, in_delete, in_delete_self = 0x100, 0x200, 0x400
+    in_q_overflow, in_ignored, in_isdir = 0x4000, 0x8000, 0x40000000
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    inotify_fd = libc.inotify_init()
+    if inotify_fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    mask = in_close_write | in_moved_from | in_moved_to | in_create | in_delete | in_delete_self
+    watches = dict() # watch descriptor -> folder (relative to photo_home)
+
+    def add_watches(folder):
+        for subfolder, _ in scan_folders(os.path.join(index['photo_home'], folder)):
+            descriptor = libc.inotify_add_watch(inotify_fd, os.fsencode(subfolder), mask)
+            if descriptor >= 0:
+                watches[descriptor] = _relative_folder(index, subfolder)
+
+    def subtree(folder):
+        return [descriptor for descriptor, subfolder in watches.items()
+                if subfolder == folder or subfolder.startswith(os.path.join(folder, ''))]
+
+    add_watches('')
+    print('watching {0} folders'.format(len(watches)))
+    event_header = struct.Struct('iIII') # wd, mask, cookie, len
+    changed = set()
+    while True:
+        timeout = delay if changed else None
+        if not select.select([inotify_fd], [], [], timeout)[0]:
+            # no more events within delay seconds, so apply the changes
+            update_folders(index, sorted(changed), workers, chunksize)
+            save_index(index, filename)
+            changed = set()
+            continue
+        data = os.read(inotify_fd, 65536)
+        position = 0
+        while position < len(data):
+            descriptor, event_mask, _, length = event_header.unpack_from(data, position)
+            name = os.fsdecode(data[position + event_header.size:
+                                    position + event_header.size + length].rstrip(b'\0'))
+            position += event_header.size + length
+            if event_mask & in_q_overflow:
+                refresh_index(index, workers, chunksize) # events were lost
+                continue
+            folder = watches.get(descriptor)
+            if folder is None:
+                continue
+            if event_mask & in_ignored: # watched folder was deleted
+                del watches[descriptor]
+                continue
+            changed.add(folder)
+            if not event_mask & in_isdir:
+                continue
+            subfolder = os.path.join(folder, name)
+            if event_mask & (in_create | in_moved_to):
+                add_watches(subfolder)
+                changed.update(watches[descriptor] for descriptor in subtree(subfolder))
+            elif event_mask & (in_delete | in_moved_from):
+                # a moved folder keeps its watches, under the wrong name
+                for descriptor in subtree(subfolder):
+                    libc.inotify_rm_watch(inotify_fd, descriptor)
+                    watches.pop(descriptor, None)
+                changed.add(subfolder)
+
+#-------------------------------------------------------------------------------
+def _index_entries(index, timestamps):
+    """Convert (filename, timestamp) tuples to index entries.
+
+    Returns a list of (epoch, filename relative to photo_home) tuples; files
+    with invalid timestamps are skipped.
+    """
+    entries = []
+    for filename, taken in timestamps:
+        try:
+            entries.append((ts_to_epoch(taken), os.path.relpath(filename, index['photo_home'])))
+        except ValueError:
+            pass # invalid timestamp
+    return entries
+
+#-------------------------------------------------------------------------------
+def _parse_chunk(filenames):
+    """Get capture timestamps for a list of files. Runs in a worker process.
+
+    Returns a list of (filename, timestamp) tuples; timestamp is None if the
+    file couldn't be read.
+    """
+    results = []
+    for filename in filenames:
+        try:
+            results.append((filename, exifts.file_timestamp(filename)))
+        except OSError:
+            results.append((filename, None))
+    return results
+
+#-------------------------------------------------------------------------------
+def _relative_folder(index, folder):
+    """Get a folder's path relative to photo_home ('' for photo_home itself).
+    """
+    relpath = os.path.relpath(folder, index['photo_home'])
+    return '' if relpath == '.' else relpath
+
+#-------------------------------------------------------------------------------
+def _set_entries(index, entries):
+    """Sort index entries and store them in the index.
+    """
+    entries.sort()
+    index['timestamps'] = [epoch for epoch, _ in entries]
+    index['filenames'] = [relpath for _, relpath in entries]
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Build the photo timestamp index.')
+    PARSER.add_argument('photo_home', help='root folder of the photo backups')
+    PARSER.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default = # of CPUs)')
+    PARSER.add_argument('--chunksize', type=int, default=200,
+                        help='number of files per work unit')
+    PARSER.add_argument('--refresh', action='store_true',
+                        help='rescan only changed folders of the saved index')
+    PARSER.add_argument('--watch', action='store_true',
+                        help='keep the saved index updated as files change (Linux)')
+    PARSER.add_argument('--metrics', action='store_true',
+                        help='record timers/counters in cache/metrics.json')
+    ARGS = PARSER.parse_args()
+
+    if ARGS.metrics:
+        metrics.enable(interval=60)
+
+    INDEX = load_index() if ARGS.refresh or ARGS.watch else None
+    if INDEX and INDEX['photo_home'] == ARGS.photo_home:
+        print('{0} folders rescanned, {1} removed'.format(
+            *refresh_index(INDEX, workers=ARGS.workers, chunksize=ARGS.chunksize)))
+    else:
+        INDEX = build_index(ARGS.photo_home, workers=ARGS.workers, chunksize=ARGS.chunksize)
+    save_index(INDEX)
+    if ARGS.watch:
+        try:
+            watch_index(INDEX, workers=ARGS.workers or 1, chunksize=ARGS.chunksize)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,435 @@
+""" workqueue.py
+lease-based work queue for harvesting with several workers
+
+Each page of an account's photostream is a work unit: fetch the page
+(people.getPhotos), get the tag data for its photos (photos.getInfo, or the
+tags extra in bulk mode), and write the <user>-photostream-pageXXX.json and
+<user>-tags-pageXXX.json files. The units are kept in a SQLite database
+(cache/workqueue.db), and any number of worker processes, on this machine or
+on others that share the folder, claim units by taking a lease on them.
+
+- Adding an account queues its page 1; when page 1 is done, the rest of the
+  account's pages are queued (so only page 1 needs the page count).
+- A worker renews its lease while it works on a unit. If a worker dies, its
+  lease expires and the unit is claimed by another worker; units that fail
+  are retried, up to a limit.
+- A unit's pages are written and the unit is marked done in one
+  transaction, and only by the worker that holds the lease, so no page is
+  written twice.
+- Each worker has its own API key (a section of ../_private/flickr.ini)
+  with its own quota. All workers share the response cache (see
+  respcache.py), committing each response as it arrives, so when a unit is
+  claimed again after its lease expired, the API calls that were already
+  made for it are answered from the cache and no page is fetched twice.
+
+For workers on other machines, the queue and the cache folder must be on a
+shared volume whose file locking works with SQLite (which isn't always the
+case for NFS).
+
+Usage: python workqueue.py add [<user_id> ...] [--bulk]
+       python workqueue.py work --app APP [--app APP ...] [--threads 8]
+                                [--calls-per-hour 3600] [--lease 300]
+                                [--endpoint URL]
+       python workqueue.py status
+       python workqueue.py retry
+Use --queue FILE before the command for a queue other than
+cache/workqueue.db.
+"""
+import argparse
+import contextlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from flickrclient import API_ENDPOINT, FlickrClient, FlickrError
+import flickrtags
+import respcache
+
+#-------------------------------------------------------------------------------
+class WorkQueue:
+    """Queue of (account, page) work units, claimed with leases.
+
+    filename = SQLite database; default is cache/workqueue.db
+    lease_seconds = how long a claim lasts if it isn't renewed
+    max_attempts = number of times a unit is tried before it's marked failed
+
+    Each thread gets its own connection, so a queue can be shared by a
+    worker and its lease renewal thread.
+    """
+    def __init__(self, filename=None, *, lease_seconds=300, max_attempts=5):
+        self.filename = filename or queue_filename()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS units (user_id TEXT, pageno INTEGER, bulk INTEGER, '
+            'state TEXT, worker TEXT, lease TEXT, expires REAL, attempts INTEGER, '
+            'error TEXT, PRIMARY KEY (user_id, pageno))')
+
+    def add_user(self, user_id, bulk=False):
+        """Queue the first page of an account's photostream.
+
+        user_id = Flickr user ID
+        bulk = whether to get the tags with the photostream, 500 photos per
+               page, instead of a photos.getInfo call per photo (the tags
+               extra has Flickr's normalized tags, not the raw tags)
+
+        Returns True if the account was added, False if it was already queued.
+        """
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO units VALUES (?, 1, ?, 'pending', NULL, NULL, NULL, 0, NULL)",
+            (user_id, int(bulk)))
+        return cursor.rowcount == 1
+
+    def claim(self, worker):
+        """Claim the next available unit.
+
+        worker = name of the worker claiming it
+
+        Returns the unit, a dictionary with user_id, pageno, bulk and lease
+        (the lease ID, needed to renew or finish the unit), or None if no
+        unit is available now.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                "UPDATE units SET state='failed', lease=NULL, error='lease expired' "
+                "WHERE state='leased' AND expires<? AND attempts>=?", (now, self.max_attempts))
+            row = connection.execute(
+                "SELECT user_id, pageno, bulk FROM units WHERE state='pending' OR "
+                "(state='leased' AND expires<?) ORDER BY pageno, user_id LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            lease = uuid.uuid4().hex
+            connection.execute(
+                "UPDATE units SET state='leased', worker=?, lease=?, expires=?, "
+                "attempts=attempts+1 WHERE user_id=? AND pageno=?",
+                (worker, lease, now + self.lease_seconds, row[0], row[1]))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return {'user_id': row[0], 'pageno': row[1], 'bulk': bool(row[2]), 'lease': lease}
+
+    def complete(self, unit, write, tot_pages=None):
+        """Finish a unit: save its results, and mark it done.
+
+        unit = the unit, as returned by claim()
+        write = function that saves the unit's results; it's called with the
+                queue locked, and only if the lease is still held
+        tot_pages = for page 1, the number of pages in the photostream; the
+                    other pages are queued
+
+        Returns True if the unit was finished, or False if the lease was lost
+        (it expired and another worker claimed the unit), in which case
+        write isn't called. If write raises an exception, the unit isn't
+        marked done.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if not self._holds(unit):
+                connection.execute('ROLLBACK')
+                return False
+            write()
+            connection.execute("UPDATE units SET state='done', lease=NULL, error=NULL "
+                               "WHERE user_id=? AND pageno=?", (unit['user_id'], unit['pageno']))
+            if tot_pages:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO units VALUES "
+                    "(?, ?, ?, 'pending', NULL, NULL, NULL, 0, NULL)",
+                    [(unit['user_id'], pageno, int(unit['bulk']))
+                     for pageno in range(2, tot_pages + 1)])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return True
+
+    def counts(self):
+        """Get the number of units in each state, for each account.
+
+        Returns a dictionary of user_id -> dictionary of state -> count.
+        States are pending, leased, done and failed.
+        """
+        counts = dict()
+        for user_id, state, count in self._connection().execute(
+                'SELECT user_id, state, COUNT(*) FROM units GROUP BY user_id, state'):
+            counts.setdefault(user_id, dict())[state] = count
+        return counts
+
+    def leases(self):
+        """Get the units that are currently leased.
+
+        Returns a list of (user_id, pageno, worker, seconds left) tuples.
+        Negative seconds left means that the lease has expired, and the unit
+        will be claimed by the next worker that asks.
+        """
+        now = time.time()
+        return [(user_id, pageno, worker, expires - now) for user_id, pageno, worker, expires
+                in self._connection().execute(
+                    "SELECT user_id, pageno, worker, expires FROM units WHERE state='leased' "
+                    "ORDER BY user_id, pageno")]
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the queue's write lock, to serialize updates that all of the
+        workers make to shared files. Does nothing extra if this thread is
+        already in a transaction (e.g. in a complete() write function).
+        """
+        connection = self._connection()
+        if connection.in_transaction:
+            yield
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        finally:
+            connection.execute('COMMIT')
+
+    def release(self, unit, error):
+        """Give up on a unit after an error, so that it can be retried.
+
+        unit = the unit, as returned by claim()
+        error = error message, saved with the unit
+
+        The unit is marked failed if it has been tried max_attempts times.
+        """
+        self._connection().execute(
+            "UPDATE units SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END, "
+            "lease=NULL, error=? WHERE user_id=? AND pageno=? AND lease=?",
+            (self.max_attempts, error, unit['user_id'], unit['pageno'], unit['lease']))
+
+    def remaining(self):
+        """Get the number of units that are pending or leased.
+        """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def renew(self, unit):
+        """Extend the lease on a unit.
+
+        Returns True if the lease was renewed, or False if it was lost.
+        """
+        cursor = self._connection().execute(
+            "UPDATE units SET expires=? WHERE user_id=? AND pageno=? AND lease=? "
+            "AND state='leased'",
+            (time.time() + self.lease_seconds, unit['user_id'], unit['pageno'], unit['lease']))
+        return cursor.rowcount == 1
+
+    def retry_failed(self):
+        """Queue the failed units again, with a new set of attempts.
+
+        Returns the number of units queued.
+        """
+        return self._connection().execute(
+            "UPDATE units SET state='pending', attempts=0 WHERE state='failed'").rowcount
+
+    def _connection(self):
+        """Get this thread's connection to the queue database.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit, with explicit transactions for claim() and
+            # complete(); waits up to a minute for another worker's lock
+            connection = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            self.local.connection = connection
+        return connection
+
+    def _holds(self, unit):
+        """Determine whether a unit's lease is still held.
+        """
+        row = self._connection().execute(
+            "SELECT 1 FROM units WHERE user_id=? AND pageno=? AND lease=? AND state='leased'",
+            (unit['user_id'], unit['pageno'], unit['lease'])).fetchone()
+        return row is not None
+
+#-------------------------------------------------------------------------------
+def fetch_unit(client, unit, executor):
+    """Get the photostream page and tag records for a unit.
+
+    client = FlickrClient used for the API calls
+    unit = the unit, as returned by WorkQueue.claim()
+    executor = thread pool for the photos.getInfo calls
+
+    Returns (jsondata, records): the people.getPhotos payload, and the tag
+    records for the page's photos, in photostream order.
+    """
+    user_id = unit['user_id']
+    params = {'user_id': user_id, 'per_page': '500' if unit['bulk'] else '100',
+              'page': str(unit['pageno'])}
+    if unit['bulk']:
+        params['extras'] = 'date_taken,tags'
+    jsondata = client.call('flickr.people.getPhotos', **params)
+    photos = jsondata['photos']['photo']
+    if unit['bulk']:
+        return (jsondata, [flickrtags.bulk_tag_record(user_id, photo) for photo in photos])
+
+    infos = executor.map(lambda photo: client.call('flickr.photos.getInfo',
+                                                   photo_id=photo['id']), photos)
+    return (jsondata, [flickrtags.tag_record(user_id, photo, photo_info)
+                       for photo, photo_info in zip(photos, infos)])
+
+#-------------------------------------------------------------------------------
+def print_status(queue):
+    """Print the number of units in each state, and the current leases.
+
+    queue = WorkQueue
+    """
+    for user_id, counts in sorted(queue.counts().items()):
+        print('{0:20} '.format(user_id) + ', '.join(
+            '{0} {1}'.format(counts.get(state, 0), state)
+            for state in ['pending', 'leased', 'done', 'failed']))
+    for user_id, pageno, worker, left in queue.leases():
+        print('  {0} page {1}: {2}, {3:.0f} seconds left'.format(user_id, pageno, worker, left))
+
+#-------------------------------------------------------------------------------
+def queue_filename():
+    """Get filename for the default work queue database.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/workqueue.db')
+
+#-------------------------------------------------------------------------------
+def run_worker(app, *, filename=None, endpoint=API_ENDPOINT, threads=8,
+               calls_per_hour=3600, burst=10, lease_seconds=300, poll=5):
+    """Claim and process units until the queue is empty.
+
+    app = section of ../_private/flickr.ini with this worker's API key
+    filename = queue database; default is cache/workqueue.db
+    endpoint = URL of the Flickr REST API
+    threads = number of concurrent photos.getInfo calls
+    calls_per_hour = this worker's API quota
+    burst = number of calls that can be made at once after an idle period
+    lease_seconds = how long a claim lasts if the worker stops renewing it
+    poll = seconds to wait when other workers hold all of the remaining units
+
+    Returns the number of units this worker completed.
+    """
+    import concurrent.futures
+    import requests
+    from harvest import TokenBucket
+    queue = WorkQueue(filename, lease_seconds=lease_seconds)
+    worker = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), app)
+    cache = respcache.ResponseCache(commit_every=1) # shared with the other workers
+    client = FlickrClient(app, endpoint=endpoint, pool_size=threads, cache=cache,
+                          limiter=TokenBucket((calls_per_hour - burst) / 3600, burst))
+    completed = 0
+    # the tag store is updated in batches, with the queue locked
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor, \
+        flickrtags.batched_store(lock=queue.locked):
+        while True:
+            unit = queue.claim(worker)
+            if unit is None:
+                if not queue.remaining():
+                    break
+                time.sleep(poll) # wait for new pages, or for a lease to expire
+                continue
+
+            stop_renewing = threading.Event()
+            renewer = threading.Thread(target=_renew_lease,
+                                       args=(queue, unit, stop_renewing), daemon=True)
+            renewer.start()
+            try:
+                jsondata, records = fetch_unit(client, unit, executor)
+
+                def write(unit=unit, jsondata=jsondata, records=records):
+                    flickrtags.write_cache(user_id=unit['user_id'], pageno=unit['pageno'],
+                                           datatype='photostream', jsondata=jsondata)
+                    flickrtags.write_cache(user_id=unit['user_id'], pageno=unit['pageno'],
+                                           datatype='tags', jsondata=records)
+
+                tot_pages = jsondata['photos']['pages'] if unit['pageno'] == 1 else None
+                if queue.complete(unit, write, tot_pages):
+                    completed += 1
+                else:
+                    print('lease lost for {0} page {1}; not written'.format(
+                        unit['user_id'], unit['pageno']))
+            except (requests.RequestException, ValueError, KeyError, OSError, FlickrError,
+                    respcache.NotCached) as err:
+                print('ERROR: {0} page {1} - {2}'.format(unit['user_id'], unit['pageno'], err))
+                queue.release(unit, str(err))
+            finally:
+                stop_renewing.set()
+                renewer.join()
+
+    client.close()
+    cache.close()
+    print('{0}: {1} pages harvested'.format(worker, completed))
+    return completed
+
+#-------------------------------------------------------------------------------
+def run_workers(apps, **options):
+    """Run a worker process for each API key.
+
+    apps = list of sections of ../_private/flickr.ini, one per worker
+    options = keyword arguments passed to run_worker()
+
+    Returns the total number of units completed.
+    """
+    if len(apps) == 1:
+        return run_worker(apps[0], **options)
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(apps)) as executor:
+        futures = [executor.submit(run_worker, app, **options) for app in apps]
+        return sum(future.result() for future in futures)
+
+#-------------------------------------------------------------------------------
+def _renew_lease(queue, unit, stop):
+    """Renew a unit's lease periodically, until stop is set.
+
+    Runs on its own thread while the worker processes the unit.
+    """
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.renew(unit):
+            break # lost; complete() will refuse to write the unit
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Work queue for harvesting with many workers.')
+    PARSER.add_argument('--queue', default=None, help='queue database (default = '
+                        'cache/workqueue.db)')
+    PARSER.add_argument('command', choices=['add', 'work', 'status', 'retry'])
+    PARSER.add_argument('user_id', nargs='*', help='for add: Flickr user IDs (default = all)')
+    PARSER.add_argument('--bulk', action='store_true',
+                        help='for add: get normalized tags with the photostream, '
+                        '500 photos per call')
+    PARSER.add_argument('--app', action='append',
+                        help='for work: section of ../_private/flickr.ini with an API key '
+                        '(repeatable; one worker process per key)')
+    PARSER.add_argument('--threads', type=int, default=8,
+                        help='for work: concurrent API calls per worker')
+    PARSER.add_argument('--calls-per-hour', type=int, default=3600,
+                        help='for work: API quota of each key')
+    PARSER.add_argument('--lease', type=int, default=300,
+                        help='for work: seconds a claim lasts if not renewed')
+    PARSER.add_argument('--endpoint', default=API_ENDPOINT,
+                        help='for work: Flickr REST API endpoint (e.g., fakeflickr.py)')
+    ARGS = PARSER.parse_args()
+
+    QUEUE = WorkQueue(ARGS.queue)
+    if ARGS.command == 'add':
+        for USER_ID in ARGS.user_id or flickrtags.USERS:
+            print('{0}: {1}'.format(USER_ID, 'queued' if QUEUE.add_user(USER_ID, ARGS.bulk)
+                                    else 'already queued'))
+    elif ARGS.command == 'work':
+        if not ARGS.app:
+            print('ERROR: work needs at least one --app')
+            sys.exit(1)
+        run_workers(ARGS.app, filename=ARGS.queue, endpoint=ARGS.endpoint,
+                    threads=ARGS.threads, calls_per_hour=ARGS.calls_per_hour,
+                    lease_seconds=ARGS.lease)
+    elif ARGS.command == 'retry':
+        print('{0} failed units queued again'.format(QUEUE.retry_failed()))
+    else:
+        print_status(QUEUE)
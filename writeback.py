@@ -0,0 +1,296 @@
+""" writeback.py
+write matched Flickr keywords next to the original files
+
+For each photo matched to a file (see matcher.py and phash.py), the photo's
+keywords are written to a sidecar file next to the original: an XMP sidecar
+(DSC_1234.NEF -> DSC_1234.xmp, keywords in dc:subject, which Lightroom,
+digiKam and most other tools read), or a plain DSC_1234-keyword.txt file
+with one keyword per line. The keywords are normalized by the rules in
+tagrules.ini (see tagrules.py), which drop the auto-generated flickr-* tags.
+
+Each sidecar is rendered in memory and compared with the existing file, and
+only files whose content changed are written, so a re-run over the whole
+archive only touches what's new. Writes are atomic (temp file + rename) and
+spread across a thread pool. XMP sidecars that weren't written by this
+module (e.g. Lightroom develop settings) are never replaced: the keywords
+are merged into their dc:subject and the rest of the file is kept as is
+(sidecars that can't be merged are listed and left alone).
+
+The sidecars this module has written are listed in cache/writeback.json.
+A listed sidecar that isn't in the current output, because its file lost
+its keywords, was matched to another photo, or is no longer matched at all,
+is removed (if it's still the one written here).
+
+Usage: python writeback.py [--format xmp|txt] [--workers 8] [--ambiguous]
+                           [--dry-run]
+"""
+import argparse
+from collections import Counter
+import json
+import os
+import re
+import sys
+from xml.sax.saxutils import escape, unescape
+
+import tagrules
+
+CREATOR_TOOL = 'phototag' # xmp:CreatorTool of the sidecars written here
+WRITE_STATUSES = ['exact', 'near', 'phash'] # match statuses written by default
+
+XMP_TEMPLATE = '''<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmp:CreatorTool="{creator}">
+   <dc:subject>
+    <rdf:Bag>
+{items}
+    </rdf:Bag>
+   </dc:subject>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+'''
+DC_NAMESPACE = 'http://purl.org/dc/elements/1.1/'
+
+#-------------------------------------------------------------------------------
+def file_keywords(matches, records, statuses=None, rules=None):
+    """Get the keywords to write for each matched file.
+
+    matches = dictionary of photo_url -> match, from matcher.load_matches()
+    records = iterable of raw tag records (dictionaries), i.e. from
+              flickrtags.tag_records(user_id, normalize=False)
+    statuses = match statuses to include; default is WRITE_STATUSES
+    rules = tagrules.TagRules to normalize the keywords; default is
+            tagrules.default_rules()
+
+    Returns a dictionary of filename -> sorted list of keywords. Files left
+    with no keywords are left out (write_keywords() removes their sidecars).
+    """
+    statuses = set(statuses or WRITE_STATUSES)
+    rules = rules or tagrules.default_rules()
+    keywords = dict()
+    for record in records:
+        match = matches.get(record['photo_url'])
+        if not match or not match['filename'] or match['status'] not in statuses:
+            continue
+        words = rules.normalize_keywords(record['keywords'])
+        if words:
+            keywords.setdefault(match['filename'], set()).update(words)
+    return {filename: sorted(words) for filename, words in keywords.items()}
+
+#-------------------------------------------------------------------------------
+def manifest_filename():
+    """Get filename for the list of sidecars written by this module.
+    """
+    source_folder = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(source_folder, 'cache/writeback.json')
+
+#-------------------------------------------------------------------------------
+def render_sidecar(keywords, sidecar_format='xmp'):
+    """Get the content of a sidecar file.
+
+    keywords = sorted list of keywords
+    sidecar_format = 'xmp' or 'txt'
+
+    Returns the content as bytes (UTF-8).
+    """
+    if sidecar_format == 'txt':
+        return ''.join(keyword + '\n' for keyword in keywords).encode('utf-8')
+    items = '\n'.join('     <rdf:li>' + escape(keyword) + '</rdf:li>' for keyword in keywords)
+    return XMP_TEMPLATE.format(creator=CREATOR_TOOL, items=items).encode('utf-8')
+
+#-------------------------------------------------------------------------------
+def sidecar_filename(filename, sidecar_format='xmp'):
+    """Get the sidecar filename for an original.
+
+    filename = full path of the original, e.g. 'd:/photos/DSC_1234.NEF'
+    sidecar_format = 'xmp' (-> DSC_1234.xmp) or 'txt' (-> DSC_1234-keyword.txt)
+    """
+    stem = os.path.splitext(filename)[0]
+    return stem + ('-keyword.txt' if sidecar_format == 'txt' else '.xmp')
+
+#-------------------------------------------------------------------------------
+def write_keywords(keywords, sidecar_format='xmp', workers=8, dry_run=False,
+                   manifest=None):
+    """Write sidecar files for a set of files.
+
+    keywords = dictionary of filename -> sorted list of keywords, as
+               returned by file_keywords()
+    sidecar_format = 'xmp' or 'txt'
+    workers = number of threads writing files
+    dry_run = if True, only count what would be written
+    manifest = optional filename of the list of sidecars written by this
+               module; default is cache/writeback.json
+
+    Sidecars in the manifest (for this format) that aren't in keywords are
+    removed, and the manifest is updated (except in a dry run). Returns a
+    Counter of results: written, merged (keywords added to an existing XMP
+    sidecar from another tool), removed (a sidecar written here that's no
+    longer in the output), unchanged, foreign (an XMP sidecar from another
+    tool that couldn't be merged, left alone) and error.
+    """
+    import concurrent.futures
+    # originals with the same name and different extensions (DSC_1234.jpg
+    # and DSC_1234.NEF) share a sidecar, which gets the keywords of both
+    sidecars = dict()
+    for filename, words in keywords.items():
+        sidecars.setdefault(sidecar_filename(filename, sidecar_format), set()).update(words)
+    manifest = manifest or manifest_filename()
+    owned = dict()
+    if os.path.isfile(manifest):
+        with open(manifest, 'r', encoding='utf-8') as fhandle:
+            owned = json.loads(fhandle.read())
+    previous = set(owned.get(sidecar_format, []))
+    for sidecar in previous:
+        sidecars.setdefault(sidecar, set()) # no keywords now, so it's removed
+
+    def write(item):
+        sidecar, words = item
+        return _write_sidecar(sidecar, sorted(words), sidecar_format, dry_run)
+
+    items = list(sidecars.items())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(write, items))
+    if not dry_run:
+        owned[sidecar_format] = sorted(
+            sidecar for (sidecar, _), (_, ours) in zip(items, results)
+            if ours or (ours is None and sidecar in previous))
+        os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        with open(manifest + '.tmp', 'w', encoding='utf-8') as fhandle:
+            fhandle.write(json.dumps(owned, ensure_ascii=False))
+        os.replace(manifest + '.tmp', manifest)
+    return Counter(result for result, _ in results)
+
+#-------------------------------------------------------------------------------
+def _merge_xmp(existing, keywords):
+    """Merge keywords into the dc:subject of an XMP sidecar from another tool.
+
+    existing = content of the sidecar (bytes)
+    keywords = sorted list of keywords
+
+    Keywords already in the sidecar are kept, in their order, and the new
+    ones are added after them; the rest of the file isn't changed. Returns
+    the new content (bytes), or None if the sidecar can't be merged.
+    """
+    try:
+        text = existing.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    subject = re.search(r'<dc:subject>\s*<rdf:Bag>(.*?)</rdf:Bag>', text, re.DOTALL)
+    if subject:
+        present = {unescape(item) for item
+                   in re.findall(r'<rdf:li[^>]*>(.*?)</rdf:li>', subject.group(1), re.DOTALL)}
+        # new items go after the last one, with the same indentation
+        last = list(re.finditer(r'([ \t]*)<rdf:li[^>]*>.*?</rdf:li>', subject.group(1),
+                                re.DOTALL))
+        indent = last[-1].group(1) if last else ''
+        added = ''.join('\n' + indent + '<rdf:li>' + escape(keyword) + '</rdf:li>'
+                        for keyword in keywords if keyword not in present)
+        if not added:
+            return existing
+        position = subject.start(1) + (last[-1].end() if last else 0)
+        return (text[:position] + added + text[position:]).encode('utf-8')
+    if '<dc:subject' in text:
+        return None # e.g. an empty <dc:subject/>, or an rdf:Seq
+    description = re.search(r'<rdf:Description\b[^>]*?(/?)>', text)
+    if not description:
+        return None
+    start_tag = text[description.start():description.end() - len(description.group(1)) - 1]
+    if 'xmlns:dc=' not in text:
+        start_tag += ' xmlns:dc="' + DC_NAMESPACE + '"'
+    items = ''.join('<rdf:li>' + escape(keyword) + '</rdf:li>\n' for keyword in keywords)
+    block = '>\n<dc:subject>\n<rdf:Bag>\n' + items + '</rdf:Bag>\n</dc:subject>\n'
+    if description.group(1):
+        block += '</rdf:Description>' # was self-closing
+    text = text[:description.start()] + start_tag + block + text[description.end():]
+    return text.encode('utf-8')
+
+#-------------------------------------------------------------------------------
+def _write_sidecar(sidecar, keywords, sidecar_format, dry_run):
+    """Write one sidecar file, if its content has changed, or remove it if
+    it was written here and there are no keywords.
+
+    Returns (result, ours): result is 'written', 'merged', 'removed',
+    'unchanged', 'foreign' or 'error', and ours is whether the sidecar is
+    now one written by this module (None if it couldn't be read).
+    """
+    try:
+        with open(sidecar, 'rb') as fhandle:
+            existing = fhandle.read()
+    except FileNotFoundError:
+        existing = None
+    except OSError:
+        return ('error', None)
+    foreign = existing is not None and sidecar_format == 'xmp' and \
+        ('xmp:CreatorTool="' + CREATOR_TOOL + '"').encode('utf-8') not in existing
+
+    if not keywords:
+        if existing is None or foreign:
+            return ('unchanged', False)
+        if not dry_run:
+            try:
+                os.remove(sidecar)
+            except OSError as err:
+                print('ERROR: could not remove {0} - {1}'.format(sidecar, err))
+                return ('error', True)
+        return ('removed', False)
+
+    if foreign:
+        content = _merge_xmp(existing, keywords)
+        if content is None:
+            print('--> skipping {0} (XMP from another tool, could not merge)'.format(sidecar))
+            return ('foreign', False)
+        result = 'merged'
+    else:
+        content = render_sidecar(keywords, sidecar_format)
+        result = 'written'
+    if existing == content:
+        return ('unchanged', not foreign)
+    if dry_run:
+        return (result, not foreign)
+
+    tempfile = sidecar + '.tmp'
+    try:
+        with open(tempfile, 'wb') as fhandle:
+            fhandle.write(content)
+        os.replace(tempfile, sidecar)
+    except OSError as err:
+        print('ERROR: could not write {0} - {1}'.format(sidecar, err))
+        return ('error', existing is not None and not foreign)
+    return (result, not foreign)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description='Write keywords next to the originals.')
+    PARSER.add_argument('--format', choices=['xmp', 'txt'], default='xmp',
+                        help='XMP sidecars or *-keyword.txt files')
+    PARSER.add_argument('--workers', type=int, default=8, help='number of writer threads')
+    PARSER.add_argument('--ambiguous', action='store_true',
+                        help='also write keywords for ambiguous matches')
+    PARSER.add_argument('--dry-run', action='store_true',
+                        help="count the files that would change, but don't write them")
+    ARGS = PARSER.parse_args()
+
+    import itertools
+    import time
+    from flickrtags import USERS, tag_records
+    import matcher
+    MATCHES = matcher.load_matches()
+    if not MATCHES:
+        print('ERROR: no saved matches; run matcher.py first')
+        sys.exit(1)
+    START = time.time()
+    STATUSES = WRITE_STATUSES + (['ambiguous'] if ARGS.ambiguous else [])
+    RECORDS = itertools.chain.from_iterable(tag_records(user_id, normalize=False)
+                                            for user_id in USERS)
+    KEYWORDS = file_keywords(MATCHES, RECORDS, STATUSES)
+    TOTALS = write_keywords(KEYWORDS, ARGS.format, ARGS.workers, ARGS.dry_run)
+    print('{0} sidecars: {1} written, {2} merged, {3} removed, {4} unchanged, '
+          '{5} foreign, {6} errors, {7:.1f} seconds'.format(
+              sum(TOTALS.values()), TOTALS['written'], TOTALS['merged'], TOTALS['removed'],
+              TOTALS['unchanged'], TOTALS['foreign'], TOTALS['error'], time.time() - START))